@@ -85,9 +85,9 @@ workflow only_gnomon {
 
 
         annot_builder(gencoll_asn, models, genome_asn, task_params.get('annot_builder', [:]))
-        def accept_asn = annot_builder.out.accept_asn
+        def accept_annot_file = annot_builder.out.accept_ftable_annot
         
-        annotwriter(accept_asn, [:])
+        annotwriter(accept_annot_file, [:])
         annotwriter.out.annoted_file
     emit:
         out_files = annotwriter.out.annoted_file
@@ -8,10 +8,12 @@ include { egapx } from './subworkflows/ncbi/main'
 include { only_gnomon } from './subworkflows/ncbi/only_gnomon'
 
 params.verbose = false
+// egapx.py --publish-mode publishes symlinks and replaces them with hardlinks, reflinks or moved files after the run
+params.publish_mode = 'copy'
 
 
 process export {
-    publishDir "${params.output}", mode: 'copy', saveAs: { fn -> fn.substring(fn.lastIndexOf('/')+1) }
+    publishDir "${params.output}", mode: params.publish_mode, saveAs: { fn -> fn.substring(fn.lastIndexOf('/')+1) }
     input:
         path out_files
         path annot_builder_output, stageAs: 'annot_builder_output/*'
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+# Benchmarks of the EGAPx runner on synthetic data served by local FTP and HTTP servers
+#
+# python ui/benchmark.py                    run all benchmarks at default sizes
+# python ui/benchmark.py --gff-mb 4096      print_statistics on 4 GB accept.gff
+# python ui/benchmark.py --only lineage download_https
+#
+# Results are appended to benchmark_results.jsonl and compared with the previous result
+# for the same host and sizes, slower than --threshold is reported as regression
+import argparse
+import contextlib
+import copy
+import datetime
+import gzip
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import socketserver
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+
+RESULTS_NAME = "benchmark_results.jsonl"
+DATA_SUBSYSTEM_VERSION = "1"
+PROTEIN_ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+NUCLEOTIDES = "ACGT"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks of EGAPx runner on synthetic data")
+    parser.add_argument("--only", nargs='+', help="Run only benchmarks with these names or name prefixes", default=[])
+    parser.add_argument("--list", help="List benchmarks and exit", action="store_true", default=False)
+    parser.add_argument("-r", "--repeat", help="Runs of each benchmark, median is reported, default 3", type=int, default=3)
+    parser.add_argument("--taxa", help="Nodes in synthetic taxonomy, default 200000", type=int, default=200000)
+    parser.add_argument("--references", help="HMM parameter sets and protein bags in support data, default 500", type=int, default=500)
+    parser.add_argument("--reference-kb", help="Size of each HMM parameter file and protein bag in KB, default 16", type=int, default=16)
+    parser.add_argument("--queries", help="Taxids looked up by lineage and closest reference benchmarks, default 1000", type=int, default=1000)
+    parser.add_argument("--read-files", help="Read files for prepare_reads, default 2000", type=int, default=2000)
+    parser.add_argument("--reads-per-file", help="Reads in each read file, default 200", type=int, default=200)
+    parser.add_argument("--gff-mb", help="Size of synthetic accept.gff in MB, default 256", type=int, default=256)
+    parser.add_argument("--download-workers", help="Workers for download benchmarks, default 4", type=int, default=4)
+    parser.add_argument("--nextflow", help="Nextflow executable for --stub-run benchmark, default is a stand-in that only writes the trace, "
+                        "so that only the runner overhead is measured", default="")
+    parser.add_argument("--seed", help="Random seed for synthetic data", type=int, default=1)
+    parser.add_argument("-w", "--workdir", help="Directory for synthetic data, default is a temporary directory", default="")
+    parser.add_argument("-k", "--keep", help="Keep synthetic data after the run", action="store_true", default=False)
+    parser.add_argument("-o", "--results", help=f"Results file, default {RESULTS_NAME}", default=RESULTS_NAME)
+    parser.add_argument("-t", "--threshold", help="Relative slowdown against the previous result reported as regression, default 0.25", type=float, default=0.25)
+    parser.add_argument("--min-delta", help="Ignore slowdowns smaller than this many seconds, default 0.05", type=float, default=0.05)
+    parser.add_argument("--check", help="Exit with error if there are regressions", action="store_true", default=False)
+    parser.add_argument("--no-save", help="Do not append results to results file", action="store_true", default=False)
+    parser.add_argument("-v", "--verbose", help="Show runner output", action="store_true", default=False)
+    return parser.parse_args(argv[1:])
+
+
+## Synthetic data
+
+def random_taxonomy(n, rng):
+    """ Random tree of n nodes as list of (taxid, parent), taxids are sparse like in the real taxonomy.
+    Parent of node i is one of nodes i/8..i-1, which gives depth logarithmic in n """
+    taxids = [1] + rng.sample(range(2, n * 4), n - 1)
+    nodes = [(1, 1)]
+    for i in range(1, n):
+        nodes.append((taxids[i], taxids[rng.randrange(i // 8, i)]))
+    return nodes
+
+
+def make_support_data(root, args, rng):
+    """ Support data tree in the layout of the FTP site under root, returns (support data directory, taxonomy nodes) """
+    support = os.path.join(root, egapx.FTP_EGAP_ROOT_PATH)
+    taxonomy_dir = os.path.join(support, "taxonomy", DATA_SUBSYSTEM_VERSION)
+    hmm_dir = os.path.join(support, "gnomon", DATA_SUBSYSTEM_VERSION, "hmm_parameters")
+    proteins_dir = os.path.join(support, "target_proteins", DATA_SUBSYSTEM_VERSION)
+    for d in (taxonomy_dir, hmm_dir, proteins_dir):
+        os.makedirs(d, exist_ok=True)
+    with open(os.path.join(support, f"{egapx.DATA_VERSION}.mft"), 'wt') as f:
+        for subsystem in ("gnomon", "target_proteins", "taxonomy"):
+            f.write(f"{subsystem}/{DATA_SUBSYSTEM_VERSION}\n")
+
+    nodes = random_taxonomy(args.taxa, rng)
+    conn = sqlite3.connect(os.path.join(taxonomy_dir, "taxonomy4blast.sqlite3"))
+    conn.execute("CREATE TABLE TaxidInfo (taxid INTEGER PRIMARY KEY, parent INTEGER, rank TEXT, scientific_name TEXT)")
+    conn.executemany("INSERT INTO TaxidInfo VALUES (?, ?, 'no rank', ?)", ((t, p, f"taxon {t}") for t, p in nodes))
+    conn.commit()
+    conn.close()
+
+    parents = dict(nodes)
+    def lineage(taxid):
+        result = []
+        while taxid != 1:
+            taxid = parents[taxid]
+            result.append(taxid)
+        result.reverse()
+        return result
+
+    # HMMs for any taxa, protein bags for upper nodes since they are matched only by taxid in the lineage
+    size = args.reference_kb * 1024
+    hmm_taxids = rng.sample([t for t, _ in nodes[1:]], min(args.references, len(nodes) - 1))
+    with open(os.path.join(hmm_dir, "taxid.list"), 'wt') as f:
+        for taxid in hmm_taxids:
+            f.write(f"{taxid}\t{'; '.join(map(str, lineage(taxid)))};\n")
+            with open(os.path.join(hmm_dir, f"{taxid}.params"), 'wt') as p:
+                p.write("".join(rng.choices(NUCLEOTIDES, k=size)))
+    upper = [t for t, _ in nodes[1:max(len(nodes) // 20, 2)]]
+    protein_taxids = rng.sample(upper, min(args.references, len(upper)))
+    with open(os.path.join(proteins_dir, "taxid.list"), 'wt') as f:
+        f.write("#taxid\tname\n")
+        for taxid in protein_taxids:
+            f.write(f"{taxid}\ttaxon {taxid}\n")
+            with gzip.open(os.path.join(proteins_dir, f"{taxid}.faa.gz"), 'wt', compresslevel=1) as p:
+                for i in range(max(size // 400, 1)):
+                    p.write(f">prot{taxid}_{i}\n{''.join(rng.choices(PROTEIN_ALPHABET, k=400))}\n")
+    return support, nodes
+
+
+def make_reads(directory, n_files, reads_per_file, rng):
+    "Paired FASTQ files of SRA runs, n_files in total"
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    quality = "I" * 100
+    for run in range(max(n_files // 2, 1)):
+        for mate in (1, 2):
+            name = os.path.join(directory, f"SRR{1000000 + run}_{mate}.fastq")
+            with open(name, 'wt') as f:
+                for i in range(reads_per_file):
+                    f.write(f"@SRR{1000000 + run}.{i}/{mate}\n{''.join(rng.choices(NUCLEOTIDES, k=100))}\n+\n{quality}\n")
+            files.append(name)
+    return files
+
+
+def make_gff(path, size_mb, rng):
+    "Gnomon-like accept.gff of about size_mb, genes of 1 to 10 exons on 100 sequences"
+    target = size_mb << 20
+    block = []
+    for i in range(1000):
+        seqid = f"NC_{i % 100:06d}.1"
+        start = 1000 + i * 20000
+        exons = rng.randint(1, 10)
+        gene = f"gene-LOC{i}"
+        rna = f"rna-XM_{i}.1"
+        end = start + exons * 1000 - 500
+        partial = ";partial=true" if i % 13 == 0 else ""
+        block.append(f"{seqid}\tGnomon\tgene\t{start}\t{end}\t.\t+\t.\tID={gene};Name=LOC{i};gene_biotype=protein_coding{partial}\n")
+        block.append(f"{seqid}\tGnomon\tmRNA\t{start}\t{end}\t.\t+\t.\tID={rna};Parent={gene};product=uncharacterized protein{partial}\n")
+        for e in range(exons):
+            s = start + e * 1000
+            block.append(f"{seqid}\tGnomon\texon\t{s}\t{s + 499}\t.\t+\t.\tID=exon-XM_{i}.1-{e + 1};Parent={rna}\n")
+            block.append(f"{seqid}\tGnomon\tCDS\t{s}\t{s + 499}\t.\t+\t0\tID=cds-XP_{i}.1;Parent={rna}\n")
+    block = "".join(block).encode()
+    with open(path, 'wb') as f:
+        f.write(b"##gff-version 3\n")
+        for i in range(100):
+            f.write(f"##sequence-region NC_{i:06d}.1 1 30000000\n".encode())
+        written = 0
+        while written < target:
+            f.write(block)
+            written += len(block)
+
+
+## Local servers
+
+class QuietHttpHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+    """ Minimal anonymous read-only FTP server, just the commands used by ftplib and urllib:
+    passive mode, MLSD, SIZE, MDTM, RETR with REST, CWD and PWD """
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def local_path(self, path):
+        path = path if path.startswith('/') else f"{self.cwd.rstrip('/')}/{path}"
+        full = os.path.normpath(os.path.join(self.server.root, path.lstrip('/')))
+        return full if full == self.server.root or full.startswith(self.server.root + os.sep) else None
+
+    def transfer(self, send):
+        if not self.pasv:
+            self.reply("425 Use PASV first")
+            return
+        self.reply("150 Opening data connection")
+        conn, _ = self.pasv.accept()
+        try:
+            send(conn)
+        finally:
+            conn.close()
+            self.pasv.close()
+            self.pasv = None
+        self.reply("226 Transfer complete")
+
+    def handle(self):
+        self.cwd = "/"
+        self.pasv = None
+        self.rest = 0
+        self.reply("220 EGAPx benchmark FTP")
+        for line in self.rfile:
+            cmd, _, arg = line.decode().rstrip("\r\n").partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'QUIT':
+                self.reply("221 Bye")
+                return
+            elif cmd == 'USER':
+                self.reply("331 Any password")
+            elif cmd == 'PASS':
+                self.reply("230 Logged in")
+            elif cmd in ('TYPE', 'NOOP', 'MODE', 'STRU'):
+                self.reply("200 OK")
+            elif cmd == 'SYST':
+                self.reply("215 UNIX Type: L8")
+            elif cmd == 'PWD':
+                self.reply(f'257 "{self.cwd}"')
+            elif cmd == 'CWD':
+                path = self.local_path(arg)
+                if path and os.path.isdir(path):
+                    self.cwd = "/" + os.path.relpath(path, self.server.root).replace(os.sep, '/').lstrip('.')
+                    self.reply("250 OK")
+                else:
+                    self.reply(f"550 {arg}: No such directory")
+            elif cmd == 'PASV':
+                self.pasv = socket.create_server(("127.0.0.1", 0))
+                port = self.pasv.getsockname()[1]
+                self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+            elif cmd == 'REST':
+                self.rest = int(arg)
+                self.reply(f"350 Restarting at {self.rest}")
+            elif cmd == 'SIZE':
+                path = self.local_path(arg)
+                if path and os.path.isfile(path):
+                    self.reply(f"213 {os.path.getsize(path)}")
+                else:
+                    self.reply(f"550 {arg}: Not a regular file")
+            elif cmd == 'MDTM':
+                path = self.local_path(arg)
+                if path and os.path.isfile(path):
+                    modify = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+                    self.reply(f"213 {modify}")
+                else:
+                    self.reply(f"550 {arg}: Not a regular file")
+            elif cmd == 'MLSD':
+                path = self.local_path(arg or self.cwd)
+                if not path or not os.path.isdir(path):
+                    self.reply(f"550 {arg}: No such directory")
+                    continue
+                lines = []
+                for entry in os.scandir(path):
+                    st = entry.stat()
+                    modify = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc).strftime('%Y%m%d%H%M%S')
+                    kind = 'dir' if entry.is_dir() else 'file'
+                    lines.append(f"type={kind};size={st.st_size};modify={modify}; {entry.name}\r\n")
+                self.transfer(lambda conn: conn.sendall("".join(lines).encode()))
+            elif cmd == 'RETR':
+                path = self.local_path(arg)
+                rest, self.rest = self.rest, 0
+                if not path or not os.path.isfile(path):
+                    self.reply(f"550 {arg}: Not a regular file")
+                    continue
+                def send(conn):
+                    with open(path, 'rb') as f:
+                        conn.sendfile(f, rest)
+                self.transfer(send)
+            else:
+                self.reply(f"502 {cmd} not implemented")
+
+
+class FtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        super().__init__(("127.0.0.1", 0), FtpHandler)
+
+
+@contextlib.contextmanager
+def serve(root):
+    "Serve root over FTP and HTTP on localhost, yields (ftp host:port, http host:port)"
+    ftp = FtpServer(root)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHttpHandler, directory=root))
+    httpd.daemon_threads = True
+    threads = [threading.Thread(target=s.serve_forever, daemon=True) for s in (ftp, httpd)]
+    for t in threads:
+        t.start()
+    try:
+        yield f"127.0.0.1:{ftp.server_address[1]}", f"127.0.0.1:{httpd.server_address[1]}"
+    finally:
+        for s in (ftp, httpd):
+            s.shutdown()
+            s.server_close()
+
+
+def use_server(protocol, server):
+    "Point the runner at benchmark server"
+    egapx.FTP_EGAP_PROTOCOL = protocol
+    egapx.FTP_EGAP_SERVER = server
+    egapx.FTP_EGAP_ROOT = f"{protocol}://{server}/{egapx.FTP_EGAP_ROOT_PATH}"
+
+
+def reset_runner(cache_dir):
+    "Forget everything the runner keeps in memory between calls, as at the start of a new run"
+    egapx.user_cache_dir = cache_dir
+    egapx.metadata_ttl = 3600
+    egapx.offline_mode = False
+    egapx.lineage_table = None
+    egapx.data_version_cache.clear()
+    egapx.lineage_cache.clear()
+    egapx.reference_indexes.clear()
+
+
+## Benchmarks
+
+class Benchmark:
+    """ Synthetic data and servers shared by benchmarks, every benchmark method takes the run number
+    and returns dict of extra metrics, its wall time is measured around it """
+    def __init__(self, args, workdir, servers):
+        self.args = args
+        self.workdir = workdir
+        self.rng = random.Random(args.seed)
+        self.ftp_server, self.http_server = servers
+        self.support, nodes = make_support_data(os.path.join(workdir, "ftp"), args, self.rng)
+        self.queries = [t for t, _ in self.rng.sample(nodes, min(args.queries, len(nodes)))]
+        self.cache = ""
+
+    @classmethod
+    def names(cls):
+        return [name[len("bench_"):] for name in dir(cls) if name.startswith("bench_")]
+
+    def local_cache(self):
+        "Local support data cache for lookup benchmarks, a copy of the served tree unless a download already made one"
+        if not self.cache:
+            self.cache = os.path.join(self.workdir, "cache")
+            shutil.copytree(self.support, self.cache)
+        return self.cache
+
+    def clean_cache(self):
+        "Remove lineage table and reference indexes built by previous runs"
+        cache = self.local_cache()
+        shutil.rmtree(os.path.join(cache, egapx.REFERENCE_INDEX_DIR), ignore_errors=True)
+        parents = os.path.join(cache, "taxonomy", DATA_SUBSYSTEM_VERSION, "taxonomy4blast.sqlite3" + egapx.TAXONOMY_PARENTS_SUFFIX)
+        if os.path.exists(parents):
+            os.remove(parents)
+        reset_runner(cache)
+
+    def download(self, protocol, run, sync):
+        local_cache = os.path.join(self.workdir, f"download_{protocol}_{run}")
+        if protocol == 'ftp':
+            use_server('ftp', self.ftp_server)
+        else:
+            # HttpDownloader talks plain HTTP to the local server when the runner protocol is http
+            use_server('http', self.http_server)
+        reset_runner(local_cache)
+        os.makedirs(local_cache, exist_ok=True)
+        if sync:
+            egapx.download_egapx_ftp_data(local_cache, self.args.download_workers, 'https' if protocol == 'https' else 'ftp')
+            reset_runner(local_cache)
+        egapx.runner_profile = egapx.RunnerProfile()
+        try:
+            start = time.monotonic()
+            if egapx.download_egapx_ftp_data(local_cache, self.args.download_workers, 'https' if protocol == 'https' else 'ftp') != 0:
+                raise RuntimeError(f"download over {protocol} failed")
+            self.timed = time.monotonic() - start
+            counters = egapx.runner_profile.counters
+        finally:
+            egapx.runner_profile = None
+        if not self.cache:
+            self.cache = local_cache
+        else:
+            shutil.rmtree(local_cache)
+        return { 'network_requests': counters['network_requests'], 'mb': round(counters['network_bytes'] / 1e6, 2) }
+
+    def bench_download_ftp(self, run):
+        "Mirror support data over FTP into empty cache"
+        return self.download('ftp', run, False)
+
+    def bench_download_https(self, run):
+        "Mirror support data over HTTP into empty cache"
+        return self.download('https', run, False)
+
+    def bench_download_sync(self, run):
+        "Re-sync up to date cache, only the manifest is revalidated"
+        return self.download('https', run, True)
+
+    def bench_lineage_table(self, run):
+        "Build taxid -> parent table from taxonomy database"
+        self.clean_cache()
+        start = time.monotonic()
+        egapx.get_lineage_table()
+        self.timed = time.monotonic() - start
+        return { 'taxa': self.args.taxa }
+
+    def bench_lineage(self, run):
+        "get_lineage for every query taxid from the lineage table"
+        self.local_cache()
+        reset_runner(self.cache)
+        egapx.get_lineage_table()
+        start = time.monotonic()
+        depth = sum(len(egapx.get_lineage(t)) for t in self.queries)
+        self.timed = time.monotonic() - start
+        return { 'queries': len(self.queries), 'mean_depth': round(depth / len(self.queries), 1) }
+
+    def bench_lineage_db(self, run):
+        "Lineages of query taxids by recursive queries to taxonomy database, used when the table can't be built"
+        self.local_cache()
+        reset_runner(self.cache)
+        start = time.monotonic()
+        egapx.get_db_lineages(egapx.get_taxonomy_db_name(), self.queries)
+        self.timed = time.monotonic() - start
+        return { 'queries': len(self.queries) }
+
+    def closest(self, func, cold):
+        if cold:
+            self.clean_cache()
+            queries = self.queries[:1]
+        else:
+            self.local_cache()
+            reset_runner(self.cache)
+            func(self.queries[0])
+            queries = self.queries
+        start = time.monotonic()
+        found = sum(1 for t in queries if func(t))
+        self.timed = time.monotonic() - start
+        return { 'queries': len(queries), 'found': found }
+
+    def bench_closest_hmm_cold(self, run):
+        "get_closest_hmm for one taxid with empty runner cache, builds lineage table and reference index"
+        return self.closest(lambda t: egapx.get_closest_hmm(t)[0], True)
+
+    def bench_closest_hmm(self, run):
+        "get_closest_hmm for every query taxid with warm runner cache"
+        return self.closest(lambda t: egapx.get_closest_hmm(t)[0], False)
+
+    def bench_closest_protein_bag_cold(self, run):
+        "get_closest_protein_bag for one taxid with empty runner cache"
+        return self.closest(egapx.get_closest_protein_bag, True)
+
+    def bench_closest_protein_bag(self, run):
+        "get_closest_protein_bag for every query taxid with warm runner cache"
+        return self.closest(egapx.get_closest_protein_bag, False)
+
+    def bench_prepare_reads(self, run):
+        "prepare_reads on read files of many SRA runs, including read profiling for metadata"
+        reads_dir = os.path.join(self.workdir, "reads")
+        if not os.path.isdir(reads_dir):
+            self.read_files = make_reads(reads_dir, self.args.read_files, self.args.reads_per_file, self.rng)
+        output = os.path.join(self.workdir, "prepare_reads")
+        shutil.rmtree(output, ignore_errors=True)
+        os.makedirs(output)
+        run_inputs = { 'input': { 'reads': list(self.read_files) }, 'output': output }
+        start = time.monotonic()
+        egapx.prepare_reads(run_inputs)
+        self.timed = time.monotonic() - start
+        return { 'files': len(self.read_files), 'libraries': len(run_inputs['input']['reads']) }
+
+    def bench_merge_params(self, run):
+        "merge_params of default task parameters with run inputs overriding every task option, 100 times"
+        task_params = egapx.read_default_task_params(SCRIPT_DIR)
+        overrides = { task: { section: "-benchmark-flag -benchmark-option 1" for section, value in sections.items() if isinstance(value, str) }
+                      for task, sections in task_params['tasks'].items() if isinstance(sections, dict) }
+        run_inputs = { 'input': { 'genome': "/data/genome.fa", 'taxid': 9606 }, 'tasks': overrides }
+        copies = [ (copy.deepcopy(task_params), copy.deepcopy(run_inputs)) for _ in range(100) ]
+        start = time.monotonic()
+        for params, inputs in copies:
+            egapx.merge_params(params, inputs)
+        self.timed = time.monotonic() - start
+        return { 'options': sum(len(s) for s in overrides.values()) }
+
+    def bench_print_statistics(self, run):
+        "print_statistics on synthetic accept.gff of --gff-mb, without statistics from a previous call"
+        output = os.path.join(self.workdir, "statistics")
+        accept_gff = os.path.join(output, "accept.gff")
+        if not os.path.exists(accept_gff):
+            os.makedirs(output, exist_ok=True)
+            make_gff(accept_gff, self.args.gff_mb, self.rng)
+        for suffix in (".json", ".tsv"):
+            stats_file = os.path.join(output, egapx.GFF_STATS_NAME + suffix)
+            if os.path.exists(stats_file):
+                os.remove(stats_file)
+        start = time.monotonic()
+        egapx.print_statistics(output)
+        self.timed = time.monotonic() - start
+        return { 'gff_mb': round(os.path.getsize(accept_gff) / (1 << 20)) }
+
+    def stub_run_setup(self):
+        "Input YAML, config directory and nextflow stand-in for end-to-end runs"
+        stub = os.path.join(self.workdir, "stub_run")
+        if os.path.isdir(stub):
+            return stub
+        os.makedirs(os.path.join(stub, "bin"))
+        shutil.copytree(os.path.join(SCRIPT_DIR, "assets", "config", "executor"), os.path.join(stub, "egapx_config"))
+        with open(os.path.join(stub, "genome.fa"), 'wt') as f:
+            for i in range(10):
+                f.write(f">chr{i}\n{''.join(self.rng.choices(NUCLEOTIDES, k=100000))}\n")
+        reads = make_reads(os.path.join(stub, "reads"), 4, 1000, self.rng)
+        # Taxid with a protein bag, otherwise the run fails validation
+        self.local_cache()
+        reset_runner(self.cache)
+        taxid = next((t for t in self.queries if egapx.get_closest_protein_bag(t)), self.queries[0])
+        with open(os.path.join(stub, "input.yaml"), 'wt') as f:
+            json.dump({ 'genome': os.path.join(stub, "genome.fa"), 'taxid': taxid, 'reads': reads }, f)
+        nextflow = os.path.join(stub, "bin", "nextflow")
+        with open(nextflow, 'wt') as f:
+            f.write("#!/bin/sh\n# Stand-in for nextflow, writes empty trace\n"
+                    "while [ $# -gt 0 ]; do [ \"$1\" = \"-with-trace\" ] && echo 'task_id\tprocess\tstatus\tworkdir' > \"$2\"; shift; done\n")
+        os.chmod(nextflow, 0o755)
+        return stub
+
+    def bench_stub_run(self, run):
+        "egapx.py --stub-run end to end, wall time of the runner process and its profiled phases"
+        stub = self.stub_run_setup()
+        output = os.path.join(stub, f"output_{run}")
+        shutil.rmtree(output, ignore_errors=True)
+        env = dict(os.environ)
+        env.pop("EGAPX_CACHE_ROOT", None)
+        env["EGAPX_STATE_DIR"] = os.path.join(stub, "state")
+        if self.args.nextflow:
+            env["PATH"] = os.path.dirname(os.path.abspath(shutil.which(self.args.nextflow) or self.args.nextflow)) + os.pathsep + env["PATH"]
+        else:
+            env["PATH"] = os.path.join(stub, "bin") + os.pathsep + env["PATH"]
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, "egapx.py"), os.path.join(stub, "input.yaml"), "-o", output, "-e", "local",
+               "-c", os.path.join(stub, "egapx_config"), "-lc", self.cache, "--stub-run", "--profile"]
+        start = time.monotonic()
+        result = subprocess.run(cmd, cwd=stub, env=env, stdout=None if self.args.verbose else subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.timed = time.monotonic() - start
+        if result.returncode != 0:
+            raise RuntimeError(f"stub run failed:\n{result.stdout or ''}")
+        with open(os.path.join(output, egapx.RUN_PROFILE_NAME), 'rt') as f:
+            phases = json.load(f)['phases']
+        return { 'phases': { p['phase']: p['elapsed_s'] for p in phases if '/' not in p['phase'] } }
+
+    def run(self, name, repeat):
+        "Run benchmark repeat times, returns median and min seconds and extra metrics of the last run"
+        method = getattr(self, f"bench_{name}")
+        times = []
+        extra = {}
+        for i in range(repeat):
+            self.timed = None
+            with contextlib.ExitStack() as stack:
+                if not self.args.verbose:
+                    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                start = time.monotonic()
+                extra = method(i) or {}
+                elapsed = time.monotonic() - start
+            # Benchmarks with setup time only their measured part
+            times.append(self.timed if self.timed is not None else elapsed)
+        return dict(seconds=round(statistics.median(times), 4), min=round(min(times), 4), runs=repeat, **extra)
+
+
+## Results
+
+def runner_version():
+    "Commit of the runner source, with + if the working tree has changes, empty if not in git"
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=SCRIPT_DIR, capture_output=True, text=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def load_results(path):
+    results = []
+    if os.path.exists(path):
+        with open(path, 'rt') as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+def previous_result(results, entry, name):
+    "Most recent earlier result of benchmark on the same host with the same data sizes"
+    for prev in reversed(results):
+        if prev['host'] == entry['host'] and prev['sizes'] == entry['sizes'] and name in prev['results']:
+            return prev
+    return None
+
+
+def compare(results, entry, threshold, min_delta):
+    "Print results next to previous ones, returns names of regressed benchmarks"
+    regressions = []
+    print(f"{'benchmark':28s} {'seconds':>10s} {'previous':>10s} {'change':>8s}  version")
+    for name, result in entry['results'].items():
+        prev = previous_result(results, entry, name)
+        if not prev:
+            print(f"{name:28s} {result['seconds']:10.4f} {'':>10s} {'':>8s}")
+            continue
+        before = prev['results'][name]['seconds']
+        change = (result['seconds'] - before) / before if before else 0
+        regressed = change > threshold and result['seconds'] - before > min_delta
+        if regressed:
+            regressions.append(name)
+        print(f"{name:28s} {result['seconds']:10.4f} {before:10.4f} {change:+8.1%}  {prev['version']}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.list:
+        for name in Benchmark.names():
+            print(f"{name:28s} {getattr(Benchmark, f'bench_{name}').__doc__}")
+        return 0
+    workdir = args.workdir or tempfile.mkdtemp(prefix="egapx_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    # Runner state outside of any local cache goes into the benchmark directory, not into ~/.cache/egapx
+    os.environ["EGAPX_STATE_DIR"] = os.path.join(workdir, "state")
+    try:
+        with serve(os.path.join(workdir, "ftp")) as servers:
+            print(f"Generating synthetic data in {workdir}")
+            bench = Benchmark(args, workdir, servers)
+            names = bench.names()
+            # Downloads first, so that lookups use the downloaded cache
+            names.sort(key=lambda n: (not n.startswith("download"), n))
+            if args.only:
+                names = [n for n in names if any(n == o or n.startswith(o) for o in args.only)]
+            entry = { 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'version': runner_version(),
+                      'host': platform.node(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                      'sizes': { k: getattr(args, k) for k in ('taxa', 'references', 'reference_kb', 'queries', 'read_files',
+                                                                'reads_per_file', 'gff_mb', 'download_workers', 'nextflow') },
+                      'results': {} }
+            for name in names:
+                print(f"Running {name}", flush=True)
+                entry['results'][name] = bench.run(name, args.repeat)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results = load_results(args.results)
+    regressions = compare(results, entry, args.threshold, args.min_delta)
+    if not args.no_save:
+        with open(args.results, 'at') as f:
+            f.write(json.dumps(entry) + "\n")
+        print(f"Results appended to {args.results}")
+    if regressions:
+        print(f"Regressions: {' '.join(regressions)}")
+        return 1 if args.check else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
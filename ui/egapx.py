@@ -3,6 +3,8 @@
 #
 import shlex
 import shutil
+import copy
+import itertools
 import sys
 import os
 import argparse
@@ -11,16 +13,40 @@ import tempfile
 import re
 import time
 import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 from ftplib import FTP
 from ftplib import FTP_TLS
 import ftplib
 from pathlib import Path
 from typing import List
-from urllib.request import urlopen
+from urllib.request import urlopen, Request
+import urllib.error
+import hashlib
+import urllib.parse
 import json
 import sqlite3
 import stat
+import fcntl
+import socket
+import functools
+import contextlib
+import cProfile
+import pstats
+import gzip
+import zlib
+import struct
+import bisect
+import heapq
+import math
+import mmap
+from array import array
+import threading
+import queue
+import errno
+import ssl
+import http.client
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 
 import yaml
 
@@ -28,88 +54,348 @@ VERBOSITY_DEFAULT=0
 VERBOSITY_QUIET=-1
 VERBOSITY_VERBOSE=1
 
-FTP_EGAP_PROTOCOL = "https"
-FTP_EGAP_SERVER = "ftp.ncbi.nlm.nih.gov"
+# Protocol and server can be overridden to point at a local FTP/HTTP stand-in, server may be given as host:port
+FTP_EGAP_PROTOCOL = os.environ.get("EGAPX_FTP_PROTOCOL", "https")
+FTP_EGAP_SERVER = os.environ.get("EGAPX_FTP_SERVER", "ftp.ncbi.nlm.nih.gov")
 FTP_EGAP_ROOT_PATH = "genomes/TOOLS/EGAP/support_data"
 FTP_EGAP_ROOT = f"{FTP_EGAP_PROTOCOL}://{FTP_EGAP_SERVER}/{FTP_EGAP_ROOT_PATH}"
 DATA_VERSION = "current"
-dataset_taxonomy_url = "https://api.ncbi.nlm.nih.gov/datasets/v2alpha/taxonomy/taxon/"
+dataset_taxonomy_url = os.environ.get("EGAPX_TAXONOMY_URL", "https://api.ncbi.nlm.nih.gov/datasets/v2alpha/taxonomy/taxon/")
 
 user_cache_dir = ''
+# Remote metadata (manifest, taxid lists, taxonomy API) is reused from disk for metadata_ttl seconds,
+# in offline mode it is never fetched once cached
+metadata_ttl = 3600
+offline_mode = False
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description="Main script for EGAPx")
     group = parser.add_argument_group('run')
     group.add_argument("filename", nargs='?', help="YAML file with input: section with at least genome: and reads: parameters")
     group.add_argument("-o", "--output", help="Output path", default="")
+    group = parser.add_argument_group('batch')
+    group.add_argument("-b", "--batch", nargs='+', help="Annotate many genomes - YAML files or directories with YAML files, each genome goes into its own subdirectory of output path", default=[])
+    group.add_argument("-j", "--max-parallel", help="Maximum number of Nextflow runs at once in batch and sweep mode, default 2", type=int, default=2)
+    group.add_argument("-sw", "--sweep", help="YAML grid of Gnomon stage task options, run alignments once and Gnomon for every combination, each variant goes into its own subdirectory of output path", default="")
     parser.add_argument("-e", "--executor", help="Nextflow executor, one of docker, singularity, aws, or local (for NCBI internal use only). Uses corresponding Nextflow config file", default="local")
     parser.add_argument("-c", "--config-dir", help="Directory for executor config files, default is ./egapx_config. Can be also set as env EGAPX_CONFIG_DIR", default="")
     parser.add_argument("-w", "--workdir", help="Working directory for cloud executor", default="")
+    group = parser.add_argument_group('hybrid executor')
+    group.add_argument("-hy", "--hybrid", help="Run big_job, huge_job and long_job processes, and processes heavy in earlier runs, with the executor of --executor config "
+                       "and the rest with local executor on this host", action="store_true", default=False)
+    group.add_argument("-hc", "--hybrid-cpus", help="CPUs of this host for local executor in hybrid mode, default all", type=int, default=0)
+    group.add_argument("-hm", "--hybrid-memory", help="Memory in GB of this host for local executor in hybrid mode, default all", type=int, default=0)
+    group.add_argument("-qs", "--queue-size", nargs='+', help="Maximum tasks queued per executor like slurm=200 local=8, without executor name for the executor of --executor config", default=[])
+    group.add_argument("-srl", "--submit-rate-limit", nargs='+', help="Maximum task submit rate per executor like slurm=6/1min, without executor name for the executor of --executor config", default=[])
+    group = parser.add_argument_group('work directory')
+    group.add_argument("-wu", "--work-usage", nargs='+', help="Report disk usage of work directories per process for runs with these trace files", default=[])
+    group.add_argument("-wc", "--work-clean", nargs='*', help="Remove task work directories after the run succeeded, except alignments and trained HMM reused by later runs, and tasks the run took from cache of earlier runs. "
+                       "With trace files, clean work directories of these finished runs instead, give it after the input file", default=None)
+    group.add_argument("-wq", "--work-quota", help="Do not launch if work directory with space the run is expected to need, "
+                       "estimated from earlier runs by genome size, would exceed this size like 500G", type=parse_disk_size, default=0)
+    parser.add_argument("-pm", "--publish-mode", help="How final outputs get into output directory: copy, link (hardlink), reflink or move, "
+                        "each falls back to copy across filesystems, default EGAPX_PUBLISH_MODE environment variable or copy",
+                        choices=PUBLISH_MODES, default=os.environ.get("EGAPX_PUBLISH_MODE", "copy"))
+    parser.add_argument("-cr", "--cache-root", help="Persistent directory for work directories shared by runs of the same inputs, which resume each other, default EGAPX_CACHE_ROOT environment variable", default="")
     parser.add_argument("-r", "--report", help="Report file prefix for report (.report.html) and timeline (.timeline.html) files, default is in output directory", default="")
     parser.add_argument("-n", "--dry-run", action="store_true", default=False)
     parser.add_argument("-st", "--stub-run", action="store_true", default=False)
+    parser.add_argument("-rr", "--resource-report", nargs='+', help="Report requested vs peak resources from run.trace.txt file(s) of past runs and generate right-sized process config in config directory", default=[])
+    parser.add_argument("-bd", "--bundle", help=f"Also write coordinate-sorted, bgzip-compressed GFF/GTF and FASTA outputs with tabix (CSI for sequences over 512 Mb), fai and gzi indexes into {BUNDLE_DIR} "
+                        "subdirectory of output directory, query them with 'egapx.py query'", action="store_true", default=False)
+    parser.add_argument("-pg", "--progress", nargs='?', help=f"Print per-process completion, throughput and estimated remaining time every this many seconds, default {PROGRESS_INTERVAL}. "
+                        f"Also writes status to {RUN_STATUS_NAME} in output directory", type=int, const=PROGRESS_INTERVAL, default=0)
+    parser.add_argument("-ss", "--status", help=f"Follow the run and keep its status in {RUN_STATUS_NAME} in output directory without printing progress", action="store_true", default=False)
     parser.add_argument("-so", "--summary-only", help="Print result statistics only if available, do not compute result", action="store_true", default=False)
     group = parser.add_argument_group('download')
     group.add_argument("-dl", "--download-only", help="Download external files to local storage, so that future runs can be isolated", action="store_true", default=False)
+    group.add_argument("-dw", "--download-workers", help="Number of parallel download workers and pooled connections, default 4", type=int, default=4)
+    group.add_argument("-dv", "--download-verify", help="Ignore the local cache index and list every subsystem on the server again", action="store_true", default=False)
+    group.add_argument("-dx", "--download-prune", help="Delete cached files of superseded support data versions", action="store_true", default=False)
+    group.add_argument("-dp", "--download-protocol", help="Protocol for mirroring support data, ftp or https, default ftp", choices=['ftp', 'https'], default="ftp")
     parser.add_argument("-lc", "--local-cache", help="Where to store the downloaded files", default="")
+    parser.add_argument("-mt", "--metadata-ttl", help="Seconds to reuse cached manifest, taxid lists and taxonomy lookups before revalidating with the server, default 3600", type=int, default=3600)
+    parser.add_argument("-off", "--offline", help="Never access the network for cached metadata", action="store_true", default=False)
     parser.add_argument("-q", "--quiet", dest='verbosity', action='store_const', const=VERBOSITY_QUIET, default=VERBOSITY_DEFAULT)
     parser.add_argument("-v", "--verbose", dest='verbosity', action='store_const', const=VERBOSITY_VERBOSE, default=VERBOSITY_DEFAULT)
+    parser.add_argument("-npf", "--no-preflight", help="Do not check that input files and URLs are reachable before launch", action="store_true", default=False)
+    parser.add_argument("-sg", "--stage", help="Download remote genome and reads into local content-addressed store and run on local copies", action="store_true", default=False)
+    parser.add_argument("-sd", "--stage-dir", help="Directory of the store for --stage, default is 'staging' in the local cache or runner cache directory", default="")
+    parser.add_argument("-nm", "--no-memo", help="Run even if a completed run with the same inputs and parameters is recorded", action="store_true", default=False)
+    parser.add_argument("-sr", "--shard-reads", help="Split large local read libraries into shards of this many reads, or of this size with K, M or G suffix, so that STAR jobs scale with cluster size", type=parse_shard_size, default=None)
+    parser.add_argument("-np", "--no-plan", help="Do not adjust thread counts and job tiers to genome size and available resources", action="store_true", default=False)
+    parser.add_argument("-fr", "--full-run", help="Run all stages even if only Gnomon parameters changed since the previous run in the output directory", action="store_true", default=False)
+    parser.add_argument("-pf", "--profile", help=f"Time runner phases, count network requests, bytes and sqlite statements, and write {RUN_PROFILE_NAME} into output directory", action="store_true", default=False)
+    parser.add_argument("-pfc", "--cprofile", help=f"Also capture cProfile statistics of the runner into {CPROFILE_NAME} in output directory", action="store_true", default=False)
     parser.add_argument("-fn", "--func_name", help="func_name", default="")
     return parser.parse_args(argv[1:])
 
 
-class FtpDownloader:
+RUN_PROFILE_NAME = "run_profile.json"
+CPROFILE_NAME = "run_profile.prof"
+
+class RunnerProfile:
+    "Wall time of runner phases with network requests, bytes and sqlite statements counted in each"
+    COUNTERS = ('network_requests', 'network_bytes', 'sqlite_queries')
+
     def __init__(self):
+        self.started = time.monotonic()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.phases = []
+        # Phases nest per thread, batch runs time their phases on worker threads
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    @contextmanager
+    def phase(self, name):
+        "Time nested phase, its name is prefixed with names of enclosing phases of the same thread"
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        full_name = "/".join(stack)
+        with self.lock:
+            before = dict(self.counters)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            stack.pop()
+            entry = { 'phase': full_name, 'start_s': round(start - self.started, 4), 'elapsed_s': round(elapsed, 4) }
+            with self.lock:
+                entry.update({ k: self.counters[k] - before[k] for k in self.COUNTERS })
+                self.phases.append(entry)
+
+    def report(self):
+        return { 'total_s': round(time.monotonic() - self.started, 4), 'totals': dict(self.counters),
+                 'phases': sorted(self.phases, key=lambda p: p['start_s']) }
+
+    def write(self, path):
+        with open(path, 'wt') as f:
+            json.dump(self.report(), f, indent=1)
+        print(f"Runner profile written to {path}")
+
+
+# Set by --profile
+runner_profile = None
+
+def profile_phase(name):
+    "Context manager timing runner phase when profiling is on"
+    return runner_profile.phase(name) if runner_profile else contextlib.nullcontext()
+
+
+def count_network(nbytes=0, requests=1):
+    if runner_profile:
+        runner_profile.count('network_requests', requests)
+        runner_profile.count('network_bytes', nbytes)
+
+
+def connect_db(path):
+    "sqlite3 connection, statements are counted when profiling is on"
+    conn = sqlite3.connect(path)
+    if runner_profile:
+        conn.set_trace_callback(lambda statement: runner_profile.count('sqlite_queries'))
+    return conn
+
+
+def profiled(name):
+    "Decorator timing every call of function as runner phase when profiling is on"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+PARTIAL_SUFFIX = ".partial"
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 1
+DOWNLOAD_BACKOFF_MAX = 60
+
+def backoff_delay(attempt):
+    return min(DOWNLOAD_BACKOFF * 2 ** attempt, DOWNLOAD_BACKOFF_MAX)
+
+
+# Remote version of the file a partial download belongs to, resuming from another version would corrupt it
+PARTIAL_VERSION_SUFFIX = ".version"
+# Errors of the local side, like a full disk or no permissions, that retrying does not fix
+NETWORK_ERRNOS = { errno.ENETUNREACH, errno.ENETDOWN, errno.EHOSTUNREACH, errno.EHOSTDOWN, errno.ETIMEDOUT, errno.ECONNREFUSED,
+                   errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE }
+
+class IncompleteTransfer(Exception):
+    "Downloaded size differs from the size of the remote file"
+
+
+def is_network_error(e):
+    "Whether download error is worth retrying - network failure or incomplete transfer, not a local error"
+    if isinstance(e, (IncompleteTransfer, EOFError, socket.timeout, socket.gaierror, ConnectionError, TimeoutError,
+                      http.client.HTTPException, ftplib.error_temp, ftplib.error_reply, ssl.SSLError)):
+        return True
+    return isinstance(e, OSError) and e.errno in NETWORK_ERRNOS
+
+
+def get_partial_size(partial_path):
+    try:
+        return os.path.getsize(partial_path)
+    except OSError:
+        return 0
+
+
+def get_partial_version(partial_path):
+    try:
+        with open(partial_path + PARTIAL_VERSION_SUFFIX, 'rt') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def set_partial_version(partial_path, version):
+    with open(partial_path + PARTIAL_VERSION_SUFFIX, 'wt') as f:
+        f.write(version or '')
+
+
+def discard_partial(partial_path):
+    for path in (partial_path, partial_path + PARTIAL_VERSION_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def finish_partial(partial_path, local_path):
+    os.replace(partial_path, local_path)
+    if os.path.exists(partial_path + PARTIAL_VERSION_SUFFIX):
+        os.remove(partial_path + PARTIAL_VERSION_SUFFIX)
+
+
+class FtpDownloader:
+    def __init__(self, timeout=None):
         self.ftp = None
+        self.timeout = timeout
 
     def connect(self, host):
         self.host = host
         self.reconnect() 
 
     def reconnect(self):
-        self.ftp = FTP(self.host)
+        host, _, port = self.host.partition(':')
+        self.ftp = FTP(timeout=self.timeout)
+        self.ftp.connect(host, int(port) if port else 21)
         self.ftp.login()
         self.ftp.set_debuglevel(0)
+
+    def close(self):
+        if self.ftp:
+            try:
+                self.ftp.quit()
+            except (OSError, EOFError, ftplib.Error):
+                self.ftp.close()
+            self.ftp = None
+
+    def list_dir(self, ftp_path):
+        count_network()
+        return list(self.ftp.mlsd(ftp_path))
+
+    def size(self, ftp_path):
+        "Size of remote file, raises FileNotFoundError if missing"
+        try:
+            self.ftp.voidcmd("TYPE I")
+            count_network()
+            return self.ftp.size(ftp_path)
+        except ftplib.error_perm as e:
+            raise FileNotFoundError(str(e))
+
+    def version(self, ftp_path):
+        "Size and modification time of remote file, None if the server does not tell them, e.g. for a directory"
+        try:
+            self.ftp.voidcmd("TYPE I")
+            count_network()
+            size = self.ftp.size(ftp_path)
+        except ftplib.error_perm:
+            return None
+        try:
+            count_network()
+            modify = self.ftp.voidcmd(f"MDTM {ftp_path}")[4:].strip()
+        except ftplib.error_perm:
+            # Size alone still tells a shrunk or grown file
+            modify = ''
+        return size, modify
+
+    def download_file(self, ftp_name, local_path, size=None):
+        return self.download_ftp_file(ftp_name, local_path, size)
        
     ##ftp_types = set()
-    def download_ftp_file(self, ftp_name, local_path):
+    def download_ftp_file(self, ftp_name, local_path, size=None):
+        """ Download into local_path.partial resuming from its current size if the remote file did not change since,
+        retry network errors with bounded exponential backoff, and rename to local_path only when the size
+        matches the remote file
+        Args:
+            size: size of the file in the directory listing, if the server does not tell it
+        """
         # print(f"file: {ftp_name}")
         # print(f"f: { os.path.dirname(local_path)}")
 
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        try:
-            with open(local_path, 'wb') as f:
-                self.ftp.retrbinary("RETR {0}".format(ftp_name), f.write)
-            # print("downloaded: {0}".format(local_path))
-            return True
-        except FileNotFoundError:
-            print("FAILED FNF: {0}".format(local_path))
-        except EOFError:
-            print("FAILED EOF: {0}".format(local_path))
-            time.sleep(1)
-            self.reconnect()
-            print("retrying...")
-            r = self.download_ftp_file(ftp_name, local_path)
-            print("downloaded on retry: {0}".format(local_path))
-            return r
-        except BrokenPipeError:
-            print("FAILED BP: {0}".format(local_path))
-        except IsADirectoryError:
+        if os.path.isdir(local_path):
             ## same as 550 but pre-exists
-            ## os.remove(local_path)
-            return 550
-        except ftplib.error_perm:
-            ## ftplib.error_perm: 550 genomes/TOOLS/EGAP/ortholog_references/9606/current: Not a regular file
-            ## its a symlink to a dir.
-            os.remove(local_path)
             return 550
+        partial_path = local_path + PARTIAL_SUFFIX
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                remote = self.version(ftp_name)
+                version = ":".join(map(str, remote)) if remote else None
+                expected = remote[0] if remote else size
+                if os.path.exists(partial_path) and (version is None or get_partial_version(partial_path) != version
+                                                     or (expected is not None and get_partial_size(partial_path) > expected)):
+                    discard_partial(partial_path)
+                if not os.path.exists(partial_path):
+                    set_partial_version(partial_path, version)
+                offset = get_partial_size(partial_path)
+                if expected is None or offset < expected:
+                    with open(partial_path, 'ab') as f:
+                        self.ftp.retrbinary("RETR {0}".format(ftp_name), f.write, rest=offset or None)
+                    count_network(get_partial_size(partial_path) - offset)
+                if expected is not None and get_partial_size(partial_path) != expected:
+                    discard_partial(partial_path)
+                    raise IncompleteTransfer(f"expected {expected} bytes")
+                finish_partial(partial_path, local_path)
+                # print("downloaded: {0}".format(local_path))
+                return True
+            except FileNotFoundError:
+                print("FAILED FNF: {0}".format(local_path))
+                return False
+            except ftplib.error_perm:
+                ## ftplib.error_perm: 550 genomes/TOOLS/EGAP/ortholog_references/9606/current: Not a regular file
+                ## its a symlink to a dir.
+                discard_partial(partial_path)
+                return 550
+            except (EOFError, OSError, ftplib.error_temp, ftplib.error_reply, IncompleteTransfer) as e:
+                if not is_network_error(e):
+                    print("FAILED {0}: {1}: {2}".format(type(e).__name__, local_path, e))
+                    return False
+                if attempt == DOWNLOAD_RETRIES:
+                    print("FAILED {0}: {1}".format(type(e).__name__, local_path))
+                    break
+                delay = backoff_delay(attempt)
+                print("FAILED {0}: {1}, retrying from byte {2} in {3}s...".format(type(e).__name__, local_path, get_partial_size(partial_path), delay))
+                time.sleep(delay)
+                try:
+                    self.reconnect()
+                except (EOFError, OSError, ftplib.Error):
+                    # Will fail again on the next attempt and be retried
+                    pass
         return False
 
     # item: ('Eublepharis_macularius', {'modify': '20240125225739', 'perm': 'fle', 'size': '4096', 'type': 'dir', 'unique': '6CU599079F', 'unix.group': '562', 'unix.mode': '0444', 'unix.owner': '14'}
-    def should_download_file(self, ftp_item, local_name):
+    # HTTP index pages may leave out size or modify, then only what is known is compared
+    @staticmethod
+    def should_download_file(ftp_item, local_name):
         metadata = ftp_item[1]
-        ftp_modify = datetime.datetime.strptime(metadata['modify'], '%Y%m%d%H%M%S')
-        ftp_size = int(metadata['size'])
+        ftp_modify = datetime.datetime.strptime(metadata['modify'], '%Y%m%d%H%M%S') if metadata.get('modify') else None
+        ftp_size = int(metadata['size']) if metadata.get('size') else None
         ftp_type = metadata['type']
 
         local_stat = []
@@ -127,61 +413,418 @@ class FtpDownloader:
 
         #print(f"should_dl: {ftp_size != local_stat.st_size}  {ftp_modify > local_stat_dt}  ")
 
-        if (ftp_type == 'file' and ftp_size != local_stat.st_size) or (ftp_type=='OS.unix=symlink' and ftp_size >= local_stat.st_size):
+        if ftp_size is not None and ((ftp_type == 'file' and ftp_size != local_stat.st_size) or (ftp_type=='OS.unix=symlink' and ftp_size >= local_stat.st_size)):
             return True
 
-        if ftp_modify > local_stat_dt:
+        if ftp_modify and ftp_modify > local_stat_dt:
             return True
 
         return False
 
-    ## types
-    ## cdir and pdir: . and ..: do nothing
-    ## file: a file
-    ## dir: a dir
-    ## OS.unix=symlink: symlink to a file, treat like a file
-    def download_ftp_dir(self, ftp_path, local_path):
-        """ replicates a directory on an ftp server recursively """
-        for ftp_item in self.ftp.mlsd(ftp_path):
-            # print(f"ftp_item: {ftp_item}")
-            ##print(f"  name: {ftp_item[0]}")
-            ##print(f"  type: {ftp_item[1]['type']}")
-            name = ftp_item[0]
-            next_ftp_name="/".join([ftp_path,name])
-            next_local_name=os.sep.join([local_path,name])
-            ftp_type = ftp_item[1]['type']
-            ##ftp_types.add(ftp_type)
-            if ftp_type=='dir':
-                self.download_ftp_dir(next_ftp_name, next_local_name)
-            elif ftp_type=='file' or ftp_type=='OS.unix=symlink':
-                if self.should_download_file(ftp_item, next_local_name):
-                    r = self.download_ftp_file(next_ftp_name, next_local_name)
-                    if r == 550:
-                        self.download_ftp_dir(next_ftp_name, next_local_name)
-                    ##time.sleep(0.1)
-            ## else: . or .. do nothing
-
-
-def download_egapx_ftp_data(local_cache_dir):
+
+# Link in directory index page, followed by date and size columns in Apache style index
+HTTP_INDEX_ENTRY = re.compile(r'<a href="(?P<href>[^"?#]+)"[^>]*>[^<]*</a>'
+                              r'(?:\s+(?P<modify>\d{4}-\d\d-\d\d \d\d:\d\d(?::\d\d)?)\s+(?P<size>[\d.]+[KMGT]?|-))?')
+
+class HttpDownloader:
+    """ Same interface as FtpDownloader, but over a keep-alive HTTP(S) connection to the FTP site web frontend """
+    def __init__(self, protocol=None, timeout=120):
+        self.conn = None
+        self.protocol = protocol or FTP_EGAP_PROTOCOL
+        self.timeout = timeout
+
+    def connect(self, host):
+        self.host = host
+        self.reconnect()
+
+    def reconnect(self):
+        self.close()
+        if self.protocol == 'https':
+            self.conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            self.conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, path, headers=None):
+        "Send request reusing the connection, reconnect once if the server dropped it, query after '?' is sent as it is"
+        path, sep, query = path.partition('?')
+        for attempt in range(2):
+            try:
+                self.conn.request(method, urllib.parse.quote(path) + sep + query, headers=headers or {})
+                count_network()
+                return self.conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionError):
+                if attempt:
+                    raise
+                self.reconnect()
+
+    def size(self, http_path):
+        "Size of remote file from HEAD request, None if not known, raises FileNotFoundError if missing"
+        response = self.request("HEAD", http_path)
+        response.read()
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            count_network()
+            with urlopen(Request(urllib.parse.urljoin(f"{self.protocol}://{self.host}{http_path}", response.getheader('Location')), method="HEAD"),
+                         timeout=self.timeout) as redirected:
+                length = redirected.headers.get('Content-Length')
+                return int(length) if length else None
+        if response.status == 404 or response.status == 410:
+            raise FileNotFoundError(f"HTTP {response.status}")
+        if response.status >= 400:
+            raise OSError(f"HTTP {response.status}")
+        length = response.getheader('Content-Length')
+        return int(length) if length else None
+
+    def version(self, http_path):
+        "Size and ETag or Last-Modified of remote file from HEAD request, None if the server tells neither, e.g. on redirect"
+        response = self.request("HEAD", f"/{http_path}")
+        response.read()
+        if response.status == 404 or response.status == 410:
+            raise FileNotFoundError(f"HTTP {response.status}")
+        if response.status >= 400:
+            raise OSError(f"HTTP {response.status}")
+        validator = response.getheader('ETag') or response.getheader('Last-Modified')
+        length = response.getheader('Content-Length')
+        if response.status != 200 or (not validator and length is None):
+            return None
+        return (int(length) if length else None), validator or ''
+
+    def list_dir(self, http_path):
+        """ List directory index page, return items in the same form as FTP.mlsd, with modification time and size
+        from the index columns where the page has them. Sizes rounded like 1.2M are left out, download_file
+        takes the exact size from the GET response
+        """
+        response = self.request("GET", f"/{http_path}/")
+        page = response.read().decode("utf-8", errors="replace")
+        if response.status != 200:
+            return []
+        items = []
+        for mo in HTTP_INDEX_ENTRY.finditer(page):
+            href = urllib.parse.unquote(mo.group('href'))
+            if href.startswith(('/', '.', 'http:', 'https:', 'ftp:')):
+                continue
+            name = href.rstrip('/')
+            if not name or '/' in name:
+                continue
+            if href.endswith('/'):
+                items.append((name, {'type': 'dir'}))
+                continue
+            metadata = {'type': 'file'}
+            if mo.group('modify'):
+                # Index pages of the FTP site web frontend show UTC time to the minute
+                metadata['modify'] = re.sub(r'\D', '', mo.group('modify')).ljust(14, '0')
+            if mo.group('size') and mo.group('size').isdigit():
+                metadata['size'] = mo.group('size')
+            items.append((name, metadata))
+        return items
+
+    def download_file(self, http_path, local_path, size=None):
+        """ Download into local_path.partial resuming with a Range request that is honored only if the file
+        still has the ETag or Last-Modified it had when the partial was started, retry network errors with
+        bounded exponential backoff, and rename to local_path only when the size matches the remote file
+        Args:
+            size: size of the file in the directory listing, if the server does not tell it
+        """
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        partial_path = local_path + PARTIAL_SUFFIX
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                offset = get_partial_size(partial_path)
+                version = get_partial_version(partial_path)
+                if offset and not version:
+                    # Can't tell whether the partial is of the current file
+                    discard_partial(partial_path)
+                    offset = 0
+                headers = {'Range': f"bytes={offset}-", 'If-Range': version} if offset else {}
+                response = self.request("GET", f"/{http_path}", headers)
+                if response.status == 416:
+                    # Partial is longer than the remote file, which changed
+                    response.read()
+                    discard_partial(partial_path)
+                    raise IncompleteTransfer("range not satisfiable")
+                if response.status not in (200, 206):
+                    response.read()
+                    print(f"FAILED HTTP {response.status}: {local_path}")
+                    return False
+                expected = size
+                if response.status == 206:
+                    mo = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.getheader('Content-Range', ''))
+                    if not mo or int(mo.group(1)) != offset:
+                        response.read()
+                        discard_partial(partial_path)
+                        raise IncompleteTransfer("unexpected range")
+                    if mo.group(2) != '*':
+                        expected = int(mo.group(2))
+                else:
+                    # Whole file, the remote file changed since the partial was started or the server ignores Range
+                    offset = 0
+                    if response.getheader('Content-Length') is not None:
+                        expected = int(response.getheader('Content-Length'))
+                    set_partial_version(partial_path, response.getheader('ETag') or response.getheader('Last-Modified'))
+                with open(partial_path, 'ab' if response.status == 206 else 'wb') as f:
+                    shutil.copyfileobj(response, f, 1024*1024)
+                count_network(get_partial_size(partial_path) - offset, requests=0)
+                if expected is not None and get_partial_size(partial_path) != expected:
+                    if get_partial_size(partial_path) > expected:
+                        discard_partial(partial_path)
+                    raise IncompleteTransfer(f"expected {expected} bytes")
+                finish_partial(partial_path, local_path)
+                return True
+            except (OSError, http.client.HTTPException, IncompleteTransfer) as e:
+                if not is_network_error(e):
+                    print(f"FAILED {type(e).__name__}: {local_path}: {e}")
+                    return False
+                if attempt == DOWNLOAD_RETRIES:
+                    print(f"FAILED {type(e).__name__}: {local_path}")
+                    break
+                delay = backoff_delay(attempt)
+                print(f"FAILED {type(e).__name__}: {local_path}, retrying from byte {get_partial_size(partial_path)} in {delay}s...")
+                time.sleep(delay)
+                self.reconnect()
+        return False
+
+
+class ConnectionPool:
+    """ Bounded pool of reusable downloader connections, at most 'size' connections are open at any time """
+    def __init__(self, host, size, downloader_class=FtpDownloader):
+        self.host = host
+        self.downloader_class = downloader_class
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        downloader = None
+        try:
+            try:
+                downloader = self.idle.get_nowait()
+            except queue.Empty:
+                downloader = self.downloader_class()
+                downloader.connect(self.host)
+            yield downloader
+            self.idle.put(downloader)
+        except BaseException:
+            # Do not return possibly broken connection to the pool
+            if downloader:
+                downloader.close()
+            raise
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class MirrorStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.end = self.start
+        self.dirs = 0
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def report(self, subsystem):
+        elapsed = max(self.end - self.start, 1e-6)
+        return (f"{subsystem}: {self.files} files, {self.bytes/1e6:.1f} MB in {elapsed:.1f}s "
+                f"({self.bytes/1e6/elapsed:.2f} MB/s), {self.dirs} dirs, {self.skipped} up to date, {self.failed} failed")
+
+
+class FtpMirror:
+    """ Mirror remote directories in parallel - directory listings and file downloads are
+    scheduled as independent tasks on the same worker pool, each task borrows a pooled connection """
+    def __init__(self, pool, workers, verbosity=VERBOSITY_DEFAULT, root=""):
+        self.pool = pool
+        self.verbosity = verbosity
+        # Local root for index paths, previously indexed and freshly listed files per subsystem
+        self.root = root
+        self.known = defaultdict(dict)
+        self.listings = defaultdict(dict)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stats = defaultdict(MirrorStats)
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.pending = 0
+        self.errors = []
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.pending += 1
+        self.executor.submit(self.run_task, fn, *args)
+
+    def run_task(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f"{args[1]}: {e!r}")
+                self.stats[args[0]].failed += 1
+        finally:
+            with self.lock:
+                self.stats[args[0]].end = time.monotonic()
+                self.pending -= 1
+                if self.pending == 0:
+                    self.done.notify_all()
+
+    def mirror_dir(self, subsystem, remote_path, local_path):
+        with self.lock:
+            stats = self.stats[subsystem]
+            stats.dirs += 1
+        with self.pool.connection() as conn:
+            items = conn.list_dir(remote_path)
+        for name, metadata in items:
+            next_remote_name = "/".join([remote_path, name])
+            next_local_name = os.sep.join([local_path, name])
+            item_type = metadata['type']
+            if item_type == 'dir':
+                self.submit(self.mirror_dir, subsystem, next_remote_name, next_local_name)
+            elif item_type == 'file' or item_type == 'OS.unix=symlink':
+                rel_name = os.path.relpath(next_local_name, self.root)
+                entry = (int(metadata.get('size', 0)), metadata.get('modify', ''))
+                with self.lock:
+                    self.listings[subsystem][rel_name] = entry
+                if self.known[subsystem].get(rel_name) == entry and os.path.isfile(next_local_name):
+                    # Same as indexed on the previous sync, no need to compare timestamps
+                    with self.lock:
+                        stats.skipped += 1
+                elif FtpDownloader.should_download_file((name, metadata), next_local_name):
+                    self.submit(self.mirror_file, subsystem, next_remote_name, next_local_name,
+                                int(metadata['size']) if item_type == 'file' and metadata.get('size') else None)
+                else:
+                    with self.lock:
+                        stats.skipped += 1
+
+    def mirror_file(self, subsystem, remote_path, local_path, size=None):
+        with self.pool.connection() as conn:
+            r = conn.download_file(remote_path, local_path, size)
+        if r == 550:
+            # Symlink to a directory
+            self.mirror_dir(subsystem, remote_path, local_path)
+            return
+        with self.lock:
+            stats = self.stats[subsystem]
+            if r:
+                stats.files += 1
+                stats.bytes += os.path.getsize(local_path)
+            else:
+                stats.failed += 1
+        if self.verbosity >= VERBOSITY_VERBOSE:
+            print(f"  {'downloaded' if r else 'FAILED'} {local_path}")
+
+    def wait(self):
+        with self.lock:
+            while self.pending:
+                self.done.wait()
+        self.executor.shutdown()
+        self.pool.close()
+
+
+CACHE_INDEX_NAME = ".egapx_index.sqlite3"
+
+class CacheIndex:
+    """ Local index of remote listings for the support data cache, so that re-sync
+    only needs to list subsystems whose version changed in the manifest """
+    def __init__(self, path):
+        self.conn = connect_db(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS subsystems (name TEXT PRIMARY KEY, version TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (name TEXT, path TEXT, size INTEGER, modify TEXT, PRIMARY KEY (name, path))")
+
+    def version(self, name):
+        row = self.conn.execute("SELECT version FROM subsystems WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def files(self, name):
+        return { path: (size, modify) for path, size, modify in
+                 self.conn.execute("SELECT path, size, modify FROM files WHERE name = ?", (name,)) }
+
+    def update(self, name, version, files):
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            self.conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                  [ (name, path, size, modify) for path, (size, modify) in files.items() ])
+            self.conn.execute("INSERT OR REPLACE INTO subsystems VALUES (?, ?)", (name, version))
+
+    def close(self):
+        self.conn.close()
+
+
+def split_manifest_line(line):
+    "Return subsystem and version for 'subsystem/version' manifest line, unversioned lines are their own subsystem"
+    parts = line.split('/')
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return line, ''
+
+
+def download_egapx_ftp_data(local_cache_dir, workers=4, protocol='ftp', verbosity=VERBOSITY_DEFAULT, verify=False, prune=False):
     global user_cache_dir
     manifest_url = f"{FTP_EGAP_ROOT}/{DATA_VERSION}.mft"
-    manifest = urlopen(manifest_url)
+    # Always revalidate, conditional request is cheap when the manifest did not change
+    manifest = fetch_url(manifest_url, ttl=0).splitlines()
     manifest_path = f"{user_cache_dir}/{DATA_VERSION}.mft"
     manifest_list = []
+    downloader_class = HttpDownloader if protocol == 'https' else FtpDownloader
+    mirror = FtpMirror(ConnectionPool(FTP_EGAP_SERVER, max(workers, 1), downloader_class), max(workers, 1), verbosity, local_cache_dir)
+    index = CacheIndex(os.path.join(local_cache_dir, CACHE_INDEX_NAME))
+    changed = {}
     for line in manifest:
         line = line.decode("utf-8").strip()
         if not line or line[0] == '#':
             continue
         manifest_list.append(line)
+        subsystem, version = split_manifest_line(line)
+        if version and not verify and index.version(subsystem) == version:
+            print(f"Up to date {line}")
+            continue
         print(f"Downloading {line}")
-        ftpd = FtpDownloader()
-        ftpd.connect(FTP_EGAP_SERVER)
-        ftpd.download_ftp_dir(FTP_EGAP_ROOT_PATH+f"/{line}", f"{local_cache_dir}/{line}")
+        changed[line] = (subsystem, version)
+        mirror.known[line] = index.files(subsystem)
+        mirror.submit(mirror.mirror_dir, line, FTP_EGAP_ROOT_PATH+f"/{line}", f"{local_cache_dir}/{line}")
+    mirror.wait()
+    for subsystem, stats in mirror.stats.items():
+        print(stats.report(subsystem))
+    # Delta against the previous index - files of superseded versions are stale
+    for line, (subsystem, version) in changed.items():
+        listing = mirror.listings[line]
+        stale = [ path for path in mirror.known[line] if path not in listing ]
+        if stale:
+            if prune:
+                for path in stale:
+                    local_name = os.path.join(local_cache_dir, path)
+                    if os.path.isfile(local_name):
+                        os.remove(local_name)
+                print(f"{line}: deleted {len(stale)} stale files")
+            else:
+                print(f"{line}: {len(stale)} stale files, use --download-prune to delete")
+        if mirror.stats[line].failed == 0:
+            index.update(subsystem, version, listing)
+    index.close()
+    if mirror.errors:
+        print("Errors during download:")
+        for e in mirror.errors:
+            print(f"  {e}")
+    total_bytes = sum(s.bytes for s in mirror.stats.values())
+    print(f"Downloaded {total_bytes/1e6:.1f} MB using {max(workers, 1)} workers")
     if user_cache_dir:
         with open(manifest_path, 'wt') as f:
             for line in manifest_list:
                 f.write(f"{line}\n")
-    return 0
+        # Precompute lineage table for downloaded taxonomy
+        taxonomy_db_name = os.path.join(local_cache_dir, get_versioned_path("taxonomy", "taxonomy4blast.sqlite3"))
+        if os.path.exists(taxonomy_db_name) and "taxonomy" in {split_manifest_line(line)[0] for line in changed}:
+            print("Building taxonomy lineage table")
+            build_parents_table(taxonomy_db_name, taxonomy_db_name + TAXONOMY_PARENTS_SUFFIX)
+    return 1 if mirror.errors else 0
 
 
 def repackage_inputs(run_inputs):
@@ -226,9 +869,245 @@ def convert_paths(run_inputs):
         run_inputs['output'] = convert_value(run_inputs['output'])
 
 
-def prepare_reads(run_inputs):
+READ_SHARDS_DIR = "read_shards"
+READ_SHARDS_MANIFEST = "shards.json"
+
+def parse_shard_size(value):
+    """ Parse --shard-reads value, plain number is reads per shard, number with K, M or G suffix is sequence bytes per shard
+    Returns:
+        (reads, bytes) limits, one of them is 0
+    """
+    mo = re.fullmatch(r'\s*([0-9.]+)\s*([KMG]?)B?\s*', str(value), re.IGNORECASE)
+    if not mo:
+        raise argparse.ArgumentTypeError(f"invalid shard size {value}, use read count or size like 4G")
+    number, unit = float(mo.group(1)), mo.group(2).upper()
+    if not unit:
+        return int(number), 0
+    return 0, int(number * { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30 }[unit])
+
+
+def read_records(f):
+    "Iterate over FASTA or 4-line FASTQ records in binary file as bytes including line ends"
+    first = f.readline()
+    if not first:
+        return
+    if first.startswith(b'@'):
+        while first:
+            yield first + f.readline() + f.readline() + f.readline()
+            first = f.readline()
+        return
+    record = [first]
+    for line in f:
+        if line.startswith(b'>'):
+            yield b''.join(record)
+            record = [line]
+        else:
+            record.append(line)
+    yield b''.join(record)
+
+
+def shard_name(path, shard_id, mate, compressed):
+    "Shard file name keeping FASTA or FASTQ extension of the source"
+    name = Path(path).name
+    if name.endswith('.gz'):
+        name = name[:-3]
+    ext = Path(name).suffix if Path(name).suffix.lower() in ('.fa', '.fasta', '.fna', '.fq', '.fastq') else '.fa'
+    return f"{shard_id}_{mate}{ext}" + ('.gz' if compressed else '')
+
+
+def shard_library(sample_id, files, shard_dir, max_reads, max_bytes):
+    """ Stream library files and split them into shards of at most max_reads reads or max_bytes of records,
+    mates of paired library are read in lockstep so that shards stay in sync
+    Returns:
+        list of (shard_id, files), the original library if it fits into one shard
+    """
+    compressed = any(f.endswith('.gz') for f in files)
+    sources = [ open_maybe_gzip(f) for f in files ]
+    shards = []
+    outputs = None
+    count = size = 0
+    try:
+        for records in itertools.zip_longest(*(read_records(src) for src in sources)):
+            if None in records:
+                raise ValueError(f"mates of {sample_id} have different number of reads: {', '.join(files)}")
+            if outputs is None or (max_reads and count >= max_reads) or (max_bytes and size >= max_bytes):
+                if outputs:
+                    for out in outputs:
+                        out.close()
+                shard_id = f"{sample_id}_shard{len(shards) + 1:03d}"
+                paths = [ str(Path(shard_dir) / shard_name(f, shard_id, i + 1, compressed)) for i, f in enumerate(files) ]
+                # Fast compression, shards are temporary inputs of STAR
+                outputs = [ gzip.open(p, 'wb', compresslevel=1) if compressed else open(p, 'wb') for p in paths ]
+                shards.append((shard_id, paths))
+                count = size = 0
+            for out, record in zip(outputs, records):
+                out.write(record)
+            count += 1
+            size += len(records[0])
+    finally:
+        for src in sources:
+            src.close()
+        for out in outputs or []:
+            out.close()
+    if len(shards) <= 1:
+        for _, paths in shards:
+            for p in paths:
+                os.unlink(p)
+        return [ (sample_id, files) ]
+    return shards
+
+
+def shard_reads(libraries, output, shard_size, workers=None):
+    """ Split large local read libraries into balanced shards in output/read_shards, so that STAR jobs
+    scale with cluster size and not with the number of libraries. Shards of unchanged sources are reused.
+    Args:
+        libraries: dict of sample id to list of read files, as built by prepare_reads
+        shard_size: (reads, bytes) limits per shard
+    Returns:
+        (libraries, parents): sharded libraries and map of shard id to the original sample id
+    """
+    max_reads, max_bytes = shard_size
+    shard_dir = Path(output) / READ_SHARDS_DIR
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_file = shard_dir / READ_SHARDS_MANIFEST
+    manifest = {}
+    if manifest_file.exists():
+        with open(manifest_file, 'rt') as f:
+            manifest = json.load(f)
+
+    def source_key(sample_id, files):
+        sources = [ [str(Path(f).absolute()), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files ]
+        return json.dumps([sample_id, sources, max_reads, max_bytes])
+
+    result, todo = {}, {}
+    for sample_id, files in libraries.items():
+        files = files if isinstance(files, list) else [files]
+        if not 1 <= len(files) <= 2 or not all(os.path.isfile(f) for f in files):
+            # Remote or unusual libraries go as is
+            result[sample_id] = [(sample_id, files)]
+            continue
+        if not max_bytes or any(f.endswith('.gz') for f in files) or sum(os.path.getsize(f) for f in files) / len(files) > max_bytes:
+            key = source_key(sample_id, files)
+            cached = manifest.get(sample_id)
+            if cached and cached['key'] == key and all(os.path.exists(p) for _, paths in cached['shards'] for p in paths):
+                result[sample_id] = [ tuple(s) for s in cached['shards'] ]
+            else:
+                todo[sample_id] = (files, key)
+                for old in (cached or {}).get('shards', []):
+                    for p in old[1]:
+                        if p not in files and os.path.exists(p):
+                            os.unlink(p)
+        else:
+            result[sample_id] = [(sample_id, files)]
+
+    if todo:
+        workers = min(workers or os.cpu_count() or 1, len(todo))
+        start = time.monotonic()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = { sample_id: executor.submit(shard_library, sample_id, files, shard_dir, max_reads, max_bytes)
+                        for sample_id, (files, _) in todo.items() }
+            for sample_id, future in futures.items():
+                try:
+                    result[sample_id] = future.result()
+                except ValueError as e:
+                    print(f"WARNING: {e}, library is not sharded")
+                    result[sample_id] = [(sample_id, todo[sample_id][0])]
+                    continue
+                manifest[sample_id] = { 'key': todo[sample_id][1], 'shards': result[sample_id] }
+        with open(manifest_file, 'wt') as f:
+            json.dump(manifest, f, indent=1)
+        sharded = sum(len(v) for k, v in result.items() if k in todo)
+        print(f"Sharded {len(todo)} read libraries into {sharded} parts in {time.monotonic() - start:.1f}s")
+
+    sharded, parents = {}, {}
+    for sample_id in libraries:
+        for shard_id, files in result[sample_id]:
+            sharded[shard_id] = files
+            parents[shard_id] = sample_id
+    return sharded, parents
+
+
+# Records read from the start of every read file to estimate library metadata
+READ_PROFILE_RECORDS = 20000
+# and at least that many file bytes, so that gzip read-ahead does not skew the estimate
+READ_PROFILE_BYTES = 4 << 20
+READ_PROFILE_NAMES = 100
+READ_PROFILE_WORKERS = 8
+
+def mate_name(header):
+    "Read name without mate suffix, for checking that mates are in sync"
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b''
+    return name[:-2] if name[-2:] in (b'/1', b'/2') else name
+
+
+def profile_read_file(path, max_records=READ_PROFILE_RECORDS):
+    """ Estimate read count and bases of FASTA or FASTQ file, gzipped or not, from its first records,
+    scaled by the fraction of the file they take
+    Returns:
+        dict: reads, bases, exact flag and first read names
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as raw:
+        magic = raw.read(2)
+        raw.seek(0)
+        f = gzip.GzipFile(fileobj=raw) if magic == b'\x1f\x8b' else raw
+        count = bases = 0
+        names = []
+        exact = True
+        for record in read_records(f):
+            if count >= max_records and raw.tell() >= READ_PROFILE_BYTES:
+                exact = False
+                break
+            lines = record.split(b'\n')
+            if record.startswith(b'@'):
+                bases += len(lines[1].rstrip(b'\r'))
+            else:
+                bases += sum(len(line.rstrip(b'\r')) for line in lines[1:])
+            if len(names) < READ_PROFILE_NAMES:
+                names.append(mate_name(lines[0]))
+            count += 1
+        consumed = raw.tell()
+    if not exact and consumed:
+        scale = size / consumed
+        count, bases = int(count * scale), int(bases * scale)
+    return { 'reads': count, 'bases': bases, 'exact': exact, 'names': names }
+
+
+def profile_reads(libraries, workers=None):
+    """ Profile first records of local read libraries in parallel
+    Args:
+        libraries: dict of sample id to list of read files
+    Returns:
+        dict of sample id to reads and bases over all mates, paired flag and whether estimates are exact
+    """
+    files = sorted({ f for v in libraries.values() for f in v if os.path.isfile(f) })
+    if not files:
+        return {}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(workers or READ_PROFILE_WORKERS, len(files))) as executor:
+        file_profiles = dict(zip(files, executor.map(profile_read_file, files)))
+    profiles = {}
+    for sample_id, v in libraries.items():
+        if not v or not all(f in file_profiles for f in v):
+            continue
+        mates = [ file_profiles[f] for f in v ]
+        if len(mates) == 2 and mates[0]['names'] != mates[1]['names']:
+            print(f"WARNING: read names of {sample_id} mates differ, check that {v[0]} and {v[1]} are in the same order")
+        reads = sum(m['reads'] for m in mates)
+        bases = sum(m['bases'] for m in mates)
+        profiles[sample_id] = { 'reads': reads, 'bases': bases, 'paired': len(v) == 2, 'exact': all(m['exact'] for m in mates) }
+    total_reads = sum(p['reads'] for p in profiles.values())
+    total_bases = sum(p['bases'] for p in profiles.values())
+    print(f"Profiled {len(profiles)} read libraries in {time.monotonic() - start:.1f}s: "
+          f"{'' if all(p['exact'] for p in profiles.values()) else '~'}{total_reads} reads, {total_bases / 1e9:.2f} Gbases")
+    return profiles
+
+
+@profiled('prepare_reads')
+def prepare_reads(run_inputs, shard_size=None):
     """Reformat reads input to be in 'fromPairs' format expected by egapx, i.e. [sample_id, [read1, read2]]
-    Generate reads metadata file with minimal information - paired/unpaired and valid for existing libraries"""
+    Generate reads metadata file with pairedness, and read and base counts estimated from the files of every library
+    If shard_size is set, split large local libraries into shards, see shard_reads"""
     if 'reads' not in run_inputs['input'] or 'output' not in run_inputs:
         return
     prefixes = defaultdict(list)
@@ -237,9 +1116,8 @@ def prepare_reads(run_inputs):
         del run_inputs['input']['reads']
         run_inputs['input']['reads_query'] = reads
         return
-    # Create fake metadata file for reads containing only one meaningful information piece - pairedness
-    # Have an entry in this file only for SRA runs - files with prefixes SRR, ERR, and DRR and digits
-    # Non-SRA reads are handled by rnaseq_collapse internally
+    # Create metadata file for reads with pairedness, and read and base counts profiled from the files,
+    # an entry for every local library, SRA runs and others alike
     has_files = False
     for rf in run_inputs['input']['reads']:
         if type(rf) == str:
@@ -269,13 +1147,19 @@ def prepare_reads(run_inputs):
     if has_files: # len(prefixes):
         # Always create metadata file even if it's empty
         output = run_inputs['output']
+        if shard_size:
+            prefixes, _ = shard_reads(prefixes, output, shard_size)
+        # Shards get records of their own with the same layout,
+        # read and base counts come from sampled records, placeholders are left for files that cannot be read
+        profiles = profile_reads(prefixes)
         with tempfile.NamedTemporaryFile(mode='w', delete=False, dir=output, prefix='egapx_reads_metadata_', suffix='.tsv') as f:
             for k, v in prefixes.items():
-                if re.fullmatch(r'([DES]RR[0-9]+)', k):
-                    paired = 'paired' if len(v) == 2 else 'unpaired'
-                    # SRR9005248	NA	paired	2	2	NA	NA	NA	NA	NA	NA	NA	0
-                    rec = "\t".join([k, 'NA', paired, '2', '2', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', '0'])
-                    f.write(rec + '\n')
+                paired = 'paired' if len(v) == 2 else 'unpaired'
+                profile = profiles.get(k)
+                reads, bases = (str(profile['reads']), str(profile['bases'])) if profile and profile['reads'] else ('2', '2')
+                # SRR9005248	NA	paired	2	2	NA	NA	NA	NA	NA	NA	NA	0
+                rec = "\t".join([k, 'NA', paired, reads, bases, 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', '0'])
+                f.write(rec + '\n')
             f.flush()
             run_inputs['input']['reads_metadata'] = f.name
         run_inputs['input']['reads'] = [ [k, v] for k, v in prefixes.items() ]
@@ -284,6 +1168,321 @@ def prepare_reads(run_inputs):
         run_inputs['input']['reads_query'] = "[Accession] OR ".join(reads) + "[Accession]"
 
 
+def collect_input_locations(run_inputs):
+    "All file paths and URLs among inputs, read names that are SRA accessions or queries are left out"
+    locations = []
+    def collect(value):
+        if isinstance(value, dict):
+            for v in value.values():
+                collect(v)
+        elif isinstance(value, list):
+            for v in value:
+                collect(v)
+        elif isinstance(value, str) and value:
+            locations.append(value)
+    for key, value in run_inputs['input'].items():
+        if key not in path_inputs:
+            continue
+        if key == 'reads':
+            if isinstance(value, str):
+                continue
+            for rf in value:
+                if isinstance(rf, str):
+                    name = Path(rf).parts[-1] if rf else rf
+                    mo = re.match(r'([^._]+)', name)
+                    if not mo or mo.group(1) == name:
+                        continue
+                collect(rf)
+        else:
+            collect(value)
+    return list(dict.fromkeys(locations))
+
+
+PREFLIGHT_WORKERS = 32
+PREFLIGHT_CONNECTIONS_PER_HOST = 8
+PREFLIGHT_TIMEOUT = 20
+
+def check_location(location, pools, pools_lock):
+    """ Check that input is reachable and readable
+    Returns:
+        (size, error): size in bytes or None if unknown, error message or empty string
+    """
+    mo = re.match(r'([a-z0-9]{2,5})://', location)
+    if not mo:
+        if not os.path.exists(location):
+            return None, "not found"
+        if not os.access(location, os.R_OK):
+            return None, "not readable"
+        return os.path.getsize(location), ""
+    url = urllib.parse.urlsplit(location)
+    scheme = url.scheme
+    if scheme not in ('http', 'https', 'ftp'):
+        return None, ""
+    if url.query:
+        count_network()
+        with urlopen(Request(location, method="HEAD"), timeout=PREFLIGHT_TIMEOUT) as response:
+            length = response.headers.get('Content-Length')
+            return int(length) if length else None, ""
+    with pools_lock:
+        key = (scheme, url.netloc)
+        if key not in pools:
+            if scheme == 'ftp':
+                factory = lambda: FtpDownloader(timeout=PREFLIGHT_TIMEOUT)
+            else:
+                factory = lambda: HttpDownloader(scheme, timeout=PREFLIGHT_TIMEOUT)
+            pools[key] = ConnectionPool(url.netloc, PREFLIGHT_CONNECTIONS_PER_HOST, factory)
+        pool = pools[key]
+    try:
+        with pool.connection() as conn:
+            return conn.size(urllib.parse.unquote(url.path)), ""
+    except FileNotFoundError:
+        return None, "not found"
+
+
+@profiled('preflight')
+def preflight_inputs(run_inputs):
+    """ Check all input files and URLs at once over pooled connections before anything is submitted
+    Returns:
+        bool: True if all inputs are reachable
+    """
+    locations = collect_input_locations(run_inputs)
+    if not locations:
+        return True
+    start = time.monotonic()
+    pools = {}
+    pools_lock = threading.Lock()
+    results = {}
+    def check(location):
+        try:
+            results[location] = check_location(location, pools, pools_lock)
+        except Exception as e:
+            results[location] = (None, f"{type(e).__name__}: {e}")
+    with ThreadPoolExecutor(max_workers=min(PREFLIGHT_WORKERS, len(locations))) as executor:
+        list(executor.map(check, locations))
+    for pool in pools.values():
+        pool.close()
+    failed = [ (loc, err) for loc, (size, err) in results.items() if err ]
+    total = sum(size for size, err in results.values() if size)
+    unknown = sum(1 for size, err in results.values() if size is None and not err)
+    print(f"Checked {len(locations)} inputs in {time.monotonic() - start:.1f}s, total size {total/1e9:.2f} GB"
+          + (f" ({unknown} of unknown size)" if unknown else ""))
+    for loc, err in failed:
+        print(f"ERROR: input {loc}: {err}")
+    return not failed
+
+
+STAGING_DIR = "staging"
+STAGING_INDEX = "staging.sqlite3"
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FASTA_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class StagingStore:
+    """ Content-addressed local store of remote inputs. Files live in objects/<sha256>/<original name>,
+    so that the read file names sample ids are derived from are kept, and the index maps URLs to them
+    with the size of the stored file and the version of the remote file, see url_version """
+    def __init__(self, root):
+        self.root = Path(root)
+        os.makedirs(self.root / "objects", exist_ok=True)
+        self.db_path = str(self.root / STAGING_INDEX)
+        with connect_db(self.db_path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, path TEXT, size INTEGER, version TEXT)")
+            if 'version' not in [ r[1] for r in conn.execute("PRAGMA table_info(urls)") ]:
+                # Store of an older runner
+                conn.execute("ALTER TABLE urls ADD COLUMN version TEXT")
+
+    def lookup(self, url):
+        "(local path, remote version) for url if already staged and the stored file has the recorded size"
+        with connect_db(self.db_path) as conn:
+            row = conn.execute("SELECT path, size, version FROM urls WHERE url = ?", (url,)).fetchone()
+        if row and os.path.isfile(row[0]) and os.path.getsize(row[0]) == row[1]:
+            return row[0], row[2]
+        return None
+
+    def download_path(self, url):
+        "Where url is downloaded before it is checksummed, partial downloads there are resumed"
+        name = os.path.basename(urllib.parse.urlsplit(url).path) or "index"
+        return str(self.root / "tmp" / hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] / name)
+
+    def add(self, url, downloaded, version=None):
+        "Move downloaded file into the store under its checksum and record url with remote version, return the stored path"
+        sha = file_sha256(downloaded)
+        object_dir = self.root / "objects" / sha[:2] / sha
+        path = object_dir / os.path.basename(downloaded)
+        if path.is_file() and path.stat().st_size == os.path.getsize(downloaded):
+            os.remove(downloaded)
+        else:
+            os.makedirs(object_dir, exist_ok=True)
+            os.replace(downloaded, path)
+        with connect_db(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)", (url, sha, str(path), path.stat().st_size, version))
+        return str(path)
+
+
+def url_connection(url, pools, pools_lock):
+    """ Pooled connection to the host of url, pools are created on first use
+    Returns:
+        (pool, path): connection pool and path on the server, with query for HTTP
+    """
+    parts = urllib.parse.urlsplit(url)
+    with pools_lock:
+        key = (parts.scheme, parts.netloc)
+        if key not in pools:
+            factory = FtpDownloader if parts.scheme == 'ftp' else functools.partial(HttpDownloader, parts.scheme)
+            pools[key] = ConnectionPool(parts.netloc, PREFLIGHT_CONNECTIONS_PER_HOST, factory)
+        pool = pools[key]
+    path = urllib.parse.unquote(parts.path)
+    if parts.scheme == 'ftp':
+        return pool, path
+    return pool, path.lstrip('/') + (f"?{parts.query}" if parts.query else '')
+
+
+def url_version(url, pools, pools_lock):
+    "Size and modification time or ETag of remote file at url as a string, None if the server does not tell them"
+    pool, path = url_connection(url, pools, pools_lock)
+    with pool.connection() as conn:
+        version = conn.version(path)
+    return ":".join(map(str, version)) if version else None
+
+
+def download_url(url, local_path, pools, pools_lock):
+    "Download url over pooled connection with resume and retries, see FtpDownloader.download_ftp_file"
+    pool, path = url_connection(url, pools, pools_lock)
+    with pool.connection() as conn:
+        return conn.download_file(path, local_path) is True
+
+
+def fai_records(lines):
+    "samtools .fai records [name, length, offset, line bases, line width] for FASTA lines as bytes"
+    records = []
+    offset = 0
+    name = None
+    for line in lines:
+        if line[:1] == b'>':
+            name = line[1:].split()[0].decode() if line[1:].split() else ''
+            records.append([name, 0, offset + len(line), 0, 0])
+        elif name is not None:
+            rec = records[-1]
+            stripped = len(line.rstrip(b'\r\n'))
+            if rec[3] == 0:
+                rec[3], rec[4] = stripped, len(line)
+            rec[1] += stripped
+        offset += len(line)
+    return records
+
+
+def save_fai(records, fai_path):
+    with open(str(fai_path) + PARTIAL_SUFFIX, 'wt') as f:
+        for rec in records:
+            f.write("\t".join(map(str, rec)) + "\n")
+    os.replace(str(fai_path) + PARTIAL_SUFFIX, str(fai_path))
+
+
+def write_fai(fasta_path):
+    "Write samtools-compatible .fai index for uncompressed FASTA file"
+    with open(fasta_path, 'rb') as f:
+        save_fai(fai_records(f), str(fasta_path) + ".fai")
+
+
+def prepare_staged_genome(path):
+    "Decompress staged genome once next to the compressed copy and index it, return uncompressed path"
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    fasta = re.sub(r'\.(gz|bgz)$', '', path) if compressed else path
+    if fasta == path and compressed:
+        fasta = path + ".fa"
+    if not os.path.isfile(fasta):
+        with open_maybe_gzip(path) as src, open(fasta + PARTIAL_SUFFIX, 'wb') as dst:
+            shutil.copyfileobj(src, dst, FASTA_BLOCK_SIZE)
+        os.replace(fasta + PARTIAL_SUFFIX, fasta)
+    if not os.path.isfile(fasta + ".fai"):
+        write_fai(fasta)
+    return fasta
+
+
+def get_stage_dir(args):
+    return args.stage_dir or os.path.join(get_runner_cache_dir(), STAGING_DIR)
+
+
+@profiled('stage')
+def stage_inputs(run_inputs, stage_dir, workers=4):
+    """ Download remote inputs in parallel into the content-addressed store and point inputs at local copies,
+    inputs already in the store are used if the remote file has the version it had when it was staged,
+    and without any network access in offline mode
+    Returns:
+        bool: True if all remote inputs are staged
+    """
+    store = StagingStore(stage_dir)
+    urls = [ loc for loc in collect_input_locations(run_inputs) if re.match(r'(https?|ftp)://', loc) ]
+    pools = {}
+    pools_lock = threading.Lock()
+    staged = {}
+    versions = {}
+    missing = []
+    for url in urls:
+        entry = store.lookup(url)
+        if entry:
+            staged[url] = entry
+        else:
+            missing.append(url)
+    if staged and not offline_mode:
+        def check(url):
+            try:
+                return url, url_version(url, pools, pools_lock)
+            except Exception as e:
+                print(f"WARNING: can't check {url}: {e!r}, using the staged copy")
+                return url, None
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(staged)))) as executor:
+            for url, version in executor.map(check, list(staged)):
+                if version is not None and version != staged[url][1]:
+                    print(f"Remote file changed since it was staged: {url}")
+                    versions[url] = version
+                    del staged[url]
+                    missing.append(url)
+    staged = { url: entry[0] for url, entry in staged.items() }
+    if missing:
+        start = time.monotonic()
+        def fetch(url):
+            local_path = store.download_path(url)
+            try:
+                version = versions.get(url) or url_version(url, pools, pools_lock)
+                return url, local_path if download_url(url, local_path, pools, pools_lock) else None, version
+            except Exception as e:
+                print(f"ERROR: can't stage {url}: {e!r}")
+                return url, None, None
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            downloaded = list(executor.map(fetch, missing))
+        for url, local_path, version in downloaded:
+            if local_path:
+                staged[url] = store.add(url, local_path, version)
+        print(f"Staged {len(downloaded)} remote inputs in {time.monotonic() - start:.1f}s")
+    for pool in pools.values():
+        pool.close()
+    if len(staged) < len(urls):
+        return False
+    genome = run_inputs['input'].get('genome')
+    if isinstance(genome, str) and genome in staged:
+        staged[genome] = prepare_staged_genome(staged[genome])
+    def replace(value):
+        if isinstance(value, dict):
+            return { k: replace(v) for k, v in value.items() }
+        if isinstance(value, list):
+            return [ replace(v) for v in value ]
+        return staged.get(value, value)
+    for key in path_inputs:
+        if key in run_inputs['input']:
+            run_inputs['input'][key] = replace(run_inputs['input'][key])
+    if urls:
+        print(f"Using local copies of {len(urls)} remote inputs from {stage_dir}")
+    return True
+
+
+@profiled('validate')
 def expand_and_validate_params(run_inputs):
     """ Expand implicit parameters and validate inputs
     Args:
@@ -367,37 +1566,107 @@ def get_cache_dir():
     return ""
 
 
+HTTP_CACHE_DIR = "http_cache"
+
+def fetch_url(url, ttl=None):
+    """ Fetch small remote metadata file through the on-disk HTTP cache
+    Fresh entries (younger than ttl) are returned without network access, stale ones are revalidated
+    with If-None-Match/If-Modified-Since. In offline mode any cached entry is used.
+    Returns:
+        bytes: content of the url
+    """
+    ttl = metadata_ttl if ttl is None else ttl
+    cache_dir = os.path.join(get_runner_cache_dir(), HTTP_CACHE_DIR)
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    body_path = os.path.join(cache_dir, key)
+    meta_path = body_path + ".json"
+    meta = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'rt') as f:
+                meta = json.load(f)
+        except ValueError:
+            # Written by an older runner in place and truncated, fetch again
+            meta = {}
+    if meta:
+        if offline_mode or time.time() - meta.get('fetched', 0) < ttl:
+            with open(body_path, 'rb') as f:
+                return f.read()
+    elif offline_mode:
+        raise OSError(f"{url} is not cached and network access is disabled by --offline")
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        with urlopen(Request(url, headers=headers)) as response:
+            body = response.read()
+            meta = { 'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified') }
+        count_network(len(body))
+    except urllib.error.HTTPError as e:
+        count_network()
+        if e.code >= 500 and meta:
+            print(f"WARNING: can't revalidate {url}: HTTP {e.code}, using cached copy")
+            with open(body_path, 'rb') as f:
+                return f.read()
+        if e.code != 304:
+            raise
+        # Not modified, keep cached body
+        with open(body_path, 'rb') as f:
+            body = f.read()
+    except urllib.error.URLError as e:
+        if not meta:
+            raise
+        print(f"WARNING: can't revalidate {url}: {e.reason}, using cached copy")
+        with open(body_path, 'rb') as f:
+            return f.read()
+    meta['fetched'] = time.time()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(body_path + PARTIAL_SUFFIX, 'wb') as f:
+        f.write(body)
+    os.replace(body_path + PARTIAL_SUFFIX, body_path)
+    with open(meta_path + PARTIAL_SUFFIX, 'wt') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + PARTIAL_SUFFIX, meta_path)
+    return body
+
+
 data_version_cache = {}
-def get_versioned_path(subsystem, filename):
-    global data_version_cache
-    global user_cache_dir
-    if not data_version_cache:
-        manifest_path = f"{user_cache_dir}/{DATA_VERSION}.mft"
-        if user_cache_dir and os.path.exists(manifest_path):
-            with open(manifest_path, 'rt') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line[0] == '#':
-                        continue
-                    parts = line.split('/')
-                    if len(parts) == 2:
-                        data_version_cache[parts[0]] = parts[1]
-        else:
-            manifest_url = f"{FTP_EGAP_ROOT}/{DATA_VERSION}.mft"
-            manifest = urlopen(manifest_url)
-            manifest_list = []
-            for line in manifest:
-                line = line.decode("utf-8").strip()
+def load_data_versions():
+    "Read support data versions from manifest in local cache or on the server"
+    manifest_path = f"{user_cache_dir}/{DATA_VERSION}.mft"
+    if user_cache_dir and os.path.exists(manifest_path):
+        with open(manifest_path, 'rt') as f:
+            for line in f:
+                line = line.strip()
                 if not line or line[0] == '#':
                     continue
                 parts = line.split('/')
                 if len(parts) == 2:
                     data_version_cache[parts[0]] = parts[1]
-                    manifest_list.append(line)
-            if user_cache_dir:
-                with open(manifest_path, 'wt') as f:
-                    for line in manifest_list:
-                        f.write(f"{line}\n")
+    else:
+        manifest_url = f"{FTP_EGAP_ROOT}/{DATA_VERSION}.mft"
+        manifest = fetch_url(manifest_url).splitlines()
+        manifest_list = []
+        for line in manifest:
+            line = line.decode("utf-8").strip()
+            if not line or line[0] == '#':
+                continue
+            parts = line.split('/')
+            if len(parts) == 2:
+                data_version_cache[parts[0]] = parts[1]
+                manifest_list.append(line)
+        if user_cache_dir:
+            with open(manifest_path, 'wt') as f:
+                for line in manifest_list:
+                    f.write(f"{line}\n")
+
+
+def get_versioned_path(subsystem, filename):
+    if not data_version_cache:
+        with profile_phase('manifest'):
+            load_data_versions()
 
     if subsystem not in data_version_cache:
         return os.path.join(subsystem, filename)
@@ -416,11 +1685,75 @@ def get_file_path(subsystem, filename):
     return file_url
 
 
-def get_config(script_directory, args):
-    config_file = ""
+def get_config_dir(args):
     config_dir = args.config_dir if args.config_dir else os.environ.get("EGAPX_CONFIG_DIR")
     if not config_dir:
         config_dir = Path(os.getcwd()) / "egapx_config"
+    return config_dir
+
+
+# Nextflow config tokens - strings, comments, line ends, names and values like 60.GB, and single characters
+CONFIG_TOKEN = re.compile(r"""(?P<string>'(?:\\.|[^'\\\n])*'|"(?:\\.|[^"\\\n])*")|(?P<comment>//[^\n]*|/\*.*?\*/)"""
+                          r"""|(?P<newline>\n)|(?P<word>[\w.$]+)|(?P<char>\S)""", re.S)
+
+def unquote_config_value(value):
+    return value[1:-1] if len(value) > 1 and value[0] in "'\"" and value[-1] == value[0] else value
+
+
+def read_config_settings(config_path):
+    """ Assignments in Nextflow config file as { 'scope.name': value }, both dotted names and scope blocks
+    Selector blocks are part of the scope like 'process.withLabel:big_job.memory', string values are unquoted,
+    other values like closures are kept as text
+    """
+    with open(config_path, 'r') as f:
+        tokens = [ (mo.lastgroup, mo.group()) for mo in CONFIG_TOKEN.finditer(f.read()) if mo.lastgroup != 'comment' ]
+    settings = {}
+    scopes = []
+    i = 0
+    while i < len(tokens):
+        kind, token = tokens[i]
+        following = [ t for _, t in tokens[i+1:i+4] ]
+        if kind == 'word' and following[:1] == ['=']:
+            # Value runs to the end of line, closures and lists to the matching bracket
+            i += 2
+            depth = 0
+            value = []
+            while i < len(tokens) and (depth or tokens[i][0] != 'newline' or not value):
+                value_kind, value_token = tokens[i]
+                if value_kind == 'char' and value_token in '{[(':
+                    depth += 1
+                elif value_kind == 'char' and value_token in '}])':
+                    if not depth:
+                        break
+                    depth -= 1
+                if value_kind != 'newline':
+                    value.append(value_token)
+                i += 1
+            settings[".".join(scopes + [token])] = unquote_config_value(value[0]) if len(value) == 1 else " ".join(value)
+            continue
+        if kind == 'word' and following[:1] == ['{']:
+            scopes.append(token)
+            i += 2
+            continue
+        if kind == 'word' and following[:1] == [':'] and following[2:3] == ['{']:
+            scopes.append(f"{token}:{unquote_config_value(following[1])}")
+            i += 4
+            continue
+        if kind == 'char' and token == '}' and scopes:
+            scopes.pop()
+        i += 1
+    return settings
+
+
+def parse_config_memory(value):
+    "Nextflow config memory like 60.GB or '60 GB' to bytes, None for closures and other expressions"
+    return parse_nf_memory(re.sub(r'\.(?=[KMGTP]?B$)', ' ', (value or '').strip()))
+
+
+@profiled('config')
+def get_config(script_directory, args):
+    config_file = ""
+    config_dir = get_config_dir(args)
     if not Path(config_dir).is_dir():
         # Create directory and copy executor config files there
         from_dir = Path(script_directory) / 'assets' / 'config' / 'executor'
@@ -438,157 +1771,452 @@ def get_config(script_directory, args):
         print(f"Executor {args.executor} not supported")
         return ""
     default_configs = [ "default.config" ]
-    with open(str(config_file), 'r') as f:
-        config_txt = f.read().replace('\n', ' ')
-        # Check whether the config sets the container
-        mo = re.search(r"process.+container *=", config_txt)
-        if not mo:
-            default_configs.append("docker_image.config")
-        # Check whether the config specifies proccess memory or CPUs
-        mo = re.search(r"process.+(memory|cpus) *=", config_txt)
-        if not mo:
-            default_configs.append("process_resources.config")
+    # Settings in process scope, including selector blocks
+    process_settings = { k.rpartition('.')[2] for k in read_config_settings(config_file) if k.startswith('process.') }
+    # Check whether the config sets the container
+    if 'container' not in process_settings:
+        default_configs.append("docker_image.config")
+    # Check whether the config specifies proccess memory or CPUs
+    if not process_settings & { 'memory', 'cpus' }:
+        default_configs.append("process_resources.config")
     
     # Add mandatory configs
-    config_files = [str(config_file)]
+    config_files = [str(config_file.absolute())]
     for cf in default_configs:
         config_files.append(os.path.join(script_directory, "assets/config", cf))
+    # Per-process resources generated by --resource-report from previous runs go last to override the tiers
+    right_sized = Path(config_dir) / RIGHT_SIZED_CONFIG
+    if right_sized.is_file() and not args.stub_run:
+        config_files.append(str(right_sized.absolute()))
     return ",".join(config_files)
 
 
-lineage_cache = {}
-def get_lineage(taxid):
-    global lineage_cache
-    if not taxid:
-        return []
-    if taxid in lineage_cache:
-        return lineage_cache[taxid]
-    # Try cached taxonomy database
-    taxonomy_db_name = os.path.join(get_cache_dir(), get_versioned_path("taxonomy", "taxonomy4blast.sqlite3"))
-    if os.path.exists(taxonomy_db_name):
-        conn = sqlite3.connect(taxonomy_db_name)
-        if conn:
-            c = conn.cursor()
-            lineage = [taxid]
-            cur_taxid = taxid
-            while cur_taxid != 1:
-                c.execute("SELECT parent FROM TaxidInfo WHERE taxid = ?", (cur_taxid,))
-                cur_taxid = c.fetchone()[0]
-                lineage.append(cur_taxid)
-            lineage.reverse()
-            lineage_cache[taxid] = lineage
-            return lineage
-    
-    # Fallback to API
-    taxon_json_file = urlopen(dataset_taxonomy_url+str(taxid))
-    taxon = json.load(taxon_json_file)["taxonomy_nodes"][0]
-    lineage = taxon["taxonomy"]["lineage"]
-    lineage.append(taxon["taxonomy"]["tax_id"])
-    lineage_cache[taxid] = lineage
-    return lineage
+RIGHT_SIZED_CONFIG = "right_sized.config"
+RESOURCE_MEMORY_HEADROOM = 1.3
+RESOURCE_TIME_HEADROOM = 2.0
+RESOURCE_MIN_MEMORY_GB = 1
+RESOURCE_MIN_TIME_H = 1
 
+def parse_nf_duration(value):
+    "Nextflow trace duration like '1d 2h 3m 4s' or '350ms' to seconds, None if not available"
+    if not value or value == '-':
+        return None
+    units = { 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400 }
+    parts = re.findall(r'([0-9.]+)\s*(ms|s|m|h|d)', value)
+    if not parts:
+        return None
+    return sum(float(n) * units[u] for n, u in parts)
 
-def get_tax_file(subsystem, tax_path):
-    vfn = get_versioned_path(subsystem, tax_path)
-    taxids_path = os.path.join(get_cache_dir(), vfn)
-    taxids_url = f"{FTP_EGAP_ROOT}/{vfn}"
-    taxids_file = []
-    if os.path.exists(taxids_path):
+
+def parse_nf_memory(value):
+    "Nextflow trace memory like '1.5 GB' to bytes, None if not available"
+    mo = re.fullmatch(r'([0-9.]+)\s*([KMGTP]?B)', (value or '').strip())
+    if not mo:
+        return None
+    return float(mo.group(1)) * 1024 ** 'BKMGTP'.index(mo.group(2)[0] if len(mo.group(2)) > 1 else 'B')
+
+
+def parse_nf_number(value):
+    try:
+        return float((value or '').strip().rstrip('%'))
+    except ValueError:
+        return None
+
+
+def read_trace(trace_file):
+    "Read Nextflow trace file into list of dicts keyed by trace field names"
+    with open(trace_file, 'rt') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        return [ dict(zip(header, line.rstrip('\n').split('\t'))) for line in f if line.strip() ]
+
+
+def trace_process_name(row):
+    "Fully qualified process name from trace row"
+    if row.get('process') and row['process'] != '-':
+        return row['process']
+    return re.sub(r'\s*\(.*\)$', '', row.get('name', ''))
+
+
+def summarize_traces(trace_files):
+    "Per-process requested vs peak resources over all tasks in trace files"
+    processes = {}
+    for trace_file in trace_files:
+        for row in read_trace(trace_file):
+            name = trace_process_name(row)
+            if not name:
+                continue
+            p = processes.setdefault(name, { 'tasks': 0, 'failed': 0, 'cpus': None, 'memory': None, 'time': None,
+                                             'peak_rss': 0, 'peak_cpus': 0, 'realtime': 0, 'cpu_hours': 0 })
+            p['tasks'] += 1
+            if row.get('status') == 'FAILED':
+                p['failed'] += 1
+            cpus, memory, limit = parse_nf_number(row.get('cpus')), parse_nf_memory(row.get('memory')), parse_nf_duration(row.get('time'))
+            p['cpus'] = max(p['cpus'] or 0, cpus) if cpus else p['cpus']
+            p['memory'] = max(p['memory'] or 0, memory) if memory else p['memory']
+            p['time'] = max(p['time'] or 0, limit) if limit else p['time']
+            peak_rss = parse_nf_memory(row.get('peak_rss')) or 0
+            pct_cpu = parse_nf_number(row.get('%cpu')) or 0
+            realtime = parse_nf_duration(row.get('realtime')) or 0
+            p['peak_rss'] = max(p['peak_rss'], peak_rss)
+            p['peak_cpus'] = max(p['peak_cpus'], pct_cpu / 100)
+            p['realtime'] = max(p['realtime'], realtime)
+            p['cpu_hours'] += pct_cpu / 100 * realtime / 3600
+    return processes
+
+
+def right_size(p):
+    "Suggested (memory GB, cpus, time hours) for process summary"
+    memory_gb = max(RESOURCE_MIN_MEMORY_GB, math.ceil(p['peak_rss'] * RESOURCE_MEMORY_HEADROOM / 1024**3))
+    cpus = max(1, math.ceil(p['peak_cpus']))
+    if p['cpus']:
+        cpus = min(cpus, int(p['cpus']))
+    time_h = max(RESOURCE_MIN_TIME_H, math.ceil(p['realtime'] * RESOURCE_TIME_HEADROOM / 3600))
+    return memory_gb, cpus, time_h
+
+
+def resource_report(trace_files, config_dir):
+    """ Print requested vs peak resources per process for past runs and write right-sized
+    per-process Nextflow config picked up by get_config on later runs
+    Returns:
+        int: 0 on success
+    """
+    for trace_file in trace_files:
+        if not os.path.exists(trace_file):
+            print(f"Trace file {trace_file} not found")
+            return 1
+    processes = summarize_traces(trace_files)
+    if not processes:
+        print("No tasks found in trace files")
+        return 1
+    gb = 1024**3
+    fmt = "{:<60s} {:>5s} {:>9s} {:>9s} {:>5s} {:>5s} {:>9s} {:>9s} {:>9s}"
+    print(fmt.format("process", "tasks", "req_mem", "peak_mem", "req_c", "peak_c", "req_time", "max_time", "new_mem"))
+    lines = [ f"// Generated by egapx.py --resource-report from {', '.join(map(str, trace_files))}",
+              "// Per-process resources right-sized from peak usage, memory grows with retry attempt",
+              "process {" ]
+    for name in sorted(processes):
+        p = processes[name]
+        memory_gb, cpus, time_h = right_size(p)
+        print(fmt.format(name[-60:], str(p['tasks']),
+                         f"{p['memory']/gb:.1f}G" if p['memory'] else "-", f"{p['peak_rss']/gb:.1f}G",
+                         f"{p['cpus']:.0f}" if p['cpus'] else "-", f"{p['peak_cpus']:.1f}",
+                         f"{p['time']/3600:.1f}h" if p['time'] else "-", f"{p['realtime']/3600:.2f}h", f"{memory_gb}G"))
+        lines += [ f"    withName: '{name}' {{",
+                   f"        memory = {{ {memory_gb}.GB * task.attempt }}",
+                   f"        cpus = {cpus}",
+                   f"        time = {{ {time_h}.h * task.attempt }}",
+                   "    }" ]
+    lines.append("}")
+    requested = sum(p['memory'] or 0 for p in processes.values())
+    peak = sum(p['peak_rss'] for p in processes.values())
+    if requested:
+        print(f"Peak memory is {peak / requested:.1%} of requested over all processes")
+    os.makedirs(config_dir, exist_ok=True)
+    config_path = Path(config_dir) / RIGHT_SIZED_CONFIG
+    with open(config_path, 'wt') as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"Right-sized process config written to {config_path}, it will be used by later runs with this config directory")
+    return 0
+
+
+def get_runner_cache_dir():
+    "Directory for runner state shared across runs - local cache if set, otherwise EGAPX_STATE_DIR or ~/.cache/egapx"
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        cache_dir = os.environ.get("EGAPX_STATE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "egapx")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+TAXONOMY_PARENTS_SUFFIX = ".parents"
+MAX_LINEAGE_DEPTH = 256
+
+def build_parents_table(taxonomy_db_name, parents_name):
+    """ Dump taxid -> parent taxid mapping from taxonomy database into flat array of native uint32
+    indexed by taxid, 0 marks missing taxid. Written once when the cache is downloaded """
+    conn = connect_db(taxonomy_db_name)
+    try:
+        max_taxid = conn.execute("SELECT max(taxid) FROM TaxidInfo").fetchone()[0] or 0
+        parents = array('I', bytes((max_taxid + 1) * array('I').itemsize))
+        for taxid, parent in conn.execute("SELECT taxid, parent FROM TaxidInfo"):
+            parents[taxid] = parent
+    finally:
+        conn.close()
+    partial_name = parents_name + PARTIAL_SUFFIX
+    with open(partial_name, 'wb') as f:
+        parents.tofile(f)
+    os.replace(partial_name, parents_name)
+
+
+class LineageTable:
+    "Memory-mapped taxid -> parent array, see build_parents_table"
+    def __init__(self, parents_name):
+        with open(parents_name, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.parents = memoryview(self.mm).cast('I')
+
+    def lineage(self, taxid):
+        parents = self.parents
+        if taxid <= 0 or taxid >= len(parents) or not parents[taxid]:
+            return None
+        lineage = [taxid]
+        cur_taxid = taxid
+        while cur_taxid != 1:
+            cur_taxid = parents[cur_taxid]
+            if not cur_taxid or len(lineage) >= MAX_LINEAGE_DEPTH:
+                return None
+            lineage.append(cur_taxid)
+        lineage.reverse()
+        return lineage
+
+
+def get_taxonomy_db_name():
+    return os.path.join(get_cache_dir(), get_versioned_path("taxonomy", "taxonomy4blast.sqlite3"))
+
+
+lineage_table = None
+def get_lineage_table():
+    "Return LineageTable for cached taxonomy database, building it on first use if needed"
+    global lineage_table
+    if lineage_table is None:
+        lineage_table = False
+        taxonomy_db_name = get_taxonomy_db_name()
+        if get_cache_dir() and os.path.exists(taxonomy_db_name):
+            parents_name = taxonomy_db_name + TAXONOMY_PARENTS_SUFFIX
+            try:
+                if not os.path.exists(parents_name):
+                    build_parents_table(taxonomy_db_name, parents_name)
+                lineage_table = LineageTable(parents_name)
+            except (OSError, sqlite3.Error) as e:
+                print(f"WARNING: can't use taxonomy lineage table {parents_name}: {e}")
+    return lineage_table
+
+
+def get_db_lineages(taxonomy_db_name, taxids):
+    "Lineages from taxonomy database, one recursive query per taxid over a single connection"
+    lineages = {}
+    conn = connect_db(taxonomy_db_name)
+    try:
+        for taxid in taxids:
+            rows = conn.execute("""WITH RECURSIVE up(taxid, depth) AS (
+                                     SELECT taxid, 0 FROM TaxidInfo WHERE taxid = ?
+                                     UNION ALL
+                                     SELECT t.parent, up.depth + 1 FROM TaxidInfo t JOIN up ON t.taxid = up.taxid
+                                     WHERE up.taxid != 1 AND up.depth < ?)
+                                   SELECT taxid FROM up ORDER BY depth DESC""", (taxid, MAX_LINEAGE_DEPTH)).fetchall()
+            if rows:
+                lineages[taxid] = [ r[0] for r in rows ]
+    finally:
+        conn.close()
+    return lineages
+
+
+LINEAGE_CACHE_NAME = "lineage_cache.sqlite3"
+LINEAGE_API_BATCH = 100
+
+def get_api_lineages(taxids):
+    "Lineages from NCBI Datasets taxonomy API, cached on disk across runs"
+    lineages = {}
+    conn = connect_db(os.path.join(get_runner_cache_dir(), LINEAGE_CACHE_NAME))
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS lineage (taxid INTEGER PRIMARY KEY, lineage TEXT)")
+        missing = []
+        for taxid in taxids:
+            row = conn.execute("SELECT lineage FROM lineage WHERE taxid = ?", (taxid,)).fetchone()
+            if row:
+                lineages[taxid] = json.loads(row[0])
+            else:
+                missing.append(taxid)
+        for i in range(0, len(missing), LINEAGE_API_BATCH):
+            batch = missing[i:i+LINEAGE_API_BATCH]
+            taxon_json = fetch_url(dataset_taxonomy_url + ",".join(map(str, batch)))
+            nodes = json.loads(taxon_json).get("taxonomy_nodes", [])
+            for n, taxon in enumerate(nodes):
+                # Merged or retired taxid resolves to another tax_id, the node is matched to the requested one
+                # by its query, or by position if the response has one node per requested taxid
+                requested = [ int(q) for q in taxon.get("query", []) if str(q).isdigit() and int(q) in batch ]
+                if requested:
+                    taxid = requested[0]
+                elif len(nodes) == len(batch):
+                    taxid = batch[n]
+                else:
+                    continue
+                if "taxonomy" not in taxon:
+                    continue
+                lineage = taxon["taxonomy"].get("lineage", [])
+                lineage.append(taxon["taxonomy"]["tax_id"])
+                lineages[taxid] = lineage
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO lineage VALUES (?, ?)", (taxid, json.dumps(lineage)))
+    finally:
+        conn.close()
+    return lineages
+
+
+lineage_cache = {}
+@profiled('lineage')
+def get_lineages(taxids):
+    """ Lineages for many taxids at once
+    Args:
+        taxids: iterable of taxids
+    Returns:
+        dict: taxid -> lineage list from root to taxid, unknown taxids are omitted
+    """
+    global lineage_cache
+    taxids = [ int(t) for t in taxids if t ]
+    missing = [ t for t in dict.fromkeys(taxids) if t not in lineage_cache ]
+    if missing:
+        # Try cached taxonomy database
+        table = get_lineage_table()
+        if table:
+            for taxid in missing:
+                lineage = table.lineage(taxid)
+                if lineage:
+                    lineage_cache[taxid] = lineage
+        elif get_cache_dir() and os.path.exists(get_taxonomy_db_name()):
+            lineage_cache.update(get_db_lineages(get_taxonomy_db_name(), missing))
+        missing = [ t for t in missing if t not in lineage_cache ]
+    if missing:
+        # Fallback to API
+        lineage_cache.update(get_api_lineages(missing))
+    return { t: lineage_cache[t] for t in taxids if t in lineage_cache }
+
+
+def get_lineage(taxid):
+    if not taxid:
+        return []
+    return get_lineages([taxid]).get(int(taxid), [])
+
+
+def get_tax_file(subsystem, tax_path):
+    vfn = get_versioned_path(subsystem, tax_path)
+    taxids_path = os.path.join(get_cache_dir(), vfn)
+    taxids_url = f"{FTP_EGAP_ROOT}/{vfn}"
+    taxids_file = []
+    if os.path.exists(taxids_path):
         with open(taxids_path, "rb") as r:
             taxids_file = r.readlines()
     else:
-        taxids_file = urlopen(taxids_url)
+        taxids_file = fetch_url(taxids_url).splitlines(keepends=True)
     return taxids_file
 
-def get_closest_protein_bag(taxid):
-    if not taxid:
-        return ''
+class ReferenceIndex:
+    """ Maps every taxonomy node covered by a reference list to (score, reference taxid), where score
+    is the depth of the node in the reference lineage. Closest reference for a taxid is then found by
+    walking its lineage from the leaf up to the first covered node """
+    def __init__(self, nodes=None):
+        self.nodes = nodes if nodes is not None else {}
+
+    def add(self, ref_taxid, lineage):
+        "Add reference with its lineage, on equal score the reference added first wins"
+        for pos in range(1, len(lineage)):
+            node = lineage[pos]
+            if node not in self.nodes or pos > self.nodes[node][0]:
+                self.nodes[node] = (pos, ref_taxid)
 
-    taxids_file = get_tax_file("target_proteins", "taxid.list")
-    taxids_list = []
+    def closest(self, lineage):
+        "Closest reference taxid for lineage, None if only the root is shared"
+        for node in reversed(lineage[1:]):
+            if node in self.nodes:
+                return self.nodes[node][1]
+        return None
+
+    def save(self, path):
+        partial_path = path + PARTIAL_SUFFIX
+        with open(partial_path, 'wt') as f:
+            json.dump([ [node, score, ref_taxid] for node, (score, ref_taxid) in self.nodes.items() ], f)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rt') as f:
+            return cls({ node: (score, ref_taxid) for node, score, ref_taxid in json.load(f) })
+
+
+def parse_hmm_taxid_list(taxids_file):
+    "Yield (taxid, lineage) from gnomon hmm_parameters/taxid.list"
     for line in taxids_file:
-        line = line.decode("utf-8").strip()
-        if len(line) == 0 or line[0] == '#':
-            continue
-        parts = line.split('\t')
-        if len(parts) > 0:
+        parts = line.decode("utf-8").strip().split('\t')
+        if len(parts) > 1:
             t = parts[0]
-            taxids_list.append(int(t))
+            l = map(lambda x: int(x) if x[-1] != ';' else int(x[:-1]), parts[1].split())
+            yield int(t), list(l)+[int(t)]
 
-    lineage = get_lineage(taxid)
 
-    best_taxid = None
-    best_score = 0
-    for t in taxids_list:
-        try:
-            pos = lineage.index(t)
-        except ValueError:
+def parse_protein_taxid_list(taxids_file):
+    "Yield (taxid, lineage) from target_proteins/taxid.list, lineage is only the taxid itself"
+    for line in taxids_file:
+        line = line.decode("utf-8").strip()
+        if len(line) == 0 or line[0] == '#':
             continue
-        if pos > best_score:
-            best_score = pos
-            best_taxid = t
+        t = int(line.split('\t')[0])
+        # Leading 0 takes the place of the root so that the taxid itself is covered
+        yield t, [0, t]
 
-    if best_score == 0:
-        return ''
-    # print(best_taxid, best_score)
-    return get_file_path("target_proteins", f"{best_taxid}.faa.gz")
+
+REFERENCE_INDEX_DIR = "reference_index"
+reference_indexes = {}
+def get_reference_index(subsystem, tax_path, parse):
+    """ Return ReferenceIndex for the reference list, built once per data version and kept in the runner cache """
+    vfn = get_versioned_path(subsystem, tax_path)
+    if vfn in reference_indexes:
+        return reference_indexes[vfn]
+    # Only persist index for versioned lists, unversioned list may change under the same name
+    index_path = ""
+    if vfn != os.path.join(subsystem, tax_path):
+        index_path = os.path.join(get_runner_cache_dir(), REFERENCE_INDEX_DIR, vfn.replace(os.sep, '_') + ".json")
+    if index_path and os.path.exists(index_path):
+        index = ReferenceIndex.load(index_path)
+    else:
+        index = ReferenceIndex()
+        for t, l in parse(get_tax_file(subsystem, tax_path)):
+            index.add(t, l)
+        if index_path:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            index.save(index_path)
+    reference_indexes[vfn] = index
+    return index
 
 
-def get_closest_hmm(taxid):
-    if not taxid:
-        return 0, ""
+@profiled('closest_proteins')
+def resolve_closest_protein_bags(taxids):
+    "Closest protein bag path for every taxid in one call, '' if not found"
+    index = get_reference_index("target_proteins", "taxid.list", parse_protein_taxid_list)
+    lineages = get_lineages(taxids)
+    result = {}
+    for taxid in taxids:
+        best_taxid = index.closest(lineages.get(int(taxid), []))
+        result[taxid] = get_file_path("target_proteins", f"{best_taxid}.faa.gz") if best_taxid else ''
+    return result
 
-    taxids_file = get_tax_file("gnomon", "hmm_parameters/taxid.list")
 
-    taxids_list = []
-    lineages = []
-    for line in taxids_file:
-        parts = line.decode("utf-8").strip().split('\t')
-        if len(parts) > 0:
-            t = parts[0]
-            taxids_list.append(t)
-            if len(parts) > 1:
-                l = map(lambda x: int(x) if x[-1] != ';' else int(x[:-1]), parts[1].split())
-                lineages.append((int(t), list(l)+[int(t)]))
+@profiled('closest_hmm')
+def resolve_closest_hmms(taxids):
+    "Closest HMM parameters (hmm taxid, path) for every taxid in one call, (0, '') if not found"
+    index = get_reference_index("gnomon", "hmm_parameters/taxid.list", parse_hmm_taxid_list)
+    lineages = get_lineages(taxids)
+    result = {}
+    for taxid in taxids:
+        best_taxid = index.closest(lineages.get(int(taxid), []))
+        result[taxid] = (best_taxid, get_file_path("gnomon", f"hmm_parameters/{best_taxid}.params")) if best_taxid else (0, "")
+    return result
 
-    #if len(lineages) < len(taxids_list):
-    #    taxonomy_json_file = urlopen(dataset_taxonomy_url+','.join(taxids_list))
-    #    taxonomy = json.load(taxonomy_json_file)["taxonomy_nodes"]
-    #    lineages = [ (t["taxonomy"]["tax_id"], t["taxonomy"]["lineage"] + [t["taxonomy"]["tax_id"]]) for t in taxonomy ]
 
-    lineage = get_lineage(taxid)
+def get_closest_protein_bag(taxid):
+    if not taxid:
+        return ''
+    return resolve_closest_protein_bags([taxid])[taxid]
 
-    best_lineage = None
-    best_taxid = None
-    best_score = 0
-    for (t, l) in lineages:
-        pos1 = 0
-        last_match = 0
-        for pos in range(len(lineage)):
-            tax_id = lineage[pos]
-            while tax_id != l[pos1]:
-                if pos1 + 1 < len(l):
-                    pos1 += 1
-                else:
-                    break
-            if tax_id == l[pos1]:
-                last_match = pos1
-            else:
-                break
-        if last_match > best_score:
-            best_score = last_match
-            best_taxid = t
-            best_lineage = l
 
-    if best_score == 0:
+def get_closest_hmm(taxid):
+    if not taxid:
         return 0, ""
-    # print(best_lineage)
-    # print(best_taxid, best_score)
-    return best_taxid, get_file_path("gnomon", f"hmm_parameters/{best_taxid}.params")
+    return resolve_closest_hmms([taxid])[taxid]
 
 
 PLANTS=33090
 VERTEBRATES=7742
+@profiled('max_intron')
 def get_max_intron(taxid):
     if not taxid:
         return 0, 0
@@ -643,163 +2271,2561 @@ def merge_params(task_params, run_inputs):
     return task_params
 
 
-def print_statistics(output):
-    accept_gff = Path(output) / 'accept.gff'
-    print(f"Statistics for {accept_gff}")
-    counter = defaultdict(int)
-    if accept_gff.exists():
-        with open(accept_gff, 'rt') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line[0] == '#':
+FASTA_BLOCK_SIZE = 4 * 1024 * 1024
+
+def open_maybe_gzip(path):
+    "Open file for binary reading, transparently decompressing gzip and bgzip"
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    return gzip.open(path, 'rb') if magic == b'\x1f\x8b' else open(path, 'rb')
+
+
+def read_genome_stats(path):
+    """ Stream FASTA file in blocks and measure it
+    Returns:
+        dict: total length, number of sequences and N50
+    """
+    lengths = []
+    cur = None
+    in_header = False
+    with open_maybe_gzip(path) as f:
+        while True:
+            block = f.read(FASTA_BLOCK_SIZE)
+            if not block:
+                break
+            pos = 0
+            while pos < len(block):
+                if in_header:
+                    nl = block.find(b'\n', pos)
+                    if nl < 0:
+                        break
+                    in_header = False
+                    pos = nl + 1
                     continue
+                gt = block.find(b'>', pos)
+                end = len(block) if gt < 0 else gt
+                if cur is not None:
+                    seg = block[pos:end]
+                    cur += len(seg) - seg.count(b'\n') - seg.count(b'\r')
+                if gt < 0:
+                    break
+                if cur is not None:
+                    lengths.append(cur)
+                cur = 0
+                in_header = True
+                pos = gt + 1
+    if cur is not None:
+        lengths.append(cur)
+    lengths.sort(reverse=True)
+    total = sum(lengths)
+    n50 = 0
+    acc = 0
+    for l in lengths:
+        acc += l
+        if acc * 2 >= total:
+            n50 = l
+            break
+    return { 'length': total, 'sequences': len(lengths), 'n50': n50 }
+
+
+genome_stats_cache = {}
+def get_genome_stats(path):
+    "read_genome_stats remembered for the run, resource plan and work quota check both need it"
+    if path not in genome_stats_cache:
+        genome_stats_cache[path] = read_genome_stats(path)
+    return genome_stats_cache[path]
+
+
+def get_host_resources():
+    "Number of CPUs and memory in bytes of this host"
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = 0
+    return os.cpu_count() or 1, memory
+
+
+# Executors running tasks on this host, everything else is a cluster or cloud with nodes sized by process_resources.config
+LOCAL_EXECUTORS = { 'local', 'docker', 'docker_minimal', 'singularity', 'biowulf_local' }
+CLUSTER_MAX_CPUS = 31
+DEFAULT_MEMORY_GB = 60
+DEFAULT_CPUS = 7
+CLUSTER_MAX_MEMORY_GB = { 'big_job': 120, 'huge_job': 200 }
+# Thread counts by genome length - up to 100 Mb, up to 1 Gb, and larger
+PLAN_GENOME_TIERS = [ 100000000, 1000000000 ]
+PLAN_THREADS = {
+    'miniprot': [ 8, 16, 31 ],
+    'star': [ 8, 16, 16 ],
+    'star_index': [ 4, 8, 8 ],
+}
+# Job tier processes and their memory model - bytes per genome base, per read base and per protein byte,
+# GB per thread and fixed GB. STAR index is about 11 bytes per base and run_star loads it whole,
+# miniprot index is about 6 bytes per base and it keeps all proteins of the task in memory.
+# Process without 'threads' uses the fixed 'cpus', samtools merge threads are set in bam_bin_and_sort.
+PLAN_PROCESSES = {
+    'build_index': { 'label': 'big_job', 'threads': 'star_index', 'genome': 11, 'fixed_gb': 2 },
+    'merge': { 'label': 'big_job', 'cpus': 8, 'thread_gb': 0.5, 'fixed_gb': 2 },
+    'run_star': { 'label': 'huge_job', 'threads': 'star', 'genome': 11, 'reads': 0.1, 'thread_gb': 1, 'fixed_gb': 2 },
+    'run_miniprot': { 'label': 'huge_job', 'threads': 'miniprot', 'genome': 6, 'proteins': 4, 'thread_gb': 0.25, 'fixed_gb': 1 },
+}
+# Uncompressed size of gzipped input per compressed byte, FASTQ has about 2 bytes per read base
+PLAN_GZIP_RATIO = 4
+PLAN_FASTQ_BYTES_PER_BASE = 2
+
+def get_executor_limits(config_file):
+    "CPUs and memory in GB set for all processes in the executor config, first file in the config chain"
+    settings = read_config_settings(config_file.split(',')[0])
+    cpus = settings.get('process.cpus', '')
+    memory = parse_config_memory(settings.get('process.memory'))
+    return int(cpus) if cpus.isdigit() else 0, int(memory // 1024**3) if memory else 0
+
+
+def local_input_size(path):
+    "Uncompressed size estimate of local input file, 0 for URLs, accessions and missing files"
+    if not isinstance(path, str) or re.match(r'[a-z0-9]{2,5}://', path) or not os.path.isfile(path):
+        return 0
+    size = os.path.getsize(path)
+    return size * PLAN_GZIP_RATIO if path.endswith('.gz') else size
+
+
+def input_volumes(inputs):
+    "Read bases and protein bytes of local reads and proteins inputs, remote inputs are not counted"
+    reads = inputs.get('reads')
+    files = []
+    for r in reads if isinstance(reads, list) else []:
+        if isinstance(r, str):
+            files.append(r)
+        elif isinstance(r, list):
+            # Either list of mates or [ sample id, [ mates ] ]
+            files += [ f for v in r for f in (v if isinstance(v, list) else [ v ]) ]
+    read_bases = sum(local_input_size(f) for f in set(files)) // PLAN_FASTQ_BYTES_PER_BASE
+    return { 'reads': read_bases, 'proteins': local_input_size(inputs.get('proteins')) }
+
+
+def plan_resources(inputs, executor, config_file):
+    """ Choose task thread counts from genome size, and memory and cpus of job tier processes from genome,
+    read and protein volume, limited by available resources
+    Returns:
+        dict: plan with 'tasks' parameters to merge, 'processes' and 'labels' resources, or None if genome is not a local file
+    """
+    genome = inputs.get('genome')
+    if not genome or re.match(r'[a-z0-9]{2,5}://', genome) or not os.path.isfile(genome):
+        return None
+    stats = get_genome_stats(genome)
+    volumes = input_volumes(inputs)
+    executor_cpus, executor_memory_gb = get_executor_limits(config_file)
+    if executor in LOCAL_EXECUTORS:
+        host_cpus, host_memory = get_host_resources()
+        max_cpus = min(executor_cpus or host_cpus, host_cpus)
+        max_memory_gb = host_memory // 1024**3
+    else:
+        max_cpus = executor_cpus or CLUSTER_MAX_CPUS
+        max_memory_gb = 0
+    tier = sum(1 for t in PLAN_GENOME_TIERS if stats['length'] > t)
+    threads = { k: max(1, min(v[tier], max_cpus)) for k, v in PLAN_THREADS.items() }
+    processes = {}
+    for name, model in PLAN_PROCESSES.items():
+        cpus = threads[model['threads']] if 'threads' in model else min(model['cpus'], max_cpus)
+        memory_bytes = (stats['length'] * model.get('genome', 0) + volumes['reads'] * model.get('reads', 0) +
+                        volumes['proteins'] * model.get('proteins', 0))
+        memory_gb = math.ceil(memory_bytes / 1e9 + cpus * model.get('thread_gb', 0) + model['fixed_gb'])
+        memory_gb = min(memory_gb, CLUSTER_MAX_MEMORY_GB[model['label']])
+        if max_memory_gb:
+            memory_gb = min(memory_gb, max_memory_gb)
+        processes[name] = { 'label': model['label'], 'memory': memory_gb, 'cpus': cpus }
+    # Tier covers all its processes, cpus and memory are taken separately
+    labels = {}
+    for p in processes.values():
+        label = labels.setdefault(p['label'], { 'memory': 0, 'cpus': 0 })
+        label['memory'] = max(label['memory'], p['memory'])
+        label['cpus'] = max(label['cpus'], p['cpus'])
+    defaults = {}
+    if max_memory_gb:
+        # Local executor refuses tasks asking for more than the host has
+        defaults = { 'memory': min(DEFAULT_MEMORY_GB, max_memory_gb), 'cpus': min(DEFAULT_CPUS, max_cpus) }
+    tasks = {
+        'miniprot': { 'miniprot': f"-t {threads['miniprot']}" },
+        'star_index': { 'STAR': f"--runThreadN {threads['star_index']}" },
+        'star_wnode': { 'star_wnode': f"-cpus-per-worker {threads['star']}", 'star-params': f"--runThreadN {threads['star']}" },
+    }
+    return { 'genome': stats, 'volumes': volumes, 'max_cpus': max_cpus, 'max_memory_gb': max_memory_gb, 'threads': threads,
+             'defaults': defaults, 'processes': processes, 'labels': labels, 'tasks': tasks }
+
+
+PLANNED_RESOURCES_CONFIG = "planned_resources.config"
+
+@profiled('plan')
+def apply_resource_plan(args, run_inputs, task_params, config_file):
+    """ Measure genome, merge planned thread counts into default task parameters, so that task parameters
+    from input still override them, and add job tier config when default tiers are in use
+    Returns:
+        (task_params, config_file)
+    """
+    if args.no_plan:
+        return task_params, config_file
+    plan = plan_resources(run_inputs['input'], args.executor, config_file)
+    if not plan:
+        if args.verbosity >= VERBOSITY_VERBOSE:
+            print("Genome is not a local file, resource planning skipped")
+        return task_params, config_file
+    task_params = merge_params(task_params, { 'tasks': plan['tasks'] })
+    g = plan['genome']
+    print(f"Genome: {g['sequences']} sequences, {g['length']/1e6:.1f} Mb, N50 {g['n50']/1e6:.2f} Mb; "
+          f"up to {plan['max_cpus']} cpus" + (f", {plan['max_memory_gb']} GB" if plan['max_memory_gb'] else ""))
+    v = plan['volumes']
+    if args.verbosity >= VERBOSITY_VERBOSE:
+        print(f"Local inputs: ~{v['reads']/1e9:.2f} Gbases of reads, ~{v['proteins']/1e6:.0f} MB of proteins")
+    print("Planned threads: " + ", ".join(f"{k} {v}" for k, v in plan['threads'].items()))
+    if "process_resources.config" in config_file and not args.stub_run:
+        print("Planned job tiers: " + ", ".join(f"{k} {r['memory']} GB/{r['cpus']} cpus" for k, r in plan['labels'].items()))
+        if args.verbosity >= VERBOSITY_VERBOSE:
+            print("Planned processes: " + ", ".join(f"{k} {r['memory']} GB/{r['cpus']} cpus" for k, r in plan['processes'].items()))
+        if args.dry_run:
+            # Nothing is written into output directory of a run that does not happen
+            return task_params, config_file
+        planned_config = Path(run_inputs['output']) / PLANNED_RESOURCES_CONFIG
+        with open(planned_config, 'wt') as f:
+            f.write("// Job tiers planned by egapx.py from genome, reads and proteins size and available resources\nprocess {\n")
+            for k, v in plan['defaults'].items():
+                f.write(f"    {k} = {v}{'.GB' if k == 'memory' else ''}\n")
+            for label, r in plan['labels'].items():
+                f.write(f"    withLabel: '{label}' {{\n        memory = {r['memory']}.GB\n        cpus = {r['cpus']}\n    }}\n")
+            for name, r in plan['processes'].items():
+                f.write(f"    withName: '{name}' {{\n        memory = {r['memory']}.GB\n        cpus = {r['cpus']}\n    }}\n")
+            f.write("}\n")
+        # Insert right after process_resources.config so that right-sized per-process config still wins
+        files = config_file.split(',')
+        files.insert(files.index(next(f for f in files if f.endswith("process_resources.config"))) + 1, str(planned_config.absolute()))
+        config_file = ",".join(files)
+    return task_params, config_file
+
+
+EXECUTOR_ROUTING_CONFIG = "executor_routing.config"
+# Job tiers sent to the cluster in hybrid mode unless earlier runs show the process is light
+HYBRID_CLUSTER_LABELS = ('big_job', 'huge_job', 'long_job')
+# Process is light if in earlier runs no task used more than this
+HYBRID_LIGHT_CPUS = 2
+HYBRID_LIGHT_MEMORY_GB = 16
+HYBRID_LIGHT_TIME_H = 1
+HYBRID_HISTORY_RUNS = 5
+
+def get_config_executor(config_file):
+    "Nextflow executor set for all processes in the executor config, first file in the config chain"
+    return read_config_settings(config_file.split(',')[0]).get('process.executor', 'local')
+
+
+def parse_executor_limits(values, default_executor):
+    "List like ['slurm=200', 'local=8'] to { executor: value }, value without executor is for default_executor"
+    limits = {}
+    for value in values or []:
+        executor, sep, limit = value.rpartition('=')
+        limits[executor if sep else default_executor] = limit
+    return limits
+
+
+def load_process_estimates():
+    "Per-process peak resources over the latest recorded runs whose trace files are still there, see summarize_traces"
+    with contextlib.closing(get_work_history()) as conn:
+        outputs = [ r[0] for r in conn.execute("SELECT output FROM runs ORDER BY recorded DESC") ]
+    traces = [ t for t in (os.path.join(o, "run.trace.txt") for o in outputs) if os.path.isfile(t) ][:HYBRID_HISTORY_RUNS]
+    return summarize_traces(traces)
+
+
+def is_light_process(p):
+    return (p['tasks'] > p['failed'] and p['peak_cpus'] <= HYBRID_LIGHT_CPUS and p['peak_rss'] <= HYBRID_LIGHT_MEMORY_GB * 1024**3
+            and p['realtime'] <= HYBRID_LIGHT_TIME_H * 3600)
+
+
+@profiled('routing')
+def apply_executor_routing(args, output, config_file):
+    """ With --hybrid, run light processes with local executor on this host capped at --hybrid-cpus and --hybrid-memory,
+    and heavy ones with the executor of the config. Processes are heavy by job tier label, or by peak usage in
+    earlier runs where known. Also set per-executor queue size and submit rate limits
+    Returns:
+        config_file with generated routing config appended last
+    """
+    if not (args.hybrid or args.queue_size or args.submit_rate_limit):
+        return config_file
+    cluster = get_config_executor(config_file)
+    lines = [ "// Executor routing generated by egapx.py" ]
+    executors = defaultdict(dict)
+    if args.hybrid and cluster == 'local':
+        print(f"WARNING: --hybrid needs executor config with cluster executor, {args.executor} runs everything locally")
+    elif args.hybrid:
+        host_cpus, host_memory = get_host_resources()
+        cpus = args.hybrid_cpus or host_cpus
+        memory_gb = args.hybrid_memory or host_memory // 1024**3
+        executors['local'] = { 'cpus': cpus, 'memory': f"'{memory_gb} GB'" }
+        estimates = load_process_estimates()
+        light = sorted(name for name, p in estimates.items() if is_light_process(p))
+        heavy = sorted(name for name in estimates if name not in light)
+        labels = "|".join(HYBRID_CLUSTER_LABELS)
+        # Processes run locally have to fit the local executor, or it refuses them
+        lines += [ "process {",
+                   "    executor = 'local'",
+                   f"    withLabel: '!({labels})' {{",
+                   f"        cpus = {min(DEFAULT_CPUS, cpus)}",
+                   f"        memory = {min(DEFAULT_MEMORY_GB, memory_gb)}.GB",
+                   "    }",
+                   f"    withLabel: '{labels}' {{",
+                   f"        executor = '{cluster}'",
+                   "    }" ]
+        for name in heavy:
+            lines += [ f"    withName: '{name}' {{", f"        executor = '{cluster}'" ]
+            # Default tier is capped above for the local executor, job tier labels set their own resources
+            p = estimates[name]
+            if (p['cpus'] or 0) <= DEFAULT_CPUS and (p['memory'] or 0) <= DEFAULT_MEMORY_GB * 1024**3:
+                lines += [ f"        cpus = {DEFAULT_CPUS}", f"        memory = {DEFAULT_MEMORY_GB}.GB" ]
+            lines.append("    }")
+        for name in light:
+            p_memory_gb, p_cpus, _ = right_size(estimates[name])
+            lines += [ f"    withName: '{name}' {{", "        executor = 'local'",
+                       f"        cpus = {min(p_cpus, cpus)}", f"        memory = {min(p_memory_gb, memory_gb)}.GB", "    }" ]
+        lines.append("}")
+        print(f"Hybrid executor: {cluster} for {', '.join(HYBRID_CLUSTER_LABELS)} jobs" +
+              (f" and {len(heavy)} processes heavy in earlier runs" if heavy else "") +
+              f", local up to {cpus} cpus, {memory_gb} GB for the rest" + (f" including {len(light)} processes light in earlier runs" if light else ""))
+        if args.verbosity >= VERBOSITY_VERBOSE:
+            for name in light:
+                print(f"  local: {name}")
+            for name in heavy:
+                print(f"  {cluster}: {name}")
+    for executor, size in parse_executor_limits(args.queue_size, cluster).items():
+        executors[executor]['queueSize'] = int(size)
+    for executor, rate in parse_executor_limits(args.submit_rate_limit, cluster).items():
+        executors[executor]['submitRateLimit'] = f"'{rate}'"
+    if executors:
+        lines.append("executor {")
+        for executor, settings in executors.items():
+            lines.append(f"    ${executor} {{")
+            lines += [ f"        {k} = {v}" for k, v in settings.items() ]
+            lines.append("    }")
+        lines.append("}")
+    if len(lines) == 1:
+        return config_file
+    routing_config = Path(output) / EXECUTOR_ROUTING_CONFIG
+    with open(routing_config, 'wt') as f:
+        f.write("\n".join(lines) + "\n")
+    return config_file + "," + str(routing_config.absolute())
+
+
+GFF_STATS_CHUNK = 32 * 1024 * 1024
+GFF_STATS_NAME = "accept.stats"
+
+def gff_chunks(path, chunk_size=GFF_STATS_CHUNK):
+    "Split file into (start, end) byte ranges of about chunk_size ending at line boundaries"
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', min(start + chunk_size, size - 1))
+            end = size if end < 0 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def empty_gff_stats():
+    return { 'types': defaultdict(int), 'partial': defaultdict(int), 'genes': defaultdict(int), 'seqid_end': defaultdict(int),
+             'regions': {}, 'lengths': { 'gene': array('L'), 'exon': array('L') }, 'exons': defaultdict(int), 'cds': defaultdict(int),
+             'malformed': 0 }
+
+
+def gff_chunk_stats(path, start, end):
+    "Partial statistics for lines in byte range of GFF file, keys are bytes until merged by merge_gff_stats"
+    stats = empty_gff_stats()
+    types, partial, genes, seqid_end = stats['types'], stats['partial'], stats['genes'], stats['seqid_end']
+    regions, lengths, exons, cds = stats['regions'], stats['lengths'], stats['exons'], stats['cds']
+    gene_lengths, exon_lengths = lengths['gene'], lengths['exon']
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    for line in data.split(b'\n'):
+        if not line:
+            continue
+        if line[0] == 35: # '#'
+            if line.startswith(b'##sequence-region'):
                 parts = line.split()
-                if len(parts) < 3:
-                    continue
-                counter[parts[2]] += 1
+                if len(parts) == 4 and parts[3].isdigit():
+                    regions[parts[1]] = int(parts[3])
+                else:
+                    stats['malformed'] += 1
+            continue
+        parts = line.split(b'\t', 8)
+        if len(parts) < 9:
+            # Not a GFF feature line, count feature type if present like the plain type counter does
+            parts = line.split()
+            if len(parts) >= 3:
+                types[parts[2]] += 1
+            continue
+        ftype = parts[2]
+        types[ftype] += 1
+        attrs = parts[8]
+        if b'partial=true' in attrs:
+            partial[ftype] += 1
+        if not (parts[3].isdigit() and parts[4].isdigit()):
+            # Counted by type like any other line, but coordinates can't be used
+            stats['malformed'] += 1
+            continue
+        fstart, fend = int(parts[3]), int(parts[4])
+        if ftype == b'exon' or ftype == b'CDS':
+            flen = max(fend - fstart + 1, 0)
+            i = attrs.find(b'Parent=')
+            if i < 0:
+                parents = [b'']
+            else:
+                j = attrs.find(b';', i)
+                parents = attrs[i+7:j if j >= 0 else len(attrs)].split(b',')
+            if ftype == b'exon':
+                exon_lengths.append(flen)
+                for parent in parents:
+                    exons[parent] += 1
+            else:
+                for parent in parents:
+                    cds[parent] += flen
+        elif ftype == b'gene':
+            seqid = parts[0]
+            genes[seqid] += 1
+            gene_lengths.append(max(fend - fstart + 1, 0))
+            if fend > seqid_end[seqid]:
+                seqid_end[seqid] = fend
+        elif ftype == b'region':
+            seqid = parts[0]
+            regions[seqid] = max(regions.get(seqid, 0), fend)
+    return stats
+
+
+def merge_gff_stats(total, part):
+    for key in ('types', 'partial', 'genes', 'exons', 'cds'):
+        for k, v in part[key].items():
+            total[key][k] += v
+    for k, v in part['seqid_end'].items():
+        total['seqid_end'][k] = max(total['seqid_end'][k], v)
+    for k, v in part['regions'].items():
+        total['regions'][k] = max(total['regions'].get(k, 0), v)
+    for k, v in part['lengths'].items():
+        total['lengths'][k].extend(v)
+    total['malformed'] += part['malformed']
+    return total
+
+
+def summarize_lengths(values):
+    if not values:
+        return { 'count': 0 }
+    values = sorted(values)
+    n = len(values)
+    return { 'count': n, 'min': values[0], 'mean': round(sum(values) / n, 1), 'median': values[n // 2],
+             'p10': values[n // 10], 'p90': values[min(n * 9 // 10, n - 1)], 'max': values[-1] }
+
+
+def gff_statistics(gff_path, workers=None):
+    """ Statistics of GFF file computed in parallel over memory-mapped chunks
+    Returns:
+        dict: feature type counts, per-seqid gene density, length distributions,
+              single/multi-exon transcripts and partial model counts
+    """
+    total = empty_gff_stats()
+    chunks = gff_chunks(gff_path) if os.path.exists(gff_path) else []
+    workers = workers or os.cpu_count() or 1
+    if len(chunks) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            for part in executor.map(gff_chunk_stats, [gff_path] * len(chunks), *zip(*chunks)):
+                merge_gff_stats(total, part)
+    else:
+        for start, end in chunks:
+            merge_gff_stats(total, gff_chunk_stats(gff_path, start, end))
+
+    seqids = {}
+    for seqid in sorted(set(total['seqid_end']) | set(total['regions'])):
+        length = total['regions'].get(seqid, total['seqid_end'].get(seqid, 0))
+        genes = total['genes'].get(seqid, 0)
+        seqids[seqid.decode()] = { 'length': length, 'genes': genes, 'genes_per_mb': round(genes * 1e6 / length, 2) if length else 0 }
+    exon_counts = total['exons'].values()
+    single_exon = sum(1 for c in exon_counts if c == 1)
+    return {
+        'file': str(gff_path),
+        'feature_types': { k.decode(): v for k, v in sorted(total['types'].items()) },
+        'partial': { k.decode(): v for k, v in sorted(total['partial'].items()) },
+        'lengths': { 'gene': summarize_lengths(total['lengths']['gene']),
+                     'exon': summarize_lengths(total['lengths']['exon']),
+                     'cds_per_transcript': summarize_lengths(list(total['cds'].values())) },
+        'transcripts': { 'with_exons': len(total['exons']), 'single_exon': single_exon,
+                         'multi_exon': len(total['exons']) - single_exon,
+                         'single_exon_ratio': round(single_exon / len(total['exons']), 4) if total['exons'] else 0 },
+        'seqids': seqids,
+        'malformed_lines': total['malformed'],
+    }
+
+
+def write_statistics(stats, prefix):
+    "Write statistics as JSON and as flat section/key/value TSV for tracking across releases"
+    with open(f"{prefix}.json", 'wt') as f:
+        json.dump(stats, f, indent=1)
+    with open(f"{prefix}.tsv", 'wt') as f:
+        f.write("section\tkey\tmetric\tvalue\n")
+        for section in ('feature_types', 'partial', 'transcripts'):
+            for k, v in stats[section].items():
+                f.write(f"{section}\t{k}\t\t{v}\n")
+        for section in ('lengths', 'seqids'):
+            for k, metrics in stats[section].items():
+                for m, v in metrics.items():
+                    f.write(f"{section}\t{k}\t{m}\t{v}\n")
+        f.write(f"malformed_lines\t\t\t{stats.get('malformed_lines', 0)}\n")
+
+
+def get_gff_statistics(gff_path, prefix, workers=None):
+    "Statistics from prefix.json if it was computed for the current gff_path, otherwise compute and write them"
+    if not os.path.exists(gff_path):
+        return gff_statistics(gff_path, workers)
+    st = os.stat(gff_path)
+    try:
+        with open(f"{prefix}.json", 'rt') as f:
+            stats = json.load(f)
+        if stats.get('source_size') == st.st_size and stats.get('source_mtime') == st.st_mtime:
+            return stats
+    except (OSError, ValueError):
+        pass
+    stats = gff_statistics(gff_path, workers)
+    stats['source_size'] = st.st_size
+    stats['source_mtime'] = st.st_mtime
+    write_statistics(stats, prefix)
+    return stats
+
+
+def count_features(output):
+    "Count feature types in accept.gff in output directory"
+    return get_gff_statistics(Path(output) / 'accept.gff', Path(output) / GFF_STATS_NAME)['feature_types']
+
+
+@profiled('statistics')
+def print_statistics(output, workers=None):
+    accept_gff = Path(output) / 'accept.gff'
+    print(f"Statistics for {accept_gff}")
+    stats = get_gff_statistics(accept_gff, Path(output) / GFF_STATS_NAME, workers)
+    counter = stats['feature_types']
     keys = list(counter.keys())
     keys.sort()
     for k in keys:
         print(f"{k:12s} {counter[k]}")
+    if not accept_gff.exists():
+        return
+    transcripts = stats['transcripts']
+    print(f"{'single-exon':12s} {transcripts['single_exon']} of {transcripts['with_exons']} transcripts ({transcripts['single_exon_ratio']:.1%})")
+    for k, v in stats['partial'].items():
+        print(f"{'partial ' + k:12s} {v}")
+    if stats.get('malformed_lines'):
+        print(f"WARNING: {stats['malformed_lines']} lines with malformed coordinates skipped in statistics")
+    for k, v in stats['lengths'].items():
+        if v['count']:
+            print(f"{k + ' length':12s} median {v['median']}, mean {v['mean']}, p90 {v['p90']}, max {v['max']}")
+    print(f"Detailed statistics written to {Path(output) / GFF_STATS_NAME}.json and .tsv")
 
 
-def main(argv):
-    "Main script for EGAPx"
-    #warn user that this is an alpha release
-    print("\n!!WARNING!!\nThis is an alpha release with limited features and organism scope to collect initial feedback on execution. Outputs are not yet complete and not intended for production use.\n")
+BUNDLE_DIR = "bundle"
+BUNDLE_GFF_SUFFIXES = ('.gff', '.gff3', '.gtf')
+BUNDLE_FASTA_SUFFIXES = ('.fa', '.fna', '.faa', '.fasta')
+BUNDLE_SORT_LINES = 2000000
+BUNDLE_IDS_SUFFIX = ".ids.sqlite3"
+# Uncompressed data in BGZF block, as written by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Linear index window and smallest bin of tabix, bins of 5 levels above it cover up to TABIX_MAX_END
+TABIX_WINDOW_SHIFT = 14
+TABIX_DEPTH = 5
+TABIX_MAX_END = 1 << 29
 
-    # Parse command line
-    args = parse_args(argv)
+class BgzfWriter:
+    """ Blocked gzip as written by bgzip, readable by any gzip reader. Positions are virtual offsets,
+    compressed offset of block << 16 | offset in the uncompressed block """
+    def __init__(self, path, level=6):
+        self.f = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+        self.uncompressed_offset = 0
+        # (compressed, uncompressed) offsets of blocks after the first one, for .gzi
+        self.blocks = []
 
-    global user_cache_dir
-    if args.local_cache:
-        # print(f"Local cache: {args.local_cache}")
-        user_cache_dir = args.local_cache
-    if args.download_only:
-        if args.local_cache:
-            if not args.dry_run:
-                # print(f"Download only: {args.download_only}")
-                os.makedirs(args.local_cache, exist_ok=True)
-                download_egapx_ftp_data(args.local_cache)
-            else:
-                print(f"Download only to {args.local_cache}")
-            return 0
-        else:
-            print("Local cache not set")
-            return 1
-    else:
-        # Check that input and output set
-        if not args.filename or not args.output:
-            print("Input file and output directory must be set")
-            return 1
+    def tell(self):
+        return (self.block_offset << 16) | len(self.buffer)
 
-    packaged_distro = bool(getattr(sys, '_MEIPASS', ''))
-    script_directory = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-    config_file = get_config(script_directory, args)
-    if not config_file:
-        return 1
-    
-    # Check for workdir, set if not set, and manage last used workdir
-    if not manage_workdir(args):
-        return 1
-   
-    files_to_delete = []
-    
-    # Read default task parameters into a dict
-    task_params = yaml.safe_load(open(Path(script_directory) / 'assets' / 'default_task_params.yaml', 'r'))
-    run_inputs = repackage_inputs(yaml.safe_load(open(args.filename, 'r')))
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.flush_block(BGZF_BLOCK_SIZE)
 
-    if not expand_and_validate_params(run_inputs):
-        return 1
+    def flush_block(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        # gzip header with BC extra field holding block size - 1
+        self.f.write(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        self.f.write(cdata)
+        self.f.write(struct.pack('<II', zlib.crc32(data), len(data)))
+        self.block_offset += len(cdata) + 26
+        self.uncompressed_offset += len(data)
+        self.blocks.append((self.block_offset, self.uncompressed_offset))
 
-    # Command line overrides manifest input
-    if args.output:
-        run_inputs['output'] = args.output
+    def close(self):
+        while self.buffer:
+            self.flush_block(min(len(self.buffer), BGZF_BLOCK_SIZE))
+        # Last entry is the offset of the EOF block, not a block with data
+        if self.blocks:
+            self.blocks.pop()
+        self.f.write(BGZF_EOF)
+        self.f.close()
 
-    # Convert inputs to absolute paths
-    convert_paths(run_inputs)
 
-    # Create output directory if needed
-    os.makedirs(run_inputs['output'], exist_ok=True)
+def bgzf_reader(path, voffset=0):
+    "Uncompressed stream of BGZF file from virtual offset, gzip reads the following blocks as gzip members"
+    f = open(path, 'rb')
+    f.seek(voffset >> 16)
+    reader = gzip.GzipFile(fileobj=f)
+    reader.read(voffset & 0xffff)
+    return contextlib.closing(reader), f
 
-    if args.summary_only:
-        print_statistics(run_inputs['output'])
-        return 0
 
-    # Reformat reads into pairs in fromPairs format and add reads_metadata.tsv file
-    prepare_reads(run_inputs)
+def bin_level_offset(level):
+    "Number of the first bin at level of tabix and CSI binning, level 0 is the single bin of the whole sequence"
+    return ((1 << 3 * level) - 1) // 7
 
 
-    ##if True or args.download_only:
-    ##    with open("./dumped_input.yaml", 'w') as f:
-    ##        yaml.dump(run_inputs, f)
-    ##        f.flush()
-    ##return 0 
+class TabixIndex:
+    """ Tabix index of BGZF compressed GFF or GTF, sequence, start and end in columns 1, 4 and 5.
+    Saved as .tbi when all features end below TABIX_MAX_END, as .csi with deeper binning otherwise, like tabix -C.
+    Bins are kept as (shift, position) and numbered for the binning depth when saved """
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.min_shift = TABIX_WINDOW_SHIFT
+        self.depth = TABIX_DEPTH
+        self.max_end = 0
+        # Lowest virtual offset of each bin, instead of linear index in loaded CSI index
+        self.loffsets = {}
 
-    # Add to default task parameters, if input file has some task parameters they will override the default
-    task_params = merge_params(task_params, run_inputs)
+    def add(self, seqid, beg, end, start_voffset, end_voffset):
+        "Add feature at 0-based half-open interval written between virtual offsets"
+        if seqid not in self.refs:
+            self.names.append(seqid)
+            self.refs[seqid] = ({}, [])
+        bins, linear = self.refs[seqid]
+        # Smallest bin holding the whole interval
+        shift = self.min_shift
+        while beg >> shift != (max(end, beg + 1) - 1) >> shift:
+            shift += 3
+        chunks = bins.setdefault((shift, beg >> shift), [])
+        if chunks and chunks[-1][1] == start_voffset:
+            chunks[-1][1] = end_voffset
+        else:
+            chunks.append([start_voffset, end_voffset])
+        last_window = (max(end, beg + 1) - 1) >> self.min_shift
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> self.min_shift, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_voffset
+        self.max_end = max(self.max_end, end)
 
-    # Move output from YAML file to arguments to have more transparent Nextflow log
-    output = task_params['output']
-    del task_params['output']
+    def bin_number(self, shift, position):
+        return bin_level_offset(self.depth - (shift - self.min_shift) // 3) + position
 
-    if args.func_name:
-        task_params['func_name'] = args.func_name
+    def bin_key(self, number):
+        "(shift, position) of bin number"
+        level = self.depth
+        while bin_level_offset(level) > number:
+            level -= 1
+        return self.min_shift + 3 * (self.depth - level), number - bin_level_offset(level)
 
-    # Run nextflow process
-    if args.verbosity >= VERBOSITY_VERBOSE:
-        task_params['verbose'] = True
-        print("Nextflow inputs:")
-        print(yaml.dump(task_params))
-        if 'reads_metadata' in run_inputs['input']:
+    def bins_of(self, beg, end):
+        "Keys of bins which may contain features overlapping 0-based half-open interval"
+        end = min(end, 1 << (self.min_shift + 3 * self.depth)) - 1
+        for level in range(self.depth + 1):
+            shift = self.min_shift + 3 * (self.depth - level)
+            for position in range(beg >> shift, (end >> shift) + 1):
+                yield shift, position
+
+    def save(self, name):
+        """ Write index of BGZF file name as name.tbi, or name.csi if some feature ends at TABIX_MAX_END or beyond
+        Returns:
+            str: index path
+        """
+        csi = self.max_end > TABIX_MAX_END
+        if csi:
+            # As many levels as the longest sequence needs, like tabix -C
+            while self.max_end > 1 << (self.min_shift + 3 * self.depth):
+                self.depth += 1
+        names = b''.join(name.encode() + b'\0' for name in self.names)
+        # format generic, sequence, start and end columns, comment character and lines to skip
+        header = struct.pack('<7i', 0, 1, 4, 5, ord('#'), 0, len(names)) + names
+        if csi:
+            data = bytearray(b'CSI\1') + struct.pack('<3i', self.min_shift, self.depth, len(header)) + header
+            data += struct.pack('<i', len(self.names))
+        else:
+            data = bytearray(b'TBI\1') + struct.pack('<i', len(self.names)) + header
+        for seqid in self.names:
+            bins, linear = self.refs[seqid]
+            previous = 0
+            filled = []
+            for voffset in linear:
+                previous = voffset if voffset is not None else previous
+                filled.append(previous)
+            data += struct.pack('<i', len(bins))
+            for (shift, position), chunks in sorted(bins.items(), key=lambda b: self.bin_number(*b[0])):
+                if csi:
+                    # Nothing before the offset of the first window of the bin overlaps it
+                    window = (position << shift) >> self.min_shift
+                    data += struct.pack('<IQi', self.bin_number(shift, position), filled[window] if window < len(filled) else 0, len(chunks))
+                else:
+                    data += struct.pack('<Ii', self.bin_number(shift, position), len(chunks))
+                for chunk in chunks:
+                    data += struct.pack('<QQ', *chunk)
+            if not csi:
+                data += struct.pack(f'<i{len(filled)}Q', len(filled), *filled)
+        path = name + (".csi" if csi else ".tbi")
+        writer = BgzfWriter(path + PARTIAL_SUFFIX)
+        writer.write(bytes(data))
+        writer.close()
+        os.replace(path + PARTIAL_SUFFIX, path)
+        # Index of the other kind from an earlier bundle of the same file is stale
+        stale = name + (".tbi" if csi else ".csi")
+        if os.path.exists(stale):
+            os.remove(stale)
+        return path
+
+    @classmethod
+    def load(cls, name):
+        "Index of BGZF file name from name.tbi or name.csi"
+        path = name + ".tbi" if os.path.exists(name + ".tbi") else name + ".csi"
+        with gzip.open(path, 'rb') as f:
+            data = f.read()
+        index = cls()
+        if data[:4] == b'TBI\1':
+            n_ref, = struct.unpack_from('<i', data, 4)
+            pos = 8
+        elif data[:4] == b'CSI\1':
+            index.min_shift, index.depth, l_aux = struct.unpack_from('<3i', data, 4)
+            n_ref, = struct.unpack_from('<i', data, 16 + l_aux)
+            pos = 16
+        else:
+            raise ValueError(f"{path} is not a tabix or CSI index")
+        csi = data[:4] == b'CSI\1'
+        l_nm, = struct.unpack_from('<i', data, pos + 24)
+        index.names = [ n.decode() for n in data[pos + 28:pos + 28 + l_nm].split(b'\0')[:n_ref] ]
+        pos += 28 + l_nm + (4 if csi else 0)
+        for seqid in index.names:
+            n_bin, = struct.unpack_from('<i', data, pos)
+            pos += 4
+            bins = {}
+            loffsets = {}
+            for _ in range(n_bin):
+                if csi:
+                    b, loffset, n_chunk = struct.unpack_from('<IQi', data, pos)
+                    loffsets[index.bin_key(b)] = loffset
+                    pos += 16
+                else:
+                    b, n_chunk = struct.unpack_from('<Ii', data, pos)
+                    pos += 8
+                bins[index.bin_key(b)] = [ list(struct.unpack_from('<QQ', data, pos + 16 * i)) for i in range(n_chunk) ]
+                pos += 16 * n_chunk
+            linear = None
+            if csi:
+                index.loffsets[seqid] = loffsets
+            else:
+                n_intv, = struct.unpack_from('<i', data, pos)
+                linear = list(struct.unpack_from(f'<{n_intv}Q', data, pos + 4))
+                pos += 4 + 8 * n_intv
+            index.refs[seqid] = (bins, linear)
+        return index
+
+    def min_offset(self, seqid, beg):
+        "Virtual offset before which no feature overlaps beg or later positions, None if there are no such features"
+        bins, linear = self.refs[seqid]
+        if linear is not None:
+            window = beg >> self.min_shift
+            return linear[window] if window < len(linear) else None
+        # CSI: lowest offset of the smallest existing bin holding beg
+        loffsets = self.loffsets[seqid]
+        for shift in range(self.min_shift, self.min_shift + 3 * self.depth + 1, 3):
+            if (shift, beg >> shift) in loffsets:
+                return loffsets[(shift, beg >> shift)]
+        return 0
+
+    def start(self, seqid, beg, end):
+        "Virtual offset to scan from for features overlapping 0-based half-open interval, None if there are none"
+        if seqid not in self.refs:
+            return None
+        min_offset = self.min_offset(seqid, beg)
+        if min_offset is None:
+            return None
+        bins = self.refs[seqid][0]
+        chunks = [ c for b in self.bins_of(beg, end) for c in bins.get(b, []) if c[1] > min_offset ]
+        if not chunks:
+            return None
+        return max(min_offset, min(c[0] for c in chunks))
+
+
+def gff_feature_ids(attributes, gtf):
+    "Identifiers of GFF feature to look it up by, (own ids, parent ids)"
+    if gtf:
+        ids = dict(re.findall(r'(gene_id|transcript_id) "([^"]*)"', attributes))
+        return [ v for v in ids.values() if v ], []
+    attrs = dict(a.split('=', 1) for a in attributes.split(';') if '=' in a)
+    ids = [ attrs[k] for k in ('ID', 'Name', 'gene', 'locus_tag') if attrs.get(k) ]
+    ids += re.findall(r'GeneID:(\w+)', attrs.get('Dbxref', ''))
+    return ids, attrs.get('Parent', '').split(',') if attrs.get('Parent') else []
+
+
+def sorted_gff_lines(path, tmp_dir):
+    """ Header directives and feature lines of GFF sorted by sequence and start, through sorted runs in temporary files
+    Returns:
+        (header lines, iterator of (seqid, start, line))
+    """
+    header = []
+    runs = []
+    def key(line):
+        parts = line.split(b'\t', 4)
+        return parts[0], int(parts[3])
+    def save_run(lines):
+        lines.sort(key=key)
+        run = tempfile.TemporaryFile(dir=tmp_dir)
+        run.writelines(lines)
+        run.seek(0)
+        runs.append(run)
+    lines = []
+    with open_maybe_gzip(path) as f:
+        for line in f:
+            if line.startswith(b'#'):
+                if not runs and not lines and not line.startswith(b'###'):
+                    header.append(line)
+                continue
+            parts = line.split(b'\t', 5)
+            # Malformed coordinates are counted by gff_chunk_stats, they can't be sorted or indexed
+            if line.count(b'\t') < 8 or not (parts[3].isdigit() and parts[4].isdigit()):
+                continue
+            lines.append(line if line.endswith(b'\n') else line + b'\n')
+            if len(lines) >= BUNDLE_SORT_LINES:
+                save_run(lines)
+                lines = []
+    lines.sort(key=key)
+    merged = heapq.merge(*runs, lines, key=key)
+    return header, ((*key(line), line) for line in merged)
+
+
+def bundle_gff(path, bundle_dir):
+    "Write GFF or GTF as coordinate-sorted BGZF file with tabix or CSI index and sqlite index of feature ids, return bundle file name"
+    name = os.path.join(bundle_dir, os.path.basename(path) + ".gz")
+    gtf = path.endswith('.gtf')
+    index = TabixIndex()
+    ids = []
+    writer = BgzfWriter(name + PARTIAL_SUFFIX)
+    header, features = sorted_gff_lines(path, bundle_dir)
+    for line in header:
+        writer.write(line)
+    for seqid, start, line in features:
+        begin = writer.tell()
+        writer.write(line)
+        parts = line.rstrip(b'\n').split(b'\t')
+        seqid, end = seqid.decode(), int(parts[4])
+        index.add(seqid, start - 1, end, begin, writer.tell())
+        own, _ = gff_feature_ids(parts[8].decode(errors='replace'), gtf)
+        ids.extend((i, seqid, start, end) for i in own)
+    writer.close()
+    os.replace(name + PARTIAL_SUFFIX, name)
+    index.save(name)
+    if os.path.exists(name + BUNDLE_IDS_SUFFIX):
+        os.remove(name + BUNDLE_IDS_SUFFIX)
+    with contextlib.closing(connect_db(name + BUNDLE_IDS_SUFFIX)) as conn, conn:
+        conn.execute("CREATE TABLE ids (id TEXT, seqid TEXT, start INTEGER, end INTEGER)")
+        conn.executemany("INSERT INTO ids VALUES (?, ?, ?, ?)", ids)
+        conn.execute("CREATE INDEX ids_id ON ids (id)")
+    return name
+
+
+def bundle_fasta(path, bundle_dir):
+    "Write FASTA as BGZF file with .fai and .gzi indexes as samtools faidx does, return bundle file name"
+    name = os.path.join(bundle_dir, re.sub(r'\.gz$', '', os.path.basename(path)) + ".gz")
+    writer = BgzfWriter(name + PARTIAL_SUFFIX)
+    def lines():
+        with open_maybe_gzip(path) as f:
+            for line in f:
+                writer.write(line)
+                yield line
+    records = fai_records(lines())
+    writer.close()
+    os.replace(name + PARTIAL_SUFFIX, name)
+    save_fai(records, name + ".fai")
+    with open(name + ".gzi", 'wb') as f:
+        f.write(struct.pack('<Q', len(writer.blocks)))
+        for block in writer.blocks:
+            f.write(struct.pack('<QQ', *block))
+    return name
+
+
+def write_bundle(output):
+    """ Compressed, indexed copies of GFF, GTF and FASTA outputs in bundle subdirectory of output directory,
+    a file is skipped if its bundle copy is newer
+    Returns:
+        list of bundle files
+    """
+    bundle_dir = os.path.join(output, BUNDLE_DIR)
+    os.makedirs(bundle_dir, exist_ok=True)
+    written = []
+    for entry in sorted(os.scandir(output), key=lambda e: e.name):
+        name = re.sub(r'\.gz$', '', entry.name)
+        if not entry.is_file() or not name.endswith(BUNDLE_GFF_SUFFIXES + BUNDLE_FASTA_SUFFIXES):
+            continue
+        target = os.path.join(bundle_dir, name + ".gz")
+        if os.path.exists(target) and os.path.getmtime(target) >= entry.stat().st_mtime:
+            written.append(target)
+            continue
+        if name.endswith(BUNDLE_GFF_SUFFIXES):
+            written.append(bundle_gff(entry.path, bundle_dir))
+        else:
+            written.append(bundle_fasta(entry.path, bundle_dir))
+        print(f"Bundled {entry.name}: {os.path.getsize(entry.path)/1e6:.1f} MB -> {os.path.getsize(written[-1])/1e6:.1f} MB")
+    return written
+
+
+def parse_region(target):
+    "Region 'seqid:start-end' as (seqid, start, end) with 1-based inclusive coordinates, None if target is not a region"
+    mo = re.fullmatch(r'(.+):([0-9,]+)-([0-9,]+)', target)
+    if not mo:
+        return None
+    return mo.group(1), int(mo.group(2).replace(',', '')), int(mo.group(3).replace(',', ''))
+
+
+def query_gff_region(path, index, seqid, start, end):
+    "Feature lines of BGZF GFF overlapping 1-based inclusive region"
+    voffset = index.start(seqid, start - 1, end)
+    if voffset is None:
+        return
+    reader, f = bgzf_reader(path, voffset)
+    with f, reader as lines:
+        for line in lines:
+            parts = line.split(b'\t', 5)
+            if parts[0].decode() != seqid or int(parts[3]) > end:
+                break
+            if int(parts[4]) >= start:
+                yield line
+
+
+def query_gff(path, target):
+    "Features of GFF bundle file in region, on sequence, or of feature with id and its descendants"
+    index = TabixIndex.load(path)
+    region = parse_region(target)
+    if region:
+        yield from query_gff_region(path, index, *region)
+        return
+    if target in index.refs:
+        yield from query_gff_region(path, index, target, 1, 1 << (index.min_shift + 3 * index.depth))
+        return
+    with contextlib.closing(connect_db(path + BUNDLE_IDS_SUFFIX)) as conn:
+        spans = conn.execute("SELECT seqid, min(start), max(end) FROM ids WHERE id = ? GROUP BY seqid", (target,)).fetchall()
+    gtf = path.endswith('.gtf.gz')
+    for seqid, start, end in spans:
+        lines = list(query_gff_region(path, index, seqid, start, end))
+        features = [ gff_feature_ids(line.rstrip(b'\n').split(b'\t')[8].decode(errors='replace'), gtf) for line in lines ]
+        # Feature with the id, then its descendants through Parent
+        found = [ target in own for own, _ in features ]
+        matched = { i for (own, _), selected in zip(features, found) if selected for i in own }
+        changed = True
+        while changed:
+            changed = False
+            for i, (own, parents) in enumerate(features):
+                if not found[i] and matched.intersection(parents):
+                    found[i] = changed = True
+                    matched.update(own)
+        for line, selected in zip(lines, found):
+            if selected:
+                yield line
+
+
+def query_fasta(path, target):
+    "FASTA record of sequence in BGZF FASTA bundle file, or its part for region"
+    records = {}
+    with open(path + ".fai", 'rt') as f:
+        for line in f:
+            name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')
+            records[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    region = parse_region(target)
+    seqid, start, end = region if region else (target, 1, None)
+    if seqid not in records:
+        return
+    length, offset, line_bases, line_width = records[seqid]
+    end = min(end or length, length)
+    if start > end:
+        return
+    with open(path + ".gzi", 'rb') as f:
+        n, = struct.unpack('<Q', f.read(8))
+        blocks = [(0, 0)] + [ struct.unpack('<QQ', f.read(16)) for _ in range(n) ]
+    def file_offset(pos):
+        return offset + (pos // line_bases) * line_width + pos % line_bases
+    begin = file_offset(start - 1)
+    block = blocks[bisect.bisect_right([ b[1] for b in blocks ], begin) - 1]
+    reader, f = bgzf_reader(path, block[0] << 16)
+    with f, reader as data:
+        data.read(begin - block[1])
+        chunk = data.read(file_offset(end - 1) - begin + 1)
+    sequence = chunk.replace(b'\n', b'').replace(b'\r', b'')
+    yield f">{seqid}{':%d-%d' % (start, end) if region else ''}\n".encode()
+    for i in range(0, len(sequence), 80):
+        yield sequence[i:i+80] + b'\n'
+
+
+def query_main(argv):
+    "egapx.py query - print features or sequences from output bundle"
+    parser = argparse.ArgumentParser(prog="egapx.py query", description="Query compressed, indexed outputs written with --bundle")
+    parser.add_argument("path", help="Output directory, its bundle subdirectory or bundle file")
+    parser.add_argument("targets", nargs='+', help="Region seqid:start-end, sequence id, or gene, transcript or other feature id")
+    args = parser.parse_args(argv)
+    path = args.path
+    if os.path.isdir(os.path.join(path, BUNDLE_DIR)):
+        path = os.path.join(path, BUNDLE_DIR)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, n) for n in os.listdir(path) if n.endswith('.gz'))
+    else:
+        files = [path]
+    if not files:
+        print(f"No bundle files in {args.path}, run with --bundle first", file=sys.stderr)
+        return 1
+    found = False
+    out = sys.stdout.buffer
+    for name in files:
+        if os.path.exists(name + ".tbi") or os.path.exists(name + ".csi"):
+            query = query_gff
+        elif os.path.exists(name + ".fai") and os.path.exists(name + ".gzi"):
+            query = query_fasta
+        else:
+            continue
+        for target in args.targets:
+            for line in query(name, target):
+                found = True
+                out.write(line)
+    out.flush()
+    return 0 if found else 1
+
+
+@profiled('read_defaults')
+def read_default_task_params(script_directory):
+    with open(Path(script_directory) / 'assets' / 'default_task_params.yaml', 'r') as f:
+        return yaml.safe_load(f)
+
+
+@profiled('read_inputs')
+def read_run_inputs(filename):
+    with open(filename, 'r') as f:
+        return repackage_inputs(yaml.safe_load(f))
+
+
+def get_main_nf(script_directory, packaged_distro):
+    if packaged_distro:
+        return Path(script_directory) / 'nf' / 'ui.nf'
+    return Path(script_directory) / '..' / 'nf' / 'ui.nf'
+
+
+def prepare_nextflow_run(args, main_nf, config_file, task_params, run_inputs):
+    """ Prepare reads, merge task parameters and build Nextflow command line for validated run inputs
+    Returns:
+        (task_params, nf_cmd, output): parameters to write into run_params.yaml, command, and output directory
+    """
+    # Reformat reads into pairs in fromPairs format and add reads_metadata.tsv file
+    prepare_reads(run_inputs, args.shard_reads if not args.dry_run else None)
+
+
+    ##if True or args.download_only:
+    ##    with open("./dumped_input.yaml", 'w') as f:
+    ##        yaml.dump(run_inputs, f)
+    ##        f.flush()
+    ##return 0 
+
+    # Add to default task parameters, if input file has some task parameters they will override the default
+    with profile_phase('merge_params'):
+        task_params = merge_params(task_params, run_inputs)
+
+    # Move output from YAML file to arguments to have more transparent Nextflow log
+    # Absolute, so that Nextflow can be launched from another directory
+    output = os.path.abspath(task_params['output'])
+    del task_params['output']
+
+    if args.func_name:
+        task_params['func_name'] = args.func_name
+
+    # Run nextflow process
+    if args.verbosity >= VERBOSITY_VERBOSE:
+        task_params['verbose'] = True
+        print("Nextflow inputs:")
+        print(yaml.dump(task_params))
+        if 'reads_metadata' in run_inputs['input']:
             print("Reads metadata:")
             with open(run_inputs['input']['reads_metadata'], 'r') as f:
                 print(f.read())
-    if packaged_distro:
-        main_nf = Path(script_directory) / 'nf' / 'ui.nf'
-    else:
-        main_nf = Path(script_directory) / '..' / 'nf' / 'ui.nf'
+    nf_cmd = nextflow_command(args, main_nf, config_file, output)
+    return task_params, nf_cmd, output
+
+
+def nextflow_command(args, main_nf, config_file, output):
+    "Nextflow command line for run with run_params.yaml in output directory, creates output directory"
     nf_cmd = ["nextflow", "-C", config_file, "-log", f"{output}/nextflow.log", "run", main_nf, "--output", output]
     if args.stub_run:
         nf_cmd += ["-stub-run", "-profile", "stubrun"]
     if args.report:
-        nf_cmd += ["-with-report", f"{args.report}.report.html", "-with-timeline", f"{args.report}.timeline.html"]
+        report = os.path.abspath(args.report)
+        nf_cmd += ["-with-report", f"{report}.report.html", "-with-timeline", f"{report}.timeline.html"]
     else:
         nf_cmd += ["-with-report", f"{output}/run.report.html", "-with-timeline", f"{output}/run.timeline.html"]
     
     nf_cmd += ["-with-trace", f"{output}/run.trace.txt"]
+    if args.publish_mode != 'copy':
+        # Published as symlinks, turned into files by publish_outputs after the run
+        nf_cmd += ["--publish_mode", "symlink"]
     # if output directory does not exist, it will be created
     if not os.path.exists(output):
         os.makedirs(output)
     params_file = Path(output) / "run_params.yaml"
     nf_cmd += ["-params-file", str(params_file)]
+    return nf_cmd
 
-    if args.dry_run:
+
+def launch_nextflow(args, nf_cmd, output, task_params, workdir="", log_file=None, launch_dir=None, resume=False):
+    """ Write run_params.yaml, checksums of inputs and resume.sh into output directory and run Nextflow
+    Args:
+        workdir: Nextflow work directory for this run, NXF_WORK is used if not set
+        log_file: if set, Nextflow stdout and stderr go there and Nextflow is launched from the output directory,
+                  so that concurrent runs do not share the launch directory
+        launch_dir: directory to launch Nextflow from instead, it keeps Nextflow cache needed for -resume
+        resume: run with -resume
+    Returns:
+        int: Nextflow exit code
+    """
+    params_file = Path(output) / "run_params.yaml"
+    with open(params_file, 'w') as f:
+        yaml.dump(task_params, f)
+        f.flush()
+    with open(Path(output) / RUN_INPUTS_FILE, 'w') as f:
+        f.write(stage_inputs_fingerprint(task_params.get('input', {})) + "\n")
+    if workdir:
+        nf_cmd = nf_cmd + ["-work-dir", workdir]
+    if resume:
+        nf_cmd = nf_cmd + ["-resume"]
+    cwd = launch_dir or (output if log_file else None)
+    if not check_work_quota(args, task_params, workdir or os.environ.get('NXF_WORK') or os.path.join(cwd or os.getcwd(), 'work')):
+        return 1
+    if args.verbosity >= VERBOSITY_VERBOSE:
         print(" ".join(map(str, nf_cmd)))
+    resume_file = Path(output) / "resume.sh"
+    with open(resume_file, 'w') as f:
+        f.write("#!/bin/bash\n")
+        if cwd:
+            f.write(f"cd {shlex.quote(str(cwd))}\n")
+        f.write(" ".join(map(str, nf_cmd)))
+        if not resume:
+            f.write(" -resume")
+        if not workdir and os.environ.get('NXF_WORK'):
+            f.write(" -work-dir " + os.environ['NXF_WORK'])
+        f.write("\n")
+    monitor = None
+    if args.progress or args.status:
+        monitor = ProgressMonitor(output, task_params, interval=args.progress or PROGRESS_INTERVAL, show=bool(args.progress), log_file=log_file,
+                                  label=f"{Path(output).name}: " if log_file else "")
+    if log_file:
+        with open(log_file, 'w') as log, monitor or contextlib.nullcontext():
+            r = subprocess.run(nf_cmd, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+            if monitor:
+                monitor.finish(r.returncode)
+        return r.returncode
+    quiet = args.verbosity <= VERBOSITY_QUIET
+    with monitor or contextlib.nullcontext():
+        if args.progress:
+            # Stream Nextflow output through the runner to see tasks it submits, keep the end of it for errors in quiet mode
+            tail = deque(maxlen=100)
+            with subprocess.Popen(nf_cmd + ["-ansi-log", "false"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=cwd) as proc:
+                for line in proc.stdout:
+                    monitor.feed(line)
+                    if quiet:
+                        tail.append(line)
+                    else:
+                        print(line, end='', flush=True)
+            returncode, errors = proc.returncode, "".join(tail)
+        else:
+            # Monitor follows the trace file only
+            r = subprocess.run(nf_cmd, capture_output=quiet, text=True, cwd=cwd)
+            returncode, errors = r.returncode, r.stderr
+        if monitor:
+            monitor.finish(returncode)
+    if returncode != 0:
+        if quiet:
+            print(errors)
+        print(f"To resume execution, run: sh {resume_file}")
+        return returncode
+    return 0
+
+
+SHARED_WORK_DIR = "work"
+SHARED_LOCK_NAME = "egapx.lock"
+
+def get_cache_root(args):
+    "Persistent root for Nextflow work directories shared by runs of the same inputs, --cache-root or EGAPX_CACHE_ROOT"
+    return args.cache_root or os.environ.get("EGAPX_CACHE_ROOT", "")
+
+
+def setup_cache_root(cache_root):
+    "Keep runner state and container images under cache root unless they are configured elsewhere"
+    os.environ.setdefault("EGAPX_STATE_DIR", os.path.join(cache_root, "state"))
+    os.environ.setdefault("NXF_SINGULARITY_CACHEDIR", os.path.join(cache_root, "singularity"))
+    os.environ.setdefault("NXF_APPTAINER_CACHEDIR", os.path.join(cache_root, "singularity"))
+
+
+def input_fingerprint(task_params):
+    "Fingerprint of run inputs, runs of the same inputs share work directory and resume each other's tasks"
+    doc = { 'version': FINGERPRINT_VERSION, 'input': normalize_inputs(task_params.get('input', {})) }
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def locked_launch_dir(cache_root, key):
+    """ Exclusive lock on launch directory for inputs key under cache root, waits while another run holds it
+    Yields:
+        Path: launch directory, its 'work' subdirectory is the Nextflow work directory
+    """
+    launch_dir = Path(cache_root) / SHARED_WORK_DIR / key
+    os.makedirs(launch_dir, exist_ok=True)
+    with open(launch_dir / SHARED_LOCK_NAME, 'a+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.seek(0)
+            print(f"Waiting for run {f.read().strip()} using {launch_dir}")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.truncate(0)
+        f.write(f"{socket.gethostname()}:{os.getpid()} {datetime.datetime.now().isoformat(timespec='seconds')}\n")
+        f.flush()
+        try:
+            yield launch_dir
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@profiled('nextflow')
+def run_nextflow(args, nf_cmd, output, task_params, workdir="", log_file=None, shared=True):
+    """ Run Nextflow, in shared work directory keyed by inputs with -resume if cache root is set, see launch_nextflow
+    Args:
+        shared: use shared work directory if cache root is set
+    Returns:
+        int: Nextflow exit code
+    """
+    cache_root = get_cache_root(args)
+    if not cache_root or args.stub_run or not shared:
+        return finish_run(args, output, task_params, launch_nextflow(args, nf_cmd, output, task_params, workdir, log_file))
+    key = input_fingerprint(task_params)[:16]
+    with locked_launch_dir(cache_root, key) as launch_dir:
+        if args.verbosity >= VERBOSITY_VERBOSE:
+            print(f"Using shared work directory {launch_dir / 'work'}")
+        return finish_run(args, output, task_params,
+                           launch_nextflow(args, nf_cmd, output, task_params, str(launch_dir / 'work'), log_file,
+                                           launch_dir=launch_dir, resume=(launch_dir / '.nextflow').exists()))
+
+
+PUBLISH_MODES = ('copy', 'link', 'reflink', 'move')
+# ioctl of Linux to share extents of file with another file on btrfs, XFS and similar filesystems
+FICLONE = 0x40049409
+
+def reflink_or_copy(src, dst):
+    "Clone file sharing its extents, copy if the filesystem can't"
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def publish_file(src, dst, mode):
+    """ Replace symlink dst published by Nextflow with file src, by hardlink, reflink or move, each falls back to copy
+    Returns:
+        True if the file was not copied
+    """
+    partial_path = dst + PARTIAL_SUFFIX
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    copied = False
+    if mode == 'move':
+        try:
+            os.rename(src, partial_path)
+        except OSError:
+            shutil.copy2(src, partial_path)
+            os.remove(src)
+            copied = True
+    elif mode == 'reflink':
+        reflink_or_copy(src, partial_path)
     else:
-        with open(params_file, 'w') as f:
-            yaml.dump(task_params, f)
-            f.flush()
+        try:
+            os.link(src, partial_path)
+        except OSError:
+            shutil.copy2(src, partial_path)
+            copied = True
+    os.replace(partial_path, dst)
+    return not copied
+
+
+def publish_outputs(output, mode, path=None, published=None):
+    """ Turn symlinks to task directories published by Nextflow into output directory into regular files,
+    see publish_file, symlinks to directories become directories
+    Returns:
+        (files, copied)
+    """
+    path = path or output
+    published = {} if published is None else published
+    files, copied = 0, 0
+    for entry in os.scandir(path):
+        if not entry.is_symlink():
+            continue
+        target = os.path.normpath(os.path.join(path, os.readlink(entry.path)))
+        if not re.search(r'/[0-9a-f]{2}/[0-9a-f]{30}(/|$)', target):
+            continue
+        src = os.path.realpath(entry.path)
+        moved = published.get(src)
+        if os.path.isdir(src):
+            os.remove(entry.path)
+            os.mkdir(entry.path)
+            for name in os.listdir(src):
+                os.symlink(os.path.join(src, name), os.path.join(entry.path, name))
+            f, c = publish_outputs(output, mode, entry.path, published)
+            files, copied = files + f, copied + c
+        elif moved:
+            # File published under another name too, link to the first copy
+            files += 1
+            copied += not publish_file(moved, entry.path, 'link')
+        elif os.path.isfile(src):
+            files += 1
+            copied += not publish_file(src, entry.path, mode)
+            if mode == 'move':
+                published[src] = entry.path
+    return files, copied
+
+
+def finish_run(args, output, task_params, returncode):
+    """ Publish outputs with --publish-mode, then account work directory usage of successful run
+    and clean it with --work-clean
+    Returns:
+        int: Nextflow exit code
+    """
+    if args.publish_mode != 'copy' and os.path.isdir(output):
+        # Also after failure, so that partial outputs do not point into work directory
+        files, copied = publish_outputs(output, args.publish_mode)
+        if files:
+            print(f"Published {files} files by {args.publish_mode}" + (f", {copied} copied across filesystems" if copied else ""))
+    if returncode != 0 or args.stub_run:
+        return returncode
+    try:
+        record_work_usage(output, task_params)
+        record_run_timings(output, task_params)
+        if args.work_clean is not None:
+            removed, freed = clean_work(Path(output) / "run.trace.txt")
+            print(f"Removed {removed} task directories, {freed/1024**3:.2f} GB")
+    except (OSError, sqlite3.Error) as e:
+        print(f"WARNING: work directory accounting failed: {e}")
+    return returncode
+
+
+CHECKSUM_CACHE = "checksums.sqlite3"
+RESULT_REGISTRY = "results.sqlite3"
+# Bump when the fingerprint contents change
+FINGERPRINT_VERSION = 2
+# Process publishing run outputs, its task directory has them all by name
+EXPORT_PROCESS = 'export'
+
+def cached_file_sha256(path):
+    "Checksum of file, remembered by path, size and modification time in the runner cache"
+    st = os.stat(path)
+    path = os.path.abspath(path)
+    with connect_db(os.path.join(get_runner_cache_dir(), CHECKSUM_CACHE)) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)")
+        row = conn.execute("SELECT sha256 FROM checksums WHERE path = ? AND size = ? AND mtime_ns = ?", (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        sha = file_sha256(path)
+        conn.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)", (path, st.st_size, st.st_mtime_ns, sha))
+        return sha
+
+
+def normalize_inputs(inputs):
+    """ Inputs with local files of file-valued inputs replaced by their checksums, so that renamed or re-staged copies
+    compare equal, other values like sample ids are kept as they are """
+    def normalize(value):
+        if isinstance(value, list):
+            return [ normalize(v) for v in value ]
+        if isinstance(value, str) and os.path.isabs(value) and os.path.isfile(value):
+            return { 'sha256': cached_file_sha256(value) }
+        return value
+    return { k: normalize(v) if k in path_inputs else v for k, v in inputs.items() }
+
+
+def remote_inputs(inputs):
+    """ Inputs that can change on the server without changing the run parameters - URLs and SRA reads,
+    support data under FTP_EGAP_ROOT is versioned and is not counted """
+    remote = [ k for k in ('reads_query', 'reads_ids') if inputs.get(k) ]
+    def collect(value):
+        if isinstance(value, list):
+            for v in value:
+                collect(v)
+        elif isinstance(value, str) and re.match(r'[a-z0-9]{2,5}://', value) and not value.startswith(FTP_EGAP_ROOT):
+            remote.append(value)
+    for k in path_inputs:
+        collect(inputs.get(k))
+    return remote
+
+
+def run_fingerprint(task_params):
+    """ Deterministic fingerprint of a run - effective task parameters with local input files replaced by their checksums,
+    so that resolved HMM and protein references and inputs are covered, plus support data versions """
+    params = { k: v for k, v in task_params.items() if k != 'verbose' }
+    params['input'] = normalize_inputs(params.get('input', {}))
+    doc = { 'version': FINGERPRINT_VERSION, 'params': params, 'data_versions': data_version_cache }
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def published_output_names(output):
+    "Names of files published into output directory by the export task of the run, logs and runner files are not among them"
+    trace_file = Path(output) / "run.trace.txt"
+    if not trace_file.is_file():
+        return []
+    names = set()
+    for row in trace_tasks(trace_file):
+        if trace_process_name(row).split(':')[-1] == EXPORT_PROCESS and row.get('status') in ('COMPLETED', 'CACHED') \
+                and os.path.isdir(row['workdir']):
+            names.update(n for n in os.listdir(row['workdir']) if not n.startswith('.'))
+    return sorted(n for n in names if os.path.lexists(os.path.join(output, n)))
+
+
+class ResultRegistry:
+    "Completed runs by fingerprint, with the output directory and published files they produced"
+    def __init__(self, path):
+        self.path = path
+        with connect_db(self.path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results (fingerprint TEXT PRIMARY KEY, output TEXT, files TEXT, completed TEXT)")
+
+    def lookup(self, fingerprint):
+        "(output directory, published files) of completed run if they are still intact, None otherwise"
+        with connect_db(self.path) as conn:
+            row = conn.execute("SELECT output, files FROM results WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if not row:
+            return None
+        output, files = row[0], json.loads(row[1])
+        if not files or not all(os.path.exists(os.path.join(output, f)) for f in files):
+            return None
+        return output, files
+
+    def record(self, fingerprint, output):
+        files = published_output_names(output)
+        if not files:
+            print("WARNING: published outputs are not found in the run trace, run is not recorded for reuse")
+            return
+        with connect_db(self.path) as conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                         (fingerprint, str(Path(output).absolute()), json.dumps(files), datetime.datetime.now().isoformat(timespec='seconds')))
+
+
+def get_result_registry():
+    return ResultRegistry(os.path.join(get_runner_cache_dir(), RESULT_REGISTRY))
+
+
+def link_or_copy(src, dst):
+    "Hardlink file, copy if hardlink is not possible"
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def link_outputs(cached_output, files, output):
+    "Populate output directory with published files of a cached run, hardlinked where possible"
+    cached_output = Path(cached_output)
+    if cached_output.absolute() == Path(output).absolute():
+        return
+    os.makedirs(output, exist_ok=True)
+    for name in files:
+        src = cached_output / name
+        dst = Path(output) / name
+        if dst.exists():
+            continue
+        if src.is_dir():
+            shutil.copytree(src, dst, copy_function=link_or_copy)
+        else:
+            link_or_copy(src, dst)
+
+
+@profiled('memo')
+def reuse_cached_result(args, task_params, output):
+    """ Look up completed run with the same fingerprint and link its outputs into output
+    Returns:
+        (fingerprint, reused): fingerprint to record after successful run, True if cached outputs are used
+    """
+    if args.no_memo or args.stub_run:
+        return None, False
+    remote = remote_inputs(task_params.get('input', {}))
+    if remote:
         if args.verbosity >= VERBOSITY_VERBOSE:
-            print(" ".join(map(str, nf_cmd)))
-        resume_file = Path(output) / "resume.sh"
-        with open(resume_file, 'w') as f:
-            f.write("#!/bin/bash\n")
-            f.write(" ".join(map(str, nf_cmd)))
-            f.write(" -resume")
-            if os.environ.get('NXF_WORK'):
-                f.write(" -work-dir " + os.environ['NXF_WORK'])
-            f.write("\n")
+            print(f"Run with remote inputs like {remote[0]} is not memoized, use --stage for local copies")
+        return None, False
+    fingerprint = run_fingerprint(task_params)
+    cached = get_result_registry().lookup(fingerprint)
+    if not cached:
+        return fingerprint, False
+    cached, files = cached
+    print(f"Inputs and parameters match completed run in {cached}")
+    if args.dry_run:
+        print(f"Outputs would be linked into {output} instead of running Nextflow")
+    else:
+        link_outputs(cached, files, output)
+        print(f"Outputs linked into {output}, use --no-memo to run again")
+    return fingerprint, True
+
+
+# Tasks that only_gnomon workflow runs after alignments, changes in them do not invalidate alignments
+GNOMON_STAGE_TASKS = { 'chainer', 'gnomon', 'prot_gnomon_prepare', 'annot_builder', 'annotwriter' }
+ALIGNMENT_INPUTS = ('rnaseq_alignments', 'protein_alignments')
+# Trace processes producing the alignments that egapx workflow passes to gnomon_plane
+RNASEQ_ALIGNMENTS_PROCESS = ('rnaseq_collapse:run_gpx_make_outputs', 'output/align.*.out')
+PROTEIN_ALIGNMENTS_PROCESS = ('target_proteins_plane:run_align_sort', 'output/sorted_aligns.asn')
+# Checksums of run inputs at launch, run_params.yaml has only their paths and files can change in place
+RUN_INPUTS_FILE = "run_inputs.sha256"
+
+def stage_inputs_fingerprint(inputs):
+    "Fingerprint of inputs of the alignment stages, alignment inputs of Gnomon-only run are not counted"
+    return input_fingerprint({ 'input': { k: v for k, v in inputs.items() if k not in ALIGNMENT_INPUTS } })
+
+
+def find_trace_outputs(trace_file, process, pattern):
+    "Files matching pattern in work directories of successful tasks of process in Nextflow trace"
+    files = []
+    for row in read_trace(trace_file):
+        if not trace_process_name(row).endswith(process) or row.get('status') not in ('COMPLETED', 'CACHED'):
+            continue
+        workdir = row.get('workdir', '')
+        if workdir and workdir != '-':
+            files += sorted(str(p) for p in Path(workdir).glob(pattern))
+    return files
+
+
+def find_previous_alignments(output, previous_input):
+    """ Locate alignments of the previous run in output directory, either its own alignment inputs
+    if it was Gnomon-only run, or alignment task outputs from its trace
+    Returns:
+        dict with rnaseq_alignments and protein_alignments for the inputs the previous run had, None if some are gone
+    """
+    alignments = {}
+    if any(k in previous_input for k in ALIGNMENT_INPUTS):
+        for k in ALIGNMENT_INPUTS:
+            if k in previous_input:
+                alignments[k] = previous_input[k]
+    else:
+        trace_file = Path(output) / "run.trace.txt"
+        if not trace_file.is_file():
+            return None
+        has_rnaseq = 'reads' in previous_input or 'reads_ids' in previous_input or 'reads_query' in previous_input
+        if has_rnaseq:
+            files = find_trace_outputs(trace_file, *RNASEQ_ALIGNMENTS_PROCESS)
+            if not files:
+                return None
+            alignments['rnaseq_alignments'] = files if len(files) > 1 else files[0]
+        if previous_input.get('proteins'):
+            files = find_trace_outputs(trace_file, *PROTEIN_ALIGNMENTS_PROCESS)
+            if not files:
+                return None
+            alignments['protein_alignments'] = files[0]
+    paths = [ p for v in alignments.values() for p in (v if isinstance(v, list) else [v]) ]
+    if not paths or not all(os.path.isfile(p) for p in paths):
+        return None
+    return alignments
+
+
+@profiled('stage_skip')
+def plan_stage_skip(args, task_params, output):
+    """ Switch to only_gnomon workflow with alignments of the previous run in output directory
+    if inputs and all parameters of the alignment stages are the same as in that run
+    Returns:
+        True if task_params are changed to rerun Gnomon stages only
+    """
+    if args.full_run or args.func_name or args.stub_run:
+        return False
+    params_file = Path(output) / "run_params.yaml"
+    if not params_file.is_file():
+        return False
+    with open(params_file, 'r') as f:
+        previous = yaml.safe_load(f) or {}
+    inputs = task_params.get('input', {})
+    if any(k in inputs for k in ALIGNMENT_INPUTS) or task_params.get('use_orthology'):
+        return False
+    def verbose(message):
+        if args.verbosity >= VERBOSITY_VERBOSE:
+            print(f"Full run: {message}")
+    if str(inputs.get('taxid')) != str(inputs.get('hmm_taxid')):
+        verbose("HMM is trained on this genome with chainer and gnomon parameters")
+        return False
+    inputs_file = Path(output) / RUN_INPUTS_FILE
+    if not inputs_file.is_file() or inputs_file.read_text().strip() != stage_inputs_fingerprint(inputs):
+        verbose("inputs differ from the previous run")
+        return False
+    ignored = { 'input', 'tasks', 'verbose', 'func_name' }
+    if { k: v for k, v in previous.items() if k not in ignored } != { k: v for k, v in task_params.items() if k not in ignored }:
+        verbose("workflow parameters differ from the previous run")
+        return False
+    tasks, previous_tasks = task_params.get('tasks', {}), previous.get('tasks', {})
+    changed = sorted(k for k in set(tasks) | set(previous_tasks) if tasks.get(k) != previous_tasks.get(k))
+    if not changed:
+        # Same parameters, memoization or -resume cover this
+        return False
+    upstream = [ k for k in changed if k not in GNOMON_STAGE_TASKS ]
+    if upstream:
+        verbose(f"parameters of {', '.join(upstream)} changed")
+        return False
+    alignments = find_previous_alignments(output, previous.get('input', {}))
+    if not alignments:
+        verbose("alignments of the previous run are not available")
+        return False
+    task_params['input'].update(alignments)
+    task_params['func_name'] = 'only_gnomon'
+    print(f"Only {', '.join(changed)} parameters changed since the previous run in {output}, rerunning Gnomon with its alignments")
+    print("  use --full-run to run all stages")
+    return True
+
+
+WORK_HISTORY = "work_history.sqlite3"
+# Task directory path in Nextflow work tree, nothing else is ever removed
+WORK_TASK_DIR = re.compile(r'/[0-9a-f]{2}/[0-9a-f]{30}$')
+# Outputs of these processes are reused by later runs, see plan_stage_skip and run_sweep
+# and export task directory names the published outputs for the result registry
+WORK_KEEP_PROCESSES = (RNASEQ_ALIGNMENTS_PROCESS[0], PROTEIN_ALIGNMENTS_PROCESS[0], ':run_gnomon_training', EXPORT_PROCESS)
+
+def parse_disk_size(value):
+    "Parse size like 500G or 2T to bytes, plain number is bytes"
+    mo = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)B?\s*', str(value), re.IGNORECASE)
+    if not mo:
+        raise argparse.ArgumentTypeError(f"invalid size {value}, use size like 500G")
+    return int(float(mo.group(1)) * 1024 ** ' KMGT'.index(mo.group(2).upper() or ' '))
+
+
+def is_task_dir(path):
+    return bool(WORK_TASK_DIR.search(str(path).rstrip('/')))
+
+
+def disk_usage(path, seen):
+    "Allocated bytes of files under path, hardlinked files are counted once over all calls with the same seen set"
+    total = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def trace_tasks(trace_file):
+    "Rows of trace file for tasks with work directory"
+    return [ r for r in read_trace(trace_file) if r.get('workdir', '-') not in ('', '-') ]
+
+
+def work_usage(trace_file):
+    """ Disk usage of task work directories of run
+    Returns:
+        (total bytes, dict process -> { tasks, bytes, largest }), directories shared by tasks are counted once
+    """
+    seen = set()
+    dirs = set()
+    processes = {}
+    for row in trace_tasks(trace_file):
+        if row['workdir'] in dirs:
+            continue
+        dirs.add(row['workdir'])
+        size = disk_usage(row['workdir'], seen)
+        p = processes.setdefault(trace_process_name(row), { 'tasks': 0, 'bytes': 0, 'largest': 0 })
+        p['tasks'] += 1
+        p['bytes'] += size
+        p['largest'] = max(p['largest'], size)
+    return sum(p['bytes'] for p in processes.values()), processes
+
+
+def work_report(trace_files):
+    """ Print disk usage of work directories per run and per process for runs with trace files
+    Returns:
+        int: 0 on success
+    """
+    gb = 1024**3
+    fmt = "{:<60s} {:>6s} {:>10s} {:>10s}"
+    for trace_file in trace_files:
+        if not os.path.exists(trace_file):
+            print(f"Trace file {trace_file} not found")
+            return 1
+        total, processes = work_usage(trace_file)
+        print(f"{trace_file}: {total/gb:.2f} GB in {sum(p['tasks'] for p in processes.values())} task directories")
+        print(fmt.format("process", "tasks", "total", "largest"))
+        for name, p in sorted(processes.items(), key=lambda kv: -kv[1]['bytes']):
+            keep = " (kept)" if name.endswith(WORK_KEEP_PROCESSES) else ""
+            print(fmt.format(name[-60:], str(p['tasks']), f"{p['bytes']/gb:.2f}G", f"{p['largest']/gb:.2f}G") + keep)
+    return 0
+
+
+def get_work_history():
+    conn = connect_db(os.path.join(get_runner_cache_dir(), WORK_HISTORY))
+    conn.execute("CREATE TABLE IF NOT EXISTS runs (output TEXT PRIMARY KEY, genome_length INTEGER, bytes INTEGER, recorded REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stages (output TEXT, process TEXT, tasks INTEGER, start REAL, end REAL, PRIMARY KEY (output, process))")
+    return conn
+
+
+def genome_length(genome, measure=True):
+    "Total sequence length of local genome, None for remote one, or if measure is False and the resource plan did not measure it"
+    if not genome or re.match(r'[a-z0-9]{2,5}://', str(genome)) or not os.path.isfile(genome):
+        return None
+    if not measure and genome not in genome_stats_cache:
+        return None
+    return get_genome_stats(genome)['length']
+
+
+def record_work_usage(output, task_params):
+    """ Account work directory usage of successful run in output directory
+    Returns:
+        int: bytes used by the run
+    """
+    trace_file = Path(output) / "run.trace.txt"
+    if not trace_file.is_file():
+        return 0
+    total, processes = work_usage(trace_file)
+    with contextlib.closing(get_work_history()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)",
+                     (os.path.abspath(output), genome_length(task_params.get('input', {}).get('genome')), total, time.time()))
+    print(f"Work directories use {total/1024**3:.2f} GB in {sum(p['tasks'] for p in processes.values())} task directories, see --work-usage {trace_file}")
+    return total
+
+
+def estimate_work_usage(task_params):
+    "Work directory bytes the run is expected to need, from earlier runs scaled by genome length, None if not known"
+    with contextlib.closing(get_work_history()) as conn:
+        row = conn.execute("SELECT max(CAST(bytes AS REAL) / genome_length) FROM runs WHERE genome_length > 0").fetchone()
+    if not row or not row[0]:
+        return None
+    length = genome_length(task_params.get('input', {}).get('genome'))
+    return int(row[0] * length) if length else None
+
+
+def check_work_quota(args, task_params, work_root):
+    """ Check before launch that the work directory with the space the run is expected to need fits
+    into --work-quota and into free space of its filesystem, only warn about free space without quota
+    Returns:
+        bool: True if the run may go ahead
+    """
+    gb = 1024**3
+    estimate = estimate_work_usage(task_params)
+    existing = Path(work_root).absolute()
+    while not existing.exists():
+        existing = existing.parent
+    free = shutil.disk_usage(existing).free
+    if args.work_quota:
+        used = disk_usage(work_root, set()) if os.path.isdir(work_root) else 0
+        if used + (estimate or 0) > args.work_quota:
+            print(f"ERROR: work directory {work_root} uses {used/gb:.1f} GB" +
+                  (f", the run is expected to need {estimate/gb:.1f} GB more" if estimate else "") +
+                  f", over the quota of {args.work_quota/gb:.1f} GB")
+            print("  use --work-clean with trace files of finished runs to remove their work directories")
+            return False
+    if estimate and estimate > free:
+        print(f"{'ERROR' if args.work_quota else 'WARNING'}: the run is expected to need {estimate/gb:.1f} GB in work directory {work_root}, "
+              f"only {free/gb:.1f} GB is free")
+        return not args.work_quota
+    return True
+
+
+# Tasks the run executed itself, CACHED tasks are directories of earlier runs, which in shared work directory
+# may belong to runs of other outputs
+WORK_OWN_STATUSES = ('COMPLETED', 'FAILED', 'ABORTED')
+
+def clean_work(trace_file):
+    """ Remove task directories of finished run, except outputs of WORK_KEEP_PROCESSES reused by later runs
+    and directories of cached tasks the run did not execute
+    Returns:
+        (removed directories, bytes)
+    """
+    keep = set()
+    remove = set()
+    for row in trace_tasks(trace_file):
+        if trace_process_name(row).endswith(WORK_KEEP_PROCESSES) and row.get('status') in ('COMPLETED', 'CACHED'):
+            keep.add(row['workdir'])
+        elif row.get('status') in WORK_OWN_STATUSES and is_task_dir(row['workdir']):
+            remove.add(row['workdir'])
+    removed, freed = 0, 0
+    seen = set()
+    for workdir in sorted(remove - keep):
+        if not os.path.isdir(workdir):
+            continue
+        freed += disk_usage(workdir, seen)
+        shutil.rmtree(workdir, ignore_errors=True)
+        removed += 1
+    return removed, freed
+
+
+def clean_finished_runs(trace_files):
+    """ Remove work directories of finished runs with trace files, runs still holding their shared work directory are skipped
+    Returns:
+        int: 0 on success
+    """
+    for trace_file in trace_files:
+        if not os.path.exists(trace_file):
+            print(f"Trace file {trace_file} not found")
+            return 1
+        if not (Path(trace_file).parent / 'accept.gff').exists():
+            print(f"Run of {trace_file} has not finished, skipped")
+            continue
+        rows = trace_tasks(trace_file)
+        lock_file = Path(rows[0]['workdir']).parents[2] / SHARED_LOCK_NAME if rows else None
+        with open(lock_file, 'a+') if lock_file and lock_file.exists() else contextlib.nullcontext() as f:
+            if f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f"Work directory of {trace_file} is in use by another run, skipped")
+                    continue
+            removed, freed = clean_work(trace_file)
+        print(f"{trace_file}: removed {removed} task directories, {freed/1024**3:.2f} GB")
+    return 0
+
+
+RUN_STATUS_NAME = "run_status.json"
+PROGRESS_INTERVAL = 60
+# Earlier runs to estimate remaining time from, preferring genome sizes within this factor
+PROGRESS_HISTORY_RUNS = 5
+PROGRESS_SIMILAR_GENOME = 4
+NF_TASK_EVENT = re.compile(r'^\[[0-9a-f]{2}/[0-9a-f]{6}\] (Submitted|Cached) process > (\S+)')
+
+def parse_nf_timestamp(value):
+    "Nextflow trace time like '2024-03-27 11:19:18.123' or raw epoch milliseconds to epoch seconds, None if not available"
+    if not value or value == '-':
+        return None
+    if value.isdigit():
+        return int(value) / 1000
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
         try:
-            subprocess.run(nf_cmd, check=True, capture_output=(args.verbosity <= VERBOSITY_QUIET), text=True)
-        except subprocess.CalledProcessError as e:
-            print(e.stderr)
-            print(f"To resume execution, run: sh {resume_file}")
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    return None
+
+
+def format_seconds(seconds):
+    "Duration like 2d03h, 5h07m or 4m12s"
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return f"{seconds // 86400}d{seconds % 86400 // 3600:02d}h"
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+def record_run_timings(output, task_params):
+    """ Remember when each process ran in successful run relative to its start, for estimating remaining time of later runs.
+    Runs which mostly resumed from cache are not recorded, their timings are not representative """
+    trace_file = Path(output) / "run.trace.txt"
+    if not trace_file.is_file():
+        return
+    rows = read_trace(trace_file)
+    completed = [ r for r in rows if r.get('status') == 'COMPLETED' ]
+    if not completed or len(completed) * 2 < len(rows):
+        return
+    stages = {}
+    for row in completed:
+        submit, complete = parse_nf_timestamp(row.get('submit')), parse_nf_timestamp(row.get('complete'))
+        if submit is None or complete is None:
+            continue
+        stage = stages.setdefault(trace_process_name(row), [0, submit, complete])
+        stage[0] += 1
+        stage[1] = min(stage[1], submit)
+        stage[2] = max(stage[2], complete)
+    if not stages:
+        return
+    start = min(s[1] for s in stages.values())
+    output = os.path.abspath(output)
+    with contextlib.closing(get_work_history()) as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO runs (output, genome_length, recorded) VALUES (?, ?, ?)",
+                     (output, genome_length(task_params.get('input', {}).get('genome')), time.time()))
+        conn.execute("DELETE FROM stages WHERE output = ?", (output,))
+        conn.executemany("INSERT INTO stages VALUES (?, ?, ?, ?, ?)",
+                         [ (output, process, tasks, first - start, last - start) for process, (tasks, first, last) in stages.items() ])
+
+
+def load_run_timings(length):
+    """ Process timings of earlier runs with the most similar genome lengths, or the latest runs if length is not known
+    Returns:
+        list of (genome length, { process: (tasks, start offset, end offset) })
+    """
+    with contextlib.closing(get_work_history()) as conn:
+        runs = conn.execute("SELECT output, genome_length, recorded FROM runs WHERE output IN (SELECT output FROM stages)").fetchall()
+        if length:
+            similar = [ r for r in runs if r[1] and max(r[1], length) / min(r[1], length) <= PROGRESS_SIMILAR_GENOME ]
+            runs = sorted(similar or runs, key=lambda r: abs(math.log(r[1] / length)) if r[1] else math.inf)
+        else:
+            runs.sort(key=lambda r: -r[2])
+        timings = []
+        for output, run_length, _ in runs[:PROGRESS_HISTORY_RUNS]:
+            stages = { process: (tasks, start, end) for process, tasks, start, end in
+                       conn.execute("SELECT process, tasks, start, end FROM stages WHERE output = ?", (output,)) }
+            timings.append((run_length, stages))
+    return timings
+
+
+def estimate_remaining(timings, done, elapsed, length):
+    """ Seconds until the run finishes from where its completed tasks put it in the timeline of each earlier run,
+    scaled by the pace of this run so far, or by genome length before any task completed
+    Returns:
+        (median remaining seconds, median fraction done) or (None, None) without history
+    """
+    remaining = []
+    fractions = []
+    for run_length, stages in timings:
+        total = max((end for _, _, end in stages.values()), default=0)
+        if total <= 0:
+            continue
+        position = 0
+        for process, (tasks, start, end) in stages.items():
+            if done.get(process):
+                position = max(position, start + min(1.0, done[process] / tasks) * (end - start))
+        if position > 0 and elapsed > 0:
+            remaining.append((total - position) * elapsed / position)
+        else:
+            scale = length / run_length if length and run_length else 1.0
+            remaining.append(max(total * scale - elapsed, 0))
+        fractions.append(min(position / total, 1.0))
+    if not remaining:
+        return None, None
+    return sorted(remaining)[len(remaining) // 2], sorted(fractions)[len(fractions) // 2]
+
+
+class ProgressMonitor:
+    """ Follows the run from tasks Nextflow submits and the growing trace file, prints per-process completion and
+    throughput with estimated remaining time if asked to, and keeps machine-readable status file in output directory.
+    Nextflow output lines are passed to feed(), or read from log_file if Nextflow writes there """
+    def __init__(self, output, task_params, interval=PROGRESS_INTERVAL, show=False, log_file=None, label=""):
+        self.trace_file = os.path.join(output, "run.trace.txt")
+        self.status_file = os.path.join(output, RUN_STATUS_NAME)
+        self.interval = interval
+        self.show = show
+        self.log_file = log_file
+        self.label = label
+        # Genome is not read again, with --no-plan the latest runs are the basis of the estimate
+        self.length = genome_length(task_params.get('input', {}).get('genome'), measure=False)
+        self.timings = load_run_timings(self.length)
+        self.started = time.time()
+        # Trace file is overwritten by the run, skip rows of earlier runs that are still there before it is
+        self.trace_offset = 0
+        self.trace_header = None
+        self.log_offset = 0
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.reported = {}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def stage(self, process):
+        return self.stages.setdefault(process, { 'submitted': 0, 'completed': 0, 'cached': 0, 'failed': 0,
+                                                 'first_submit': None, 'last_complete': None, 'read_bytes': 0 })
+
+    def feed(self, line):
+        "Count task submitted or cached by Nextflow from its output line"
+        mo = NF_TASK_EVENT.match(line)
+        if mo:
+            with self.lock:
+                self.stage(mo.group(2))['submitted'] += 1
+
+    def __enter__(self):
+        self.write_status('running')
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.stop.set()
+        self.thread.join()
+        if exc_type:
+            self.write_status('failed')
+
+    def finish(self, returncode):
+        "Final status once Nextflow exited"
+        self.stop.set()
+        self.thread.join()
+        self.poll()
+        self.write_status('succeeded' if returncode == 0 else 'failed', returncode)
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                self.poll()
+                self.write_status('running')
+                if self.show:
+                    self.print_progress()
+            except (OSError, ValueError) as e:
+                print(f"WARNING: progress monitor: {e}")
+
+    def poll(self):
+        if self.log_file and os.path.exists(self.log_file):
+            with open(self.log_file, 'rt', errors='replace') as f:
+                f.seek(self.log_offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    self.log_offset += len(line.encode())
+                    self.feed(line)
+        if not os.path.exists(self.trace_file) or os.path.getmtime(self.trace_file) < self.started - 1:
+            return
+        with open(self.trace_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self.trace_offset:
+                self.trace_offset = 0
+                self.trace_header = None
+            f.seek(self.trace_offset)
+            for line in f:
+                # Rest of the line is not written yet
+                if not line.endswith(b'\n'):
+                    break
+                self.trace_offset += len(line)
+                fields = line.decode(errors='replace').rstrip('\n').split('\t')
+                if self.trace_header is None:
+                    self.trace_header = fields
+                    continue
+                self.add_task(dict(zip(self.trace_header, fields)))
+
+    def add_task(self, row):
+        with self.lock:
+            stage = self.stage(trace_process_name(row))
+            status = row.get('status')
+            if status == 'CACHED':
+                stage['cached'] += 1
+            elif status == 'COMPLETED':
+                stage['completed'] += 1
+            else:
+                stage['failed'] += 1
+            submit, complete = parse_nf_timestamp(row.get('submit')), parse_nf_timestamp(row.get('complete'))
+            if status != 'CACHED' and submit and complete:
+                stage['first_submit'] = min(stage['first_submit'] or submit, submit)
+                stage['last_complete'] = max(stage['last_complete'] or complete, complete)
+            stage['read_bytes'] += parse_nf_memory(row.get('rchar')) or 0
+
+    def expected_tasks(self, process):
+        "Tasks of process in the most similar earlier run"
+        for _, stages in self.timings:
+            if process in stages:
+                return stages[process][0]
+        return None
+
+    def status(self, state, returncode=None):
+        now = time.time()
+        elapsed = now - self.started
+        with self.lock:
+            stages = []
+            for process, s in self.stages.items():
+                done = s['completed'] + s['cached']
+                span = (s['last_complete'] - s['first_submit']) if s['first_submit'] else 0
+                stages.append({ 'process': process, **s,
+                                'running': max(s['submitted'] - done - s['failed'], 0),
+                                'expected': max(s['submitted'], done + s['failed'], self.expected_tasks(process) or 0),
+                                'tasks_per_hour': round(s['completed'] * 3600 / span, 2) if span > 0 else None,
+                                'read_bytes_per_second': round(s['read_bytes'] / span) if span > 0 else None })
+        done = { s['process']: s['completed'] + s['cached'] for s in stages }
+        remaining, fraction = estimate_remaining(self.timings, done, elapsed, self.length)
+        if state != 'running':
+            remaining, fraction = 0, (1.0 if state == 'succeeded' else fraction)
+        return { 'state': state, 'returncode': returncode, 'pid': os.getpid(),
+                 'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                 'updated': datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                 'elapsed_seconds': round(elapsed),
+                 'tasks': { k: sum(s[k] for s in stages) for k in ('submitted', 'completed', 'cached', 'failed', 'running') },
+                 'fraction_done': round(fraction, 3) if fraction is not None else None,
+                 'eta_seconds': round(remaining) if remaining is not None else None,
+                 'eta_basis': { 'runs': len(self.timings), 'genome_length': self.length },
+                 'stages': stages }
+
+    def write_status(self, state, returncode=None):
+        with open(self.status_file + PARTIAL_SUFFIX, 'w') as f:
+            json.dump(self.status(state, returncode), f, indent=1)
+        os.replace(self.status_file + PARTIAL_SUFFIX, self.status_file)
+
+    def print_progress(self):
+        status = self.status('running')
+        tasks = status['tasks']
+        eta = f", about {format_seconds(status['eta_seconds'])} left ({status['fraction_done']:.0%} done)" if status['eta_seconds'] is not None else ""
+        lines = [ f"{self.label}Progress after {format_seconds(status['elapsed_seconds'])}: {tasks['completed'] + tasks['cached']} tasks done, "
+                  f"{tasks['running']} running, {tasks['failed']} failed{eta}" ]
+        for s in status['stages']:
+            done = s['completed'] + s['cached']
+            # Only processes with something going on or finished since the last report
+            if self.reported.get(s['process']) == done and not s['running']:
+                continue
+            self.reported[s['process']] = done
+            rate = f", {s['tasks_per_hour']:.1f} tasks/h, {s['read_bytes_per_second']/1e6:.1f} MB/s read" if s['tasks_per_hour'] else ""
+            lines.append(f"  {s['process']}: {done}/{s['expected']} done, {s['running']} running{rate}")
+        print("\n".join(lines), flush=True)
+
+
+def collect_batch_files(batch):
+    "Expand list of YAML files and directories with YAML files"
+    filenames = []
+    for name in batch:
+        if os.path.isdir(name):
+            filenames += sorted(str(p) for p in Path(name).iterdir() if p.suffix in ('.yaml', '.yml') and p.is_file())
+        else:
+            filenames.append(name)
+    return filenames
+
+
+BATCH_STATUS_NAME = "batch_status.tsv"
+
+def run_batch(args, script_directory, packaged_distro, config_file):
+    """ Annotate many genomes: resolve references for all of them in one pass, then run up to
+    args.max_parallel Nextflow instances at once, each with its own output and work directory """
+    filenames = collect_batch_files(args.batch)
+    if not filenames:
+        print("No input YAML files for batch")
+        return 1
+    output_root = Path(args.output).absolute()
+    os.makedirs(output_root, exist_ok=True)
+    work_root = os.environ.get('NXF_WORK') or str(output_root / 'work')
+    main_nf = get_main_nf(script_directory, packaged_distro)
+
+    runs = []
+    names = set()
+    for filename in filenames:
+        name = Path(filename).stem
+        i = 1
+        while name in names:
+            i += 1
+            name = f"{Path(filename).stem}_{i}"
+        names.add(name)
+        run = { 'name': name, 'yaml': filename, 'status': 'pending', 'exit_code': '', 'elapsed': 0.0, 'output': str(output_root / name) }
+        try:
+            run['inputs'] = read_run_inputs(filename)
+        except (OSError, yaml.YAMLError) as e:
+            print(f"ERROR: can't read {filename}: {e}")
+            run['status'] = 'invalid'
+        runs.append(run)
+
+    # Shared resolution phase - all lineages and references in one pass, results stay in memory for validation
+    start = time.monotonic()
+    taxids = [ r['inputs']['input']['taxid'] for r in runs if 'inputs' in r and r['inputs']['input'].get('taxid') ]
+    get_lineages(taxids)
+    resolve_closest_protein_bags([ r['inputs']['input']['taxid'] for r in runs if 'inputs' in r and r['inputs']['input'].get('taxid')
+                                   and 'proteins' not in r['inputs']['input'] ])
+    resolve_closest_hmms([ r['inputs']['input']['taxid'] for r in runs if 'inputs' in r and r['inputs']['input'].get('taxid')
+                           and 'hmm' not in r['inputs']['input'] ])
+    print(f"Resolved references for {len(set(taxids))} taxids in {time.monotonic() - start:.2f}s")
+
+    for run in runs:
+        if run['status'] != 'pending':
+            continue
+        run_inputs = run['inputs']
+        print(f"Preparing {run['name']} from {run['yaml']}")
+        if not expand_and_validate_params(run_inputs):
+            run['status'] = 'invalid'
+            continue
+        run_inputs['output'] = run['output']
+        convert_paths(run_inputs)
+        os.makedirs(run_inputs['output'], exist_ok=True)
+        if not args.no_preflight and not preflight_inputs(run_inputs):
+            run['status'] = 'invalid'
+            continue
+        if args.stage and not args.dry_run and not stage_inputs(run_inputs, get_stage_dir(args), args.download_workers):
+            run['status'] = 'invalid'
+            continue
+        run_config_file = apply_executor_routing(args, run_inputs['output'], config_file)
+        task_params, run_config_file = apply_resource_plan(args, run_inputs, read_default_task_params(script_directory), run_config_file)
+        run['task_params'], run['nf_cmd'], _ = prepare_nextflow_run(args, main_nf, run_config_file, task_params, run_inputs)
+        run['workdir'] = os.path.join(work_root, run['name'])
+        run['fingerprint'], reused = reuse_cached_result(args, run['task_params'], run['output'])
+        if reused:
+            run['status'] = 'cached'
+        else:
+            plan_stage_skip(args, run['task_params'], run['output'])
+
+    def execute(run):
+        start = time.monotonic()
+        run['status'] = 'running'
+        try:
+            run['exit_code'] = run_nextflow(args, run['nf_cmd'], run['output'], run['task_params'], run['workdir'],
+                                            os.path.join(run['output'], 'nextflow.out'))
+        except Exception as e:
+            # Failed to launch, the run is over all the same
+            print(f"ERROR: {run['name']}: {e!r}")
+            run['exit_code'] = 1
+        run['elapsed'] = time.monotonic() - start
+        run['status'] = 'done' if run['exit_code'] == 0 else 'failed'
+        if run['status'] == 'done' and run['fingerprint']:
+            get_result_registry().record(run['fingerprint'], run['output'])
+        print(f"{run['name']}: {run['status']} in {run['elapsed']:.0f}s")
+
+    ready = [ r for r in runs if r['status'] == 'pending' ]
+    if args.dry_run:
+        for run in ready:
+            print(" ".join(map(str, run['nf_cmd'] + ["-work-dir", run['workdir']])))
+            run['status'] = 'dry-run'
+    else:
+        with ThreadPoolExecutor(max_workers=max(args.max_parallel, 1)) as executor:
+            for f in [ executor.submit(execute, r) for r in ready ]:
+                try:
+                    f.result()
+                except Exception as e:
+                    # A broken run should not stop the others
+                    print(f"ERROR: {e!r}")
+
+    # Consolidated status and statistics table
+    counts = { r['name']: count_features(r['output']) if r['status'] in ('done', 'cached') and not args.stub_run else {} for r in runs }
+    feature_types = sorted({ k for c in counts.values() for k in c })
+    with open(output_root / BATCH_STATUS_NAME, 'wt') as f:
+        f.write("\t".join(['name', 'yaml', 'status', 'exit_code', 'elapsed_s', 'taxid', 'hmm_taxid', 'output'] + feature_types) + "\n")
+        for r in runs:
+            inputs = r.get('inputs', {}).get('input', {})
+            f.write("\t".join(map(str, [r['name'], r['yaml'], r['status'], r['exit_code'], f"{r['elapsed']:.0f}",
+                                        inputs.get('taxid', ''), inputs.get('hmm_taxid', ''), r['output']]
+                                       + [ counts[r['name']].get(k, 0) for k in feature_types ])) + "\n")
+    print(f"Batch status written to {output_root / BATCH_STATUS_NAME}")
+    return 0 if all(r['status'] in ('done', 'cached', 'dry-run') for r in runs) else 1
+
+
+def set_task_option(options, name, value):
+    """ Set option in task parameter string the way merge_params in nf/subworkflows/ncbi/utilities.nf merges them,
+    True or empty value sets a flag, False or None removes the option """
+    tokens = shlex.split(options or '')
+    opts = {}
+    i = 0
+    while i < len(tokens):
+        key = tokens[i]
+        i += 1
+        if i < len(tokens) and tokens[i] and (tokens[i][0] != '-' or ' ' in tokens[i]):
+            opts[key] = tokens[i]
+            i += 1
+        else:
+            opts[key] = ''
+    if value is False or value is None:
+        opts.pop(name, None)
+    else:
+        opts[name] = '' if value is True else str(value)
+    return " ".join(shlex.quote(k) + (" " + shlex.quote(v) if v else "") for k, v in opts.items())
+
+
+def read_sweep_grid(filename):
+    """ Read grid of option values for Gnomon stage tasks, e.g.
+        chainer:
+          chainer_wnode:
+            -minscor: [30, 40, 50]
+        gnomon:
+          annot_wnode:
+            -mpp: [5.0, 10.0]
+    Returns:
+        list of variants, each a list of ((task, section, option), value) overrides, None if grid is not valid
+    """
+    with open(filename, 'r') as f:
+        grid = yaml.safe_load(f) or {}
+    axes = []
+    for task, sections in grid.items():
+        if task not in GNOMON_STAGE_TASKS:
+            print(f"ERROR: {task} parameters can't be swept, only {', '.join(sorted(GNOMON_STAGE_TASKS))} run after alignments")
+            return None
+        for section, options in (sections or {}).items():
+            for option, values in (options or {}).items():
+                axes.append(((task, section, option), values if isinstance(values, list) else [values]))
+    if not axes:
+        print(f"ERROR: no options to sweep in {filename}")
+        return None
+    keys = [ k for k, _ in axes ]
+    return [ list(zip(keys, values)) for values in itertools.product(*(v for _, v in axes)) ]
+
+
+def describe_overrides(overrides):
+    return "; ".join(f"{task}.{section} {option} {value}" for (task, section, option), value in overrides)
+
+
+def find_trained_hmm(output):
+    "HMM parameters from the last Gnomon training iteration of the run in output directory, None if it was not trained"
+    trace_file = Path(output) / "run.trace.txt"
+    if not trace_file.is_file():
+        return None
+    rows = [ r for r in read_trace(trace_file) if trace_process_name(r).endswith(':run_gnomon_training')
+             and r.get('status') in ('COMPLETED', 'CACHED') and r.get('workdir', '-') != '-' ]
+    if not rows:
+        return None
+    last = max(rows, key=lambda r: parse_nf_number(r.get('task_id')) or 0)
+    hmm = Path(last['workdir']) / 'output' / 'hmm_params.asn'
+    return str(hmm) if hmm.is_file() else None
+
+
+SWEEP_SUMMARY_NAME = "sweep_summary.tsv"
+
+def run_sweep(args, script_directory, packaged_distro, config_file):
+    """ Run the full workflow once for the base parameters, then Gnomon stages for every variant
+    of the parameter grid on its alignments, up to args.max_parallel at once, and compare feature counts """
+    variants = read_sweep_grid(args.sweep)
+    if not variants:
+        return 1
+    run_inputs = read_run_inputs(args.filename)
+    if not expand_and_validate_params(run_inputs):
+        return 1
+    output_root = Path(args.output).absolute()
+    run_inputs['output'] = str(output_root / 'base')
+    convert_paths(run_inputs)
+    os.makedirs(run_inputs['output'], exist_ok=True)
+    if not args.no_preflight and not preflight_inputs(run_inputs):
+        return 1
+    if args.stage and not args.dry_run and not stage_inputs(run_inputs, get_stage_dir(args), args.download_workers):
+        return 1
+    config_file = apply_executor_routing(args, run_inputs['output'], config_file)
+    task_params, config_file = apply_resource_plan(args, run_inputs, read_default_task_params(script_directory), config_file)
+    main_nf = get_main_nf(script_directory, packaged_distro)
+    task_params, nf_cmd, base_output = prepare_nextflow_run(args, main_nf, config_file, task_params, run_inputs)
+    work_root = os.environ.get('NXF_WORK') or str(output_root / 'work')
+
+    runs = [ { 'name': 'base', 'overrides': [], 'status': 'pending', 'exit_code': '', 'elapsed': 0.0, 'output': base_output,
+               'task_params': task_params, 'nf_cmd': nf_cmd, 'workdir': os.path.join(work_root, 'base') } ]
+    for i, overrides in enumerate(variants, 1):
+        name = f"variant_{i:0{len(str(len(variants)))}d}"
+        runs.append({ 'name': name, 'overrides': overrides, 'status': 'pending', 'exit_code': '', 'elapsed': 0.0,
+                      'output': str(output_root / name), 'workdir': os.path.join(work_root, name) })
+
+    def execute(run):
+        start = time.monotonic()
+        run['status'] = 'running'
+        # Variants have the same inputs and would wait for each other on shared work directory
+        try:
+            run['exit_code'] = run_nextflow(args, run['nf_cmd'], run['output'], run['task_params'], run['workdir'],
+                                            os.path.join(run['output'], 'nextflow.out'), shared=not run['overrides'])
+        except Exception as e:
+            # Failed to launch, the run is over all the same
+            print(f"ERROR: {run['name']}: {e!r}")
+            run['exit_code'] = 1
+        run['elapsed'] = time.monotonic() - start
+        run['status'] = 'done' if run['exit_code'] == 0 else 'failed'
+        if run['status'] == 'done' and run['fingerprint']:
+            get_result_registry().record(run['fingerprint'], run['output'])
+        print(f"{run['name']}: {run['status']} in {run['elapsed']:.0f}s")
+
+    # Full workflow once, its alignments are shared by all variants
+    base = runs[0]
+    base['fingerprint'], reused = reuse_cached_result(args, task_params, base_output)
+    if args.dry_run:
+        if not reused:
+            print(" ".join(map(str, nf_cmd + ["-work-dir", base['workdir']])))
+        for run in runs[1:]:
+            print(f"{run['name']}: only_gnomon with {describe_overrides(run['overrides'])}")
+        return 0
+    if reused:
+        base['status'] = 'cached'
+    else:
+        print(f"Running base workflow in {base_output}")
+        execute(base)
+        if base['status'] != 'done':
+            print(f"ERROR: base run failed, see {base_output}/nextflow.out")
+            return 1
+    alignments = find_previous_alignments(base_output, task_params['input'])
+    if alignments is None:
+        print(f"ERROR: alignments of base run in {base_output} are not available")
+        return 1
+    hmm = find_trained_hmm(base_output)
+    if hmm:
+        print(f"Variants use HMM trained with base parameters {hmm}")
+
+    for run in runs[1:]:
+        params = copy.deepcopy(task_params)
+        for (task, section, option), value in run['overrides']:
+            section_params = params.setdefault('tasks', {}).setdefault(task, {})
+            section_params[section] = set_task_option(section_params.get(section, ''), option, value)
+        params['input'].update(alignments)
+        if hmm:
+            params['input']['hmm'] = hmm
+            params['input']['hmm_taxid'] = params['input']['taxid']
+        params['func_name'] = 'only_gnomon'
+        run['task_params'] = params
+        run['nf_cmd'] = nextflow_command(args, main_nf, config_file, run['output'])
+        run['fingerprint'], reused = reuse_cached_result(args, params, run['output'])
+        if reused:
+            run['status'] = 'cached'
+    with ThreadPoolExecutor(max_workers=max(args.max_parallel, 1)) as executor:
+        for f in [ executor.submit(execute, r) for r in runs[1:] if r['status'] == 'pending' ]:
+            try:
+                f.result()
+            except Exception as e:
+                # A broken variant should not stop the others
+                print(f"ERROR: {e!r}")
+
+    # Comparison table of feature counts per variant
+    counts = { r['name']: count_features(r['output']) if r['status'] in ('done', 'cached') and not args.stub_run else {} for r in runs }
+    feature_types = sorted({ k for c in counts.values() for k in c })
+    header = ['name', 'status', 'elapsed_s'] + feature_types + ['overrides']
+    rows = [ [r['name'], r['status'], f"{r['elapsed']:.0f}"] + [ str(counts[r['name']].get(k, 0)) for k in feature_types ]
+             + [describe_overrides(r['overrides']) or "-"] for r in runs ]
+    with open(output_root / SWEEP_SUMMARY_NAME, 'wt') as f:
+        for row in [header] + rows:
+            f.write("\t".join(row) + "\n")
+    widths = [ max(len(row[i]) for row in [header] + rows) for i in range(len(header) - 1) ]
+    for row in [header] + rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)) + "  " + row[-1])
+    print(f"Sweep summary written to {output_root / SWEEP_SUMMARY_NAME}")
+    return 0 if all(r['status'] in ('done', 'cached') for r in runs) else 1
+
+
+def main(argv):
+    "Main script for EGAPx"
+    if len(argv) > 1 and argv[1] == 'query':
+        return query_main(argv[2:])
+
+    #warn user that this is an alpha release
+    print("\n!!WARNING!!\nThis is an alpha release with limited features and organism scope to collect initial feedback on execution. Outputs are not yet complete and not intended for production use.\n")
+
+    # Parse command line
+    args = parse_args(argv)
+    if not (args.profile or args.cprofile):
+        return run_egapx(args)
+
+    global runner_profile
+    runner_profile = RunnerProfile()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler:
+        profiler.enable()
+    try:
+        return run_egapx(args)
+    finally:
+        if profiler:
+            profiler.disable()
+        profile_dir = os.path.abspath(args.output or ".")
+        os.makedirs(profile_dir, exist_ok=True)
+        runner_profile.write(os.path.join(profile_dir, RUN_PROFILE_NAME))
+        if profiler:
+            profiler.dump_stats(os.path.join(profile_dir, CPROFILE_NAME))
+            pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(20)
+            print(f"cProfile statistics written to {os.path.join(profile_dir, CPROFILE_NAME)}")
+
+
+def run_egapx(args):
+    "Run EGAPx for parsed command line"
+    global user_cache_dir, metadata_ttl, offline_mode
+    metadata_ttl = args.metadata_ttl
+    offline_mode = args.offline
+    if args.local_cache:
+        # print(f"Local cache: {args.local_cache}")
+        user_cache_dir = args.local_cache
+    if get_cache_root(args):
+        setup_cache_root(get_cache_root(args))
+    if args.download_only:
+        if args.local_cache:
+            if not args.dry_run:
+                # print(f"Download only: {args.download_only}")
+                os.makedirs(args.local_cache, exist_ok=True)
+                return download_egapx_ftp_data(args.local_cache, args.download_workers, args.download_protocol, args.verbosity,
+                                               args.download_verify, args.download_prune)
+            else:
+                print(f"Download only to {args.local_cache}")
+            return 0
+        else:
+            print("Local cache not set")
+            return 1
+    elif args.resource_report:
+        return resource_report(args.resource_report, get_config_dir(args))
+    elif args.work_usage:
+        return work_report(args.work_usage)
+    elif args.work_clean:
+        return clean_finished_runs(args.work_clean)
+    else:
+        # Check that input and output set
+        if not (args.filename or args.batch) or not args.output:
+            print("Input file and output directory must be set")
+            return 1
+
+    packaged_distro = bool(getattr(sys, '_MEIPASS', ''))
+    script_directory = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    config_file = get_config(script_directory, args)
+    if not config_file:
+        return 1
+    
+    # Check for workdir, set if not set, and manage last used workdir
+    if not manage_workdir(args):
+        return 1
+
+    if args.batch:
+        return run_batch(args, script_directory, packaged_distro, config_file)
+    if args.sweep:
+        return run_sweep(args, script_directory, packaged_distro, config_file)
+   
+    files_to_delete = []
+    
+    # Read default task parameters into a dict
+    task_params = read_default_task_params(script_directory)
+    run_inputs = read_run_inputs(args.filename)
+
+    if not expand_and_validate_params(run_inputs):
+        return 1
+
+    # Command line overrides manifest input
+    if args.output:
+        run_inputs['output'] = args.output
+
+    # Convert inputs to absolute paths
+    convert_paths(run_inputs)
+
+    # Create output directory if needed
+    os.makedirs(run_inputs['output'], exist_ok=True)
+
+    if args.summary_only:
+        print_statistics(run_inputs['output'])
+        if args.bundle:
+            write_bundle(run_inputs['output'])
+        return 0
+
+    if not args.no_preflight and not preflight_inputs(run_inputs):
+        return 1
+
+    if args.stage and not args.dry_run:
+        if not stage_inputs(run_inputs, get_stage_dir(args), args.download_workers):
+            return 1
+
+    config_file = apply_executor_routing(args, run_inputs['output'], config_file)
+    task_params, config_file = apply_resource_plan(args, run_inputs, task_params, config_file)
+
+    main_nf = get_main_nf(script_directory, packaged_distro)
+    task_params, nf_cmd, output = prepare_nextflow_run(args, main_nf, config_file, task_params, run_inputs)
+
+    fingerprint, reused = reuse_cached_result(args, task_params, output)
+    if reused:
+        if not args.dry_run:
+            print_statistics(output)
+            if args.bundle:
+                write_bundle(output)
+        return 0
+    plan_stage_skip(args, task_params, output)
+
+    if args.dry_run:
+        print(" ".join(map(str, nf_cmd)))
+    else:
+        if run_nextflow(args, nf_cmd, output, task_params) != 0:
             if files_to_delete:
                 print(f"Don't forget to delete file(s) {' '.join(files_to_delete)}")
             return 1
+        if fingerprint:
+            get_result_registry().record(fingerprint, output)
     if not args.dry_run and not args.stub_run:
         print_statistics(output)
+        if args.bundle:
+            write_bundle(output)
     # TODO: Use try-finally to delete the metadata file
     for f in files_to_delete:
         os.unlink(f)
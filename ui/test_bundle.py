@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Tests of --bundle output and 'egapx.py query' - BGZF files, tabix and CSI indexes checked against plain scans
+#
+# python -m unittest ui/test_bundle.py
+# python -m pytest ui/test_bundle.py
+import contextlib
+import gzip
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+
+
+def write_gff(path, features):
+    "GFF3 with (seqid, start, end, id, parent) features in the given order"
+    with open(path, 'wt') as f:
+        f.write("##gff-version 3\n")
+        for seqid, start, end, fid, parent in features:
+            attributes = f"ID={fid}" + (f";Parent={parent}" if parent else "")
+            f.write(f"{seqid}\ttest\t{'mRNA' if parent else 'gene'}\t{start}\t{end}\t.\t+\t.\t{attributes}\n")
+
+
+def scan(features, seqid, start, end):
+    "Ids of features overlapping 1-based inclusive region, by linear scan"
+    return sorted(fid for s, b, e, fid, _ in features if s == seqid and b <= end and e >= start)
+
+
+def query_ids(path, target):
+    return sorted(line.rstrip(b'\n').split(b'\t')[8].split(b';')[0][3:].decode() for line in egapx.query_gff(path, target))
+
+
+def bgzf_blocks(path):
+    "Sizes of BGZF blocks from their BC extra fields, raises if a block header is not BGZF"
+    sizes = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos < len(data):
+        magic, cm, flg, xlen, si1, si2, slen, bsize = struct.unpack_from('<HBB6xHBBHH', data, pos)
+        if (magic, cm, flg, xlen, si1, si2, slen) != (0x8b1f, 8, 4, 6, 66, 67, 2):
+            raise ValueError(f"not a BGZF block at {pos}")
+        sizes.append(bsize + 1)
+        pos += bsize + 1
+    return sizes
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="egapx_test_bundle_")
+        self.rng = random.Random(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def random_features(self, lengths, count):
+        features = []
+        for i in range(count):
+            seqid = self.rng.choice(sorted(lengths))
+            start = self.rng.randrange(1, lengths[seqid])
+            end = min(start + self.rng.choice([0, 100, 20000, 3000000]), lengths[seqid])
+            features.append((seqid, start, end, f"gene{i}", None))
+            if i % 10 == 0:
+                features.append((seqid, start, end, f"rna{i}", f"gene{i}"))
+        self.rng.shuffle(features)
+        return features
+
+    def bundle(self, features):
+        output = os.path.join(self.tmp, "out")
+        os.makedirs(output, exist_ok=True)
+        write_gff(os.path.join(output, "complete.genomic.gff"), features)
+        with contextlib.redirect_stdout(io.StringIO()):
+            written = egapx.write_bundle(output)
+        self.assertEqual(written, [ os.path.join(output, egapx.BUNDLE_DIR, "complete.genomic.gff.gz") ])
+        return written[0]
+
+    def check_sorted_gzip(self, path, features):
+        "Bundle is gzip readable, made of BGZF blocks with EOF block, and has all features sorted by sequence and start"
+        with gzip.open(path, 'rt') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "##gff-version 3")
+        rows = [ line.split('\t') for line in lines[1:] ]
+        self.assertEqual(len(rows), len(features))
+        keys = [ (r[0], int(r[3])) for r in rows ]
+        self.assertEqual(keys, sorted(keys))
+        sizes = bgzf_blocks(path)
+        with open(path, 'rb') as f:
+            f.seek(-len(egapx.BGZF_EOF), os.SEEK_END)
+            self.assertEqual(f.read(), egapx.BGZF_EOF)
+        self.assertTrue(all(size <= 0x10000 for size in sizes))
+
+    def read_index(self, path):
+        self.assertEqual(bgzf_blocks(path)[-1], len(egapx.BGZF_EOF))
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+
+    def test_tabix_index(self):
+        lengths = { 'chr1': 50000000, 'chr2': 1000000 }
+        features = self.random_features(lengths, 3000)
+        path = self.bundle(features)
+        self.check_sorted_gzip(path, features)
+        self.assertTrue(os.path.exists(path + ".tbi"))
+        self.assertFalse(os.path.exists(path + ".csi"))
+        data = self.read_index(path + ".tbi")
+        self.assertEqual(data[:4], b'TBI\1')
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<8i', data, 4)
+        self.assertEqual((n_ref, fmt, col_seq, col_beg, col_end, chr(meta), skip), (2, 0, 1, 4, 5, '#', 0))
+        self.assertEqual(data[36:36 + l_nm], b'chr1\0chr2\0')
+        for _ in range(200):
+            seqid = self.rng.choice(sorted(lengths))
+            start = self.rng.randrange(1, lengths[seqid])
+            end = start + self.rng.choice([0, 1000, 100000, 10000000])
+            self.assertEqual(query_ids(path, f"{seqid}:{start}-{end}"), scan(features, seqid, start, end))
+
+    def test_csi_index_above_tabix_limit(self):
+        lengths = { 'chr1': 3 * (1 << 29), 'chr2': 1000000 }
+        features = self.random_features(lengths, 3000)
+        features.append(('chr1', (1 << 29) - 10, (1 << 29) + 10, "across", None))
+        features.append(('chr1', 1, lengths['chr1'], "whole", None))
+        path = self.bundle(features)
+        self.check_sorted_gzip(path, features)
+        self.assertTrue(os.path.exists(path + ".csi"))
+        self.assertFalse(os.path.exists(path + ".tbi"))
+        data = self.read_index(path + ".csi")
+        self.assertEqual(data[:4], b'CSI\1')
+        min_shift, depth, l_aux = struct.unpack_from('<3i', data, 4)
+        self.assertEqual(min_shift, egapx.TABIX_WINDOW_SHIFT)
+        # Binning covers the longest sequence, tabix depth 5 does not
+        self.assertGreater(depth, egapx.TABIX_DEPTH)
+        self.assertGreaterEqual(1 << (min_shift + 3 * depth), lengths['chr1'])
+        fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<7i', data, 16)
+        self.assertEqual((fmt, col_seq, col_beg, col_end, chr(meta), skip), (0, 1, 4, 5, '#', 0))
+        self.assertEqual(l_aux, 28 + l_nm)
+        self.assertEqual(data[44:44 + l_nm], b'chr1\0chr2\0')
+        self.assertEqual(struct.unpack_from('<i', data, 16 + l_aux)[0], 2)
+        regions = [ ('chr1', (1 << 29) - 5, (1 << 29) + 5), ('chr1', lengths['chr1'] - 100, lengths['chr1']) ]
+        for _ in range(200):
+            seqid = self.rng.choice(sorted(lengths))
+            start = self.rng.randrange(1, lengths[seqid])
+            regions.append((seqid, start, start + self.rng.choice([0, 1000, 100000, 10000000])))
+        for seqid, start, end in regions:
+            self.assertEqual(query_ids(path, f"{seqid}:{start}-{end}"), scan(features, seqid, start, end))
+        # Whole sequence reaches features past 2^31
+        self.assertEqual(query_ids(path, 'chr1'), scan(features, 'chr1', 1, lengths['chr1']))
+
+    def test_rebundle_removes_stale_index(self):
+        path = self.bundle([ ('chr1', 1, 1 << 30, "big", None) ])
+        self.assertTrue(os.path.exists(path + ".csi"))
+        os.remove(os.path.join(self.tmp, "out", egapx.BUNDLE_DIR, "complete.genomic.gff.gz"))
+        path = self.bundle([ ('chr1', 1, 1000, "small", None) ])
+        self.assertTrue(os.path.exists(path + ".tbi"))
+        self.assertFalse(os.path.exists(path + ".csi"))
+
+    def test_query_by_id_includes_descendants(self):
+        features = [ ('chr1', 100, 900, "g1", None), ('chr1', 100, 500, "t1", "g1"), ('chr1', 600, 900, "t2", "g1"),
+                     ('chr1', 2000, 3000, "g2", None) ]
+        path = self.bundle(features)
+        self.assertEqual(query_ids(path, "g1"), [ "g1", "t1", "t2" ])
+        self.assertEqual(query_ids(path, "t2"), [ "t2" ])
+        self.assertEqual(query_ids(path, "missing"), [])
+
+    def test_fasta_bundle(self):
+        output = os.path.join(self.tmp, "out")
+        os.makedirs(output)
+        sequences = { 'seq1': ''.join(self.rng.choice("ACGT") for _ in range(200000)), 'seq2': "ACGTN" * 30 }
+        with open(os.path.join(output, "proteins.fa"), 'wt') as f:
+            for name, seq in sequences.items():
+                f.write(f">{name} description\n")
+                f.writelines(seq[i:i+60] + "\n" for i in range(0, len(seq), 60))
+        with contextlib.redirect_stdout(io.StringIO()):
+            path, = egapx.write_bundle(output)
+        bgzf_blocks(path)
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(f.read().count('>'), 2)
+        for name, seq in sequences.items():
+            lines = b''.join(egapx.query_fasta(path, name)).decode().splitlines()
+            self.assertEqual(lines[0].split()[0], f">{name}")
+            self.assertEqual("".join(lines[1:]), seq)
+        lines = b''.join(egapx.query_fasta(path, "seq1:100001-100100")).decode().splitlines()
+        self.assertEqual("".join(lines[1:]), sequences['seq1'][100000:100100])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# Tests of support data download and metadata cache against the local FTP and HTTP stand-ins of benchmark.py
+#
+# python -m unittest ui/test_download.py
+# python -m pytest ui/test_download.py
+import contextlib
+import http.server
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from functools import partial
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+import benchmark
+
+
+class RangeHttpHandler(benchmark.QuietHttpHandler):
+    """ Benchmark HTTP stand-in with what the runner relies on for resume and revalidation -
+    ETag, If-None-Match, Range with If-Range, and a log of requests in server.requests """
+    def send_head(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        st = os.stat(path)
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        start = 0
+        mo = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if mo and self.headers.get('If-Range', etag) == etag:
+            start = int(mo.group(1))
+            if start >= st.st_size:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{st.st_size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{st.st_size - 1}/{st.st_size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(st.st_size - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.end_headers()
+        f = open(path, 'rb')
+        f.seek(start)
+        return f
+
+
+class DownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix="egapx_test_download_")
+        cls.root = os.path.join(cls.tmp, "ftp")
+        cls.support = os.path.join(cls.root, egapx.FTP_EGAP_ROOT_PATH)
+        cls.files = {
+            "gnomon/1/hmm_parameters/9606.params": os.urandom(300000),
+            "gnomon/1/hmm_parameters/7955.params": os.urandom(1000),
+            "target_proteins/1/9606.faa.gz": os.urandom(50000),
+        }
+        for name, data in cls.files.items():
+            os.makedirs(os.path.dirname(os.path.join(cls.support, name)), exist_ok=True)
+            with open(os.path.join(cls.support, name), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(cls.support, f"{egapx.DATA_VERSION}.mft"), 'wt') as f:
+            f.write("gnomon/1\ntarget_proteins/1\n")
+        cls.ftp = benchmark.FtpServer(cls.root)
+        cls.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeHttpHandler, directory=cls.root))
+        cls.httpd.daemon_threads = True
+        cls.httpd.requests = []
+        for s in (cls.ftp, cls.httpd):
+            threading.Thread(target=s.serve_forever, daemon=True).start()
+        cls.ftp_server = f"127.0.0.1:{cls.ftp.server_address[1]}"
+        cls.http_server = f"127.0.0.1:{cls.httpd.server_address[1]}"
+        cls.saved = (egapx.FTP_EGAP_PROTOCOL, egapx.FTP_EGAP_SERVER, egapx.FTP_EGAP_ROOT, egapx.DOWNLOAD_BACKOFF)
+        egapx.DOWNLOAD_BACKOFF = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        for s in (cls.ftp, cls.httpd):
+            s.shutdown()
+            s.server_close()
+        egapx.FTP_EGAP_PROTOCOL, egapx.FTP_EGAP_SERVER, egapx.FTP_EGAP_ROOT, egapx.DOWNLOAD_BACKOFF = cls.saved
+        benchmark.reset_runner('')
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(dir=self.tmp, prefix="cache_")
+        benchmark.use_server('http', self.http_server)
+        benchmark.reset_runner(self.cache)
+        self.httpd.requests.clear()
+
+    def remote_path(self, name):
+        return f"{egapx.FTP_EGAP_ROOT_PATH}/{name}"
+
+    def local_path(self, name):
+        return os.path.join(self.cache, name)
+
+    def write_partial(self, name, data, version):
+        partial_path = self.local_path(name) + egapx.PARTIAL_SUFFIX
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        egapx.set_partial_version(partial_path, version)
+        return partial_path
+
+    def read_local(self, name):
+        with open(self.local_path(name), 'rb') as f:
+            return f.read()
+
+    def http_etag(self, name):
+        st = os.stat(os.path.join(self.support, name))
+        return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+    def mirror(self, protocol):
+        "download_egapx_ftp_data over protocol, returns (exit code, printed lines)"
+        if protocol == 'ftp':
+            benchmark.use_server('ftp', self.ftp_server)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            r = egapx.download_egapx_ftp_data(self.cache, 2, 'https' if protocol == 'http' else 'ftp')
+        return r, out.getvalue().splitlines()
+
+    def assert_mirrored(self):
+        for name, data in self.files.items():
+            self.assertEqual(self.read_local(name), data, name)
+        self.assertEqual([ p for p in os.listdir(os.path.dirname(self.local_path("gnomon/1/hmm_parameters/x")))
+                           if p.endswith((egapx.PARTIAL_SUFFIX, egapx.PARTIAL_VERSION_SUFFIX)) ], [])
+
+    def test_mirror_ftp(self):
+        r, lines = self.mirror('ftp')
+        self.assertEqual(r, 0)
+        self.assert_mirrored()
+        # Manifest did not change, nothing is listed again
+        r, lines = self.mirror('ftp')
+        self.assertEqual(r, 0)
+        self.assertIn("Up to date gnomon/1", lines)
+        self.assertIn("Up to date target_proteins/1", lines)
+
+    def test_mirror_http(self):
+        r, lines = self.mirror('http')
+        self.assertEqual(r, 0)
+        self.assert_mirrored()
+        # Listing takes what it needs from the index page, files are fetched with one GET each
+        self.assertFalse([ req for req in self.httpd.requests if req[0] == 'HEAD' ])
+        self.assertEqual(len([ req for req in self.httpd.requests if req[0] == 'GET' and not req[1].endswith(('/', '.mft')) ]),
+                         len(self.files))
+
+    def test_mirror_resumes_partial(self):
+        name = "gnomon/1/hmm_parameters/9606.params"
+        data = self.files[name]
+        self.write_partial(name, data[:100000], self.http_etag(name))
+        r, _ = self.mirror('http')
+        self.assertEqual(r, 0)
+        self.assert_mirrored()
+        ranges = [ req[2].get('Range') for req in self.httpd.requests if req[1].endswith(name) ]
+        self.assertEqual(ranges, [ "bytes=100000-" ])
+
+    def test_http_resume_same_version(self):
+        name = "gnomon/1/hmm_parameters/9606.params"
+        data = self.files[name]
+        self.write_partial(name, data[:1000], self.http_etag(name))
+        conn = egapx.HttpDownloader('http')
+        conn.connect(self.http_server)
+        self.assertTrue(conn.download_file(self.remote_path(name), self.local_path(name)))
+        self.assertEqual(self.read_local(name), data)
+        headers = self.httpd.requests[-1][2]
+        self.assertEqual((headers.get('Range'), headers.get('If-Range')), ("bytes=1000-", self.http_etag(name)))
+
+    def test_http_partial_of_changed_file_restarts(self):
+        name = "gnomon/1/hmm_parameters/9606.params"
+        self.write_partial(name, b'x' * 1000, '"old"')
+        conn = egapx.HttpDownloader('http')
+        conn.connect(self.http_server)
+        self.assertTrue(conn.download_file(self.remote_path(name), self.local_path(name)))
+        self.assertEqual(self.read_local(name), self.files[name])
+
+    def test_http_partial_longer_than_file_restarts(self):
+        name = "gnomon/1/hmm_parameters/7955.params"
+        partial_path = self.write_partial(name, b'x' * 5000, self.http_etag(name))
+        conn = egapx.HttpDownloader('http')
+        conn.connect(self.http_server)
+        self.assertTrue(conn.download_file(self.remote_path(name), self.local_path(name)))
+        self.assertEqual(self.read_local(name), self.files[name])
+        self.assertFalse(os.path.exists(partial_path))
+
+    def test_ftp_resume_same_version(self):
+        name = "gnomon/1/hmm_parameters/9606.params"
+        conn = egapx.FtpDownloader()
+        conn.connect(self.ftp_server)
+        version = conn.version("/" + self.remote_path(name))
+        # Partial of the same version is continued, not fetched again, junk in it shows that
+        self.write_partial(name, b'x' * 1000, ":".join(map(str, version)))
+        self.assertTrue(conn.download_file("/" + self.remote_path(name), self.local_path(name)))
+        self.assertEqual(self.read_local(name), b'x' * 1000 + self.files[name][1000:])
+
+    def test_ftp_partial_of_changed_file_restarts(self):
+        name = "gnomon/1/hmm_parameters/9606.params"
+        self.write_partial(name, b'x' * 1000, "1:20000101000000")
+        conn = egapx.FtpDownloader()
+        conn.connect(self.ftp_server)
+        self.assertTrue(conn.download_file("/" + self.remote_path(name), self.local_path(name)))
+        self.assertEqual(self.read_local(name), self.files[name])
+
+    def test_fetch_url_revalidates_with_304(self):
+        url = f"{egapx.FTP_EGAP_ROOT}/{egapx.DATA_VERSION}.mft"
+        body = egapx.fetch_url(url, ttl=0)
+        self.assertEqual(body, b"gnomon/1\ntarget_proteins/1\n")
+        # Fresh entry is used without a request
+        self.assertEqual(egapx.fetch_url(url, ttl=3600), body)
+        self.assertEqual(len(self.httpd.requests), 1)
+        self.assertEqual(egapx.fetch_url(url, ttl=0), body)
+        self.assertEqual(len(self.httpd.requests), 2)
+        self.assertEqual(self.httpd.requests[-1][2].get('If-None-Match'), self.http_etag(f"{egapx.DATA_VERSION}.mft"))
+
+    def stage(self, url):
+        "stage_inputs of proteins at url, returns (staged, local path, printed text)"
+        run_inputs = { 'input': { 'proteins': url } }
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            r = egapx.stage_inputs(run_inputs, os.path.join(self.cache, egapx.STAGING_DIR))
+        return r, run_inputs['input']['proteins'], out.getvalue()
+
+    def test_stage_revalidates_remote_version(self):
+        name = "stage/proteins.faa"
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b">p1\nMKV\n")
+        url = f"http://{self.http_server}/{name}?version=1"
+        r, local, _ = self.stage(url)
+        self.assertTrue(r)
+        self.assertEqual(os.path.basename(local), "proteins.faa")
+        self.assertIn(("GET", f"/{name}?version=1"), [ req[:2] for req in self.httpd.requests ])
+        # Unchanged remote file, staged copy is used after a HEAD request
+        self.httpd.requests.clear()
+        self.assertEqual(self.stage(url)[1], local)
+        self.assertEqual([ req[0] for req in self.httpd.requests ], [ "HEAD" ])
+        # Changed remote file is staged again
+        with open(path, 'wb') as f:
+            f.write(b">p1\nMKVL\n")
+        r, changed, text = self.stage(url)
+        self.assertNotEqual(changed, local)
+        self.assertIn("Remote file changed since it was staged", text)
+        with open(changed, 'rb') as f:
+            self.assertEqual(f.read(), b">p1\nMKVL\n")
+        # Stored file of the wrong size is not used
+        with open(changed, 'ab') as f:
+            f.write(b"X")
+        self.httpd.requests.clear()
+        self.assertEqual(self.stage(url)[1], changed)
+        self.assertIn("GET", [ req[0] for req in self.httpd.requests ])
+        with open(changed, 'rb') as f:
+            self.assertEqual(f.read(), b">p1\nMKVL\n")
+        # Offline, staged copy is used without requests
+        egapx.offline_mode = True
+        self.httpd.requests.clear()
+        self.assertTrue(self.stage(url)[0])
+        self.assertEqual(self.httpd.requests, [])
+
+    def test_fetch_url_offline(self):
+        url = f"{egapx.FTP_EGAP_ROOT}/{egapx.DATA_VERSION}.mft"
+        body = egapx.fetch_url(url, ttl=0)
+        egapx.offline_mode = True
+        self.assertEqual(egapx.fetch_url(url, ttl=0), body)
+        self.assertEqual(len(self.httpd.requests), 1)
+        with self.assertRaises(OSError):
+            egapx.fetch_url(f"{egapx.FTP_EGAP_ROOT}/missing.mft")
+        self.assertEqual(len(self.httpd.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
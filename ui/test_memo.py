@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Tests of run memoization - fingerprints of inputs and task parameters and the registry of completed runs
+#
+# python -m unittest ui/test_memo.py
+# python -m pytest ui/test_memo.py
+import argparse
+import contextlib
+import copy
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+
+TRACE_HEADER = "task_id\tprocess\tname\tstatus\tworkdir\n"
+
+
+def memo_args(**kwargs):
+    return argparse.Namespace(**{ 'no_memo': False, 'stub_run': False, 'dry_run': False, 'verbosity': egapx.VERBOSITY_DEFAULT, **kwargs })
+
+
+class MemoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="egapx_test_memo_")
+        self.saved = (egapx.user_cache_dir, dict(egapx.data_version_cache))
+        egapx.user_cache_dir = os.path.join(self.tmp, "cache")
+        os.makedirs(egapx.user_cache_dir)
+        egapx.data_version_cache.clear()
+        egapx.data_version_cache['gnomon'] = '1'
+        self.genome = self.write("genome.fa", ">chr1\nACGTACGT\n")
+        self.proteins = self.write("proteins.faa", ">p1\nMKV\n")
+        self.params = { 'input': { 'genome': self.genome, 'proteins': self.proteins, 'taxid': 9606, 'hmm_taxid': 9606,
+                                   'reads': [ [ 'sample', [ self.write("r_1.fq", "@r\nACGT\n+\nIIII\n") ] ] ] },
+                         'tasks': { 'gnomon': { 'gnomon': '-b 0.5' } } }
+
+    def tearDown(self):
+        egapx.user_cache_dir = self.saved[0]
+        egapx.data_version_cache.clear()
+        egapx.data_version_cache.update(self.saved[1])
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt') as f:
+            f.write(text)
+        return path
+
+    def completed_run(self, name, published):
+        "Output directory of successful run with trace of export task that published the files"
+        output = os.path.join(self.tmp, name)
+        export_dir = os.path.join(self.tmp, "work", "ab", "cdef0123456789abcdef0123456789")
+        os.makedirs(export_dir, exist_ok=True)
+        for f in published:
+            self.write(os.path.join(name, f), f"{f}\n")
+            self.write(os.path.join("work", "ab", "cdef0123456789abcdef0123456789", f), f"{f}\n")
+        self.write(os.path.join(name, "nextflow.log"), "log\n")
+        self.write(os.path.join(name, "run.trace.txt"), TRACE_HEADER +
+                   f"1\tegapx:gnomon\tegapx:gnomon (1)\tCOMPLETED\t{self.tmp}/work/12/3456\n"
+                   f"2\texport\texport (1)\tCOMPLETED\t{export_dir}\n")
+        return output
+
+    def test_fingerprint_is_stable_for_renamed_copy(self):
+        fingerprint = egapx.run_fingerprint(self.params)
+        params = copy.deepcopy(self.params)
+        params['input']['genome'] = shutil.copy(self.genome, os.path.join(self.tmp, "renamed.fa"))
+        self.assertEqual(egapx.run_fingerprint(params), fingerprint)
+
+    def test_changed_input_file_changes_fingerprint(self):
+        fingerprint = egapx.run_fingerprint(self.params)
+        with open(self.genome, 'at') as f:
+            f.write("ACGT\n")
+        self.assertNotEqual(egapx.run_fingerprint(self.params), fingerprint)
+
+    def test_changed_read_file_changes_fingerprint(self):
+        fingerprint = egapx.run_fingerprint(self.params)
+        with open(self.params['input']['reads'][0][1][0], 'at') as f:
+            f.write("@r2\nACGT\n+\nIIII\n")
+        self.assertNotEqual(egapx.run_fingerprint(self.params), fingerprint)
+
+    def test_changed_task_parameter_changes_fingerprint(self):
+        fingerprint = egapx.run_fingerprint(self.params)
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        self.assertNotEqual(egapx.run_fingerprint(params), fingerprint)
+        params = copy.deepcopy(self.params)
+        params['input']['taxid'] = 9605
+        self.assertNotEqual(egapx.run_fingerprint(params), fingerprint)
+
+    def test_changed_data_version_changes_fingerprint(self):
+        fingerprint = egapx.run_fingerprint(self.params)
+        egapx.data_version_cache['gnomon'] = '2'
+        self.assertNotEqual(egapx.run_fingerprint(self.params), fingerprint)
+
+    def test_only_file_inputs_are_hashed(self):
+        normalized = egapx.normalize_inputs(self.params['input'])
+        self.assertEqual(normalized['genome'], { 'sha256': egapx.cached_file_sha256(self.genome) })
+        self.assertEqual(normalized['reads'][0][0], 'sample')
+        self.assertIsInstance(normalized['reads'][0][1][0], dict)
+        self.assertEqual(normalized['taxid'], 9606)
+        # Verbosity does not change what the run computes
+        params = copy.deepcopy(self.params)
+        params['verbose'] = True
+        self.assertEqual(egapx.run_fingerprint(params), egapx.run_fingerprint(self.params))
+
+    def test_remote_inputs_skip_memoization(self):
+        output = self.completed_run("remote", [ "complete.genomic.gff" ])
+        for key, value in (('genome', "https://example.org/genome.fa"), ('reads_query', "SRR1[Accession]"), ('reads_ids', [ "SRR1" ])):
+            params = copy.deepcopy(self.params)
+            params['input'][key] = value
+            self.assertEqual(egapx.remote_inputs(params['input'])[:1], [ value if key == 'genome' else key ])
+            self.assertEqual(egapx.reuse_cached_result(memo_args(), params, output), (None, False))
+        # Versioned support data is not remote input
+        params = copy.deepcopy(self.params)
+        params['input']['proteins'] = f"{egapx.FTP_EGAP_ROOT}/target_proteins/1/9606.faa"
+        self.assertEqual(egapx.remote_inputs(params['input']), [])
+
+    def test_registry_reuses_published_outputs_only(self):
+        output = self.completed_run("first", [ "complete.genomic.gff", "complete.proteins.faa" ])
+        fingerprint, reused = egapx.reuse_cached_result(memo_args(), self.params, output)
+        self.assertFalse(reused)
+        egapx.get_result_registry().record(fingerprint, output)
+        self.assertEqual(egapx.get_result_registry().lookup(fingerprint), (output, [ "complete.genomic.gff", "complete.proteins.faa" ]))
+        second = os.path.join(self.tmp, "second")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(egapx.reuse_cached_result(memo_args(), self.params, second), (fingerprint, True))
+        self.assertEqual(sorted(os.listdir(second)), [ "complete.genomic.gff", "complete.proteins.faa" ])
+
+    def test_registry_entry_with_missing_outputs_is_not_reused(self):
+        output = self.completed_run("first", [ "complete.genomic.gff", "complete.proteins.faa" ])
+        fingerprint = egapx.run_fingerprint(self.params)
+        egapx.get_result_registry().record(fingerprint, output)
+        os.remove(os.path.join(output, "complete.proteins.faa"))
+        self.assertIsNone(egapx.get_result_registry().lookup(fingerprint))
+        second = os.path.join(self.tmp, "second")
+        self.assertEqual(egapx.reuse_cached_result(memo_args(), self.params, second), (fingerprint, False))
+        self.assertFalse(os.path.exists(second))
+
+    def test_run_without_published_outputs_is_not_recorded(self):
+        output = self.completed_run("empty", [])
+        fingerprint = egapx.run_fingerprint(self.params)
+        with contextlib.redirect_stdout(io.StringIO()):
+            egapx.get_result_registry().record(fingerprint, output)
+        self.assertIsNone(egapx.get_result_registry().lookup(fingerprint))
+
+
+if __name__ == "__main__":
+    unittest.main()
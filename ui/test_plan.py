@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Tests of resource planning - job tiers and thread counts from genome, reads and proteins size and resource limits
+#
+# python -m unittest ui/test_plan.py
+# python -m pytest ui/test_plan.py
+import argparse
+import contextlib
+import io
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+
+GB = 1024**3
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="egapx_test_plan_")
+        self.saved = (egapx.user_cache_dir, dict(egapx.genome_stats_cache))
+        egapx.user_cache_dir = os.path.join(self.tmp, "cache")
+        os.makedirs(egapx.user_cache_dir)
+        # 3 sequences, 2.5 Mb
+        self.genome = self.write("genome.fa", "".join(f">chr{i}\n" + "ACGTACGTAC" * (n // 10) + "\n"
+                                                     for i, n in enumerate([ 1500000, 700000, 300000 ], 1)))
+        # 2 MB of FASTQ is 1 Mbases
+        self.reads = [ self.write("lib_1.fq", "@r\n" + "A" * 999996 + "\n"), self.write("lib_2.fq", "@r\n" + "A" * 999996 + "\n") ]
+        self.proteins = self.write("proteins.faa", ">p\n" + "M" * 499997 + "\n")
+        self.inputs = { 'genome': self.genome, 'reads': [ self.reads ], 'proteins': self.proteins }
+
+    def tearDown(self):
+        egapx.user_cache_dir = self.saved[0]
+        egapx.genome_stats_cache.clear()
+        egapx.genome_stats_cache.update(self.saved[1])
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wt') as f:
+            f.write(text)
+        return path
+
+    def executor_config(self, settings):
+        return self.write("executor.config", "process {\n" + "".join(f"    {k} = {v}\n" for k, v in settings.items()) + "}\n") + \
+            ",process_resources.config"
+
+    def plan(self, executor, settings, host=(16, 64 * GB)):
+        with mock.patch.object(egapx, 'get_host_resources', return_value=host):
+            return egapx.plan_resources(self.inputs, executor, self.executor_config(settings))
+
+    def expected_memory(self, name, cpus, volumes, limit_gb=0):
+        model = egapx.PLAN_PROCESSES[name]
+        memory = math.ceil((2500000 * model.get('genome', 0) + volumes['reads'] * model.get('reads', 0) +
+                            volumes['proteins'] * model.get('proteins', 0)) / 1e9 + cpus * model.get('thread_gb', 0) + model['fixed_gb'])
+        memory = min(memory, egapx.CLUSTER_MAX_MEMORY_GB[model['label']])
+        return min(memory, limit_gb) if limit_gb else memory
+
+    def test_local_limits(self):
+        plan = self.plan('local', { 'cpus': 6 })
+        self.assertEqual((plan['genome']['sequences'], plan['genome']['length']), (3, 2500000))
+        self.assertEqual(plan['volumes'], { 'reads': 1000000, 'proteins': 500001 })
+        # Executor cpus under host cpus, and host memory
+        self.assertEqual((plan['max_cpus'], plan['max_memory_gb']), (6, 64))
+        self.assertEqual(plan['threads'], { 'miniprot': 6, 'star': 6, 'star_index': 4 })
+        self.assertEqual(plan['defaults'], { 'memory': egapx.DEFAULT_MEMORY_GB, 'cpus': 6 })
+        self.assertEqual(plan['tasks']['star_wnode'], { 'star_wnode': "-cpus-per-worker 6", 'star-params': "--runThreadN 6" })
+        self.assertEqual(plan['tasks']['miniprot'], { 'miniprot': "-t 6" })
+        self.assertEqual(plan['tasks']['star_index'], { 'STAR': "--runThreadN 4" })
+        cpus = { 'build_index': 4, 'merge': 6, 'run_star': 6, 'run_miniprot': 6 }
+        for name, p in plan['processes'].items():
+            self.assertEqual(p, { 'label': egapx.PLAN_PROCESSES[name]['label'], 'cpus': cpus[name],
+                                  'memory': self.expected_memory(name, cpus[name], plan['volumes'], 64) }, name)
+        # Tier covers its largest process
+        self.assertEqual(plan['labels']['huge_job'], { 'cpus': 6, 'memory': max(plan['processes'][n]['memory'] for n in ('run_star', 'run_miniprot')) })
+        self.assertEqual(plan['labels']['big_job'], { 'cpus': 6, 'memory': max(plan['processes'][n]['memory'] for n in ('build_index', 'merge')) })
+
+    def test_small_host(self):
+        plan = self.plan('local', {}, host=(2, 4 * GB))
+        self.assertEqual((plan['max_cpus'], plan['max_memory_gb']), (2, 4))
+        self.assertEqual(plan['threads'], { 'miniprot': 2, 'star': 2, 'star_index': 2 })
+        self.assertEqual(plan['defaults'], { 'memory': 4, 'cpus': 2 })
+        self.assertTrue(all(p['memory'] <= 4 and p['cpus'] <= 2 for p in plan['processes'].values()))
+
+    def test_cluster_limits(self):
+        plan = self.plan('slurm', { 'cpus': 12 })
+        self.assertEqual((plan['max_cpus'], plan['max_memory_gb']), (12, 0))
+        self.assertEqual(plan['threads'], { 'miniprot': 8, 'star': 8, 'star_index': 4 })
+        self.assertEqual(plan['defaults'], {})
+        self.assertEqual(plan['processes']['run_star'],
+                         { 'label': 'huge_job', 'cpus': 8, 'memory': self.expected_memory('run_star', 8, plan['volumes']) })
+        plan = self.plan('slurm', {})
+        self.assertEqual(plan['max_cpus'], egapx.CLUSTER_MAX_CPUS)
+
+    def test_remote_genome_is_not_planned(self):
+        self.inputs['genome'] = "https://example.org/genome.fa"
+        self.assertIsNone(self.plan('local', {}))
+
+    def test_dry_run_writes_no_config(self):
+        output = os.path.join(self.tmp, "out")
+        os.makedirs(output)
+        args = argparse.Namespace(no_plan=False, executor='local', stub_run=False, dry_run=True, verbosity=egapx.VERBOSITY_DEFAULT)
+        config_file = self.executor_config({ 'cpus': 6 })
+        with mock.patch.object(egapx, 'get_host_resources', return_value=(16, 64 * GB)), contextlib.redirect_stdout(io.StringIO()):
+            task_params, planned = egapx.apply_resource_plan(args, { 'input': self.inputs, 'output': output }, {}, config_file)
+            self.assertEqual(planned, config_file)
+            self.assertEqual(os.listdir(output), [])
+            self.assertEqual(task_params['tasks']['miniprot'], { 'miniprot': "-t 6" })
+            args.dry_run = False
+            _, planned = egapx.apply_resource_plan(args, { 'input': self.inputs, 'output': output }, {}, config_file)
+        planned_config = os.path.join(output, egapx.PLANNED_RESOURCES_CONFIG)
+        self.assertEqual(planned.split(','), [ config_file.split(',')[0], "process_resources.config", planned_config ])
+        settings = egapx.read_config_settings(planned_config)
+        self.assertEqual(settings['process.withLabel:huge_job.cpus'], '6')
+        self.assertEqual(settings['process.withName:build_index.cpus'], '4')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Tests of closest HMM and target protein set lookup - ReferenceIndex against the linear scans it replaced,
+# on a synthetic taxonomy database and reference lists in the support data cache layout
+#
+# python -m unittest ui/test_reference.py
+# python -m pytest ui/test_reference.py
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+import benchmark
+
+
+def scan_closest_hmm(lineage, references):
+    "Closest HMM taxid by the original scan over (taxid, lineage) of the HMM list, None if only the root is shared"
+    best_taxid = None
+    best_score = 0
+    for t, l in references:
+        pos1 = 0
+        last_match = 0
+        for tax_id in lineage:
+            while tax_id != l[pos1]:
+                if pos1 + 1 < len(l):
+                    pos1 += 1
+                else:
+                    break
+            if tax_id == l[pos1]:
+                last_match = pos1
+            else:
+                break
+        if last_match > best_score:
+            best_score = last_match
+            best_taxid = t
+    return best_taxid
+
+
+def scan_closest_proteins(lineage, references):
+    "Closest protein set taxid by the original scan over taxids of the protein list, None if there is none below the root"
+    best_taxid = None
+    best_score = 0
+    for t in references:
+        if t in lineage and lineage.index(t) > best_score:
+            best_score = lineage.index(t)
+            best_taxid = t
+    return best_taxid
+
+
+class ReferenceTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(prefix="egapx_test_reference_")
+        benchmark.reset_runner(self.cache)
+        egapx.data_version_cache.update({ 'taxonomy': '1', 'gnomon': '1', 'target_proteins': '1' })
+        rng = random.Random(1)
+        # Random tree under the root, and a branch of its own without references
+        self.parents = { 1: 1, 2: 1 }
+        for taxid in range(3, 400):
+            self.parents[taxid] = rng.choice(range(2, taxid)) if rng.random() < 0.95 else 1
+        self.parents.update({ 1000: 1, 1001: 1000, 1002: 1001 })
+        self.lineages = { t: self.lineage(t) for t in self.parents }
+        self.hmm = rng.sample(range(2, 400), 30)
+        self.proteins = rng.sample(range(2, 400), 30)
+        self.write_taxonomy()
+        self.write("gnomon/1/hmm_parameters/taxid.list",
+                   "".join(f"{t}\t{' '.join(f'{a};' for a in self.lineages[t][:-1])}\n" for t in self.hmm))
+        self.write("target_proteins/1/taxid.list", "#taxid\tname\n" + "".join(f"{t}\tspecies {t}\n" for t in self.proteins))
+
+    def tearDown(self):
+        benchmark.reset_runner('')
+        shutil.rmtree(self.cache, ignore_errors=True)
+
+    def lineage(self, taxid):
+        lineage = [ taxid ]
+        while lineage[-1] != 1:
+            lineage.append(self.parents[lineage[-1]])
+        return lineage[::-1]
+
+    def write(self, name, text):
+        path = os.path.join(self.cache, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt') as f:
+            f.write(text)
+
+    def write_taxonomy(self):
+        path = os.path.join(self.cache, "taxonomy", "1", "taxonomy4blast.sqlite3")
+        os.makedirs(os.path.dirname(path))
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE TaxidInfo (taxid INTEGER PRIMARY KEY, parent INTEGER)")
+        conn.executemany("INSERT INTO TaxidInfo VALUES (?, ?)", self.parents.items())
+        conn.commit()
+        conn.close()
+
+    def resolve(self, taxids):
+        "Closest HMM and protein set taxids for taxids, 0 and None if not found"
+        hmms = egapx.resolve_closest_hmms(taxids)
+        bags = egapx.resolve_closest_protein_bags(taxids)
+        bag_taxids = { egapx.get_file_path("target_proteins", f"{t}.faa.gz"): t for t in self.proteins }
+        return { t: (hmms[t][0], bag_taxids.get(bags[t])) for t in taxids }
+
+    def expected(self, taxid):
+        hmm_list = [ (t, self.lineages[t]) for t in self.hmm ]
+        return (scan_closest_hmm(self.lineages[taxid], hmm_list) or 0, scan_closest_proteins(self.lineages[taxid], self.proteins))
+
+    def test_same_as_scan(self):
+        taxids = sorted(self.parents)
+        resolved = self.resolve(taxids)
+        for taxid in taxids:
+            self.assertEqual(resolved[taxid], self.expected(taxid), taxid)
+        self.assertTrue(os.listdir(os.path.join(self.cache, egapx.REFERENCE_INDEX_DIR)))
+        # Index saved in the runner cache gives the same answers
+        egapx.reference_indexes.clear()
+        self.assertEqual(self.resolve(taxids), resolved)
+
+    def test_exact_match(self):
+        for t in self.hmm:
+            self.assertEqual(self.resolve([t])[t][0], t)
+        for t in self.proteins:
+            self.assertEqual(self.resolve([t])[t][1], t)
+
+    def test_ancestor_match(self):
+        # Leaf that is not a reference gets the one sharing its deepest ancestor
+        leaves = set(self.parents) - set(self.parents.values()) - set(self.hmm)
+        matched = [ t for t in sorted(leaves) if self.expected(t)[0] ]
+        self.assertTrue(matched)
+        for t in matched:
+            hmm = self.resolve([t])[t][0]
+            self.assertEqual(hmm, self.expected(t)[0])
+            self.assertNotEqual(hmm, t)
+            # The reference shares more than the root with the taxid
+            self.assertGreater(len(set(self.lineages[hmm]) & set(self.lineages[t])), 1)
+
+    def test_no_match(self):
+        self.assertEqual(self.resolve([1000, 1002]), { 1000: (0, None), 1002: (0, None) })
+        self.assertEqual(egapx.get_closest_hmm(1002), (0, ""))
+        self.assertEqual(egapx.get_closest_protein_bag(1002), "")
+        self.assertEqual(egapx.get_closest_hmm(0), (0, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
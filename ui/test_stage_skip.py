@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Tests of Gnomon-only reruns - plan_stage_skip against run_params.yaml and trace of the previous run
+#
+# python -m unittest ui/test_stage_skip.py
+# python -m pytest ui/test_stage_skip.py
+import argparse
+import contextlib
+import copy
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import egapx
+
+TRACE_HEADER = "task_id\tprocess\tname\tstatus\tworkdir\n"
+
+
+def skip_args(**kwargs):
+    return argparse.Namespace(**{ 'full_run': False, 'func_name': '', 'stub_run': False, 'verbosity': egapx.VERBOSITY_DEFAULT, **kwargs })
+
+
+class StageSkipTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="egapx_test_stage_skip_")
+        self.saved = egapx.user_cache_dir
+        egapx.user_cache_dir = os.path.join(self.tmp, "cache")
+        os.makedirs(egapx.user_cache_dir)
+        self.output = os.path.join(self.tmp, "out")
+        self.params = { 'input': { 'genome': self.write("genome.fa", ">chr1\nACGT\n"), 'proteins': self.write("proteins.faa", ">p1\nMKV\n"),
+                                   'reads': [ [ 'sample', [ self.write("r_1.fq", "@r\nACGT\n+\nIIII\n") ] ] ],
+                                   'taxid': 9606, 'hmm_taxid': 9606 },
+                        'tasks': { 'star_wnode': { 'star_wnode': '-cpus-per-worker 4' }, 'gnomon': { 'gnomon': '-b 0.5' },
+                                   'chainer': { 'chainer_wnode': '-minlen 165' } } }
+        rnaseq = self.write("work/11/1111111111111111111111111111111/output/align.1.out", "rnaseq\n")
+        proteins = self.write("work/22/2222222222222222222222222222222/output/sorted_aligns.asn", "proteins\n")
+        self.alignments = { 'rnaseq_alignments': rnaseq, 'protein_alignments': proteins }
+        self.write("out/run_params.yaml", yaml.safe_dump(self.params))
+        self.write(f"out/{egapx.RUN_INPUTS_FILE}", egapx.stage_inputs_fingerprint(self.params['input']) + "\n")
+        self.write("out/run.trace.txt", TRACE_HEADER +
+                   f"1\tegapx:rnaseq_short_plane:star_wnode:run_star\trun_star (1)\tCOMPLETED\t{self.tmp}/work/33/3333333333333333333333333333333\n"
+                   f"2\tegapx:rnaseq_collapse:run_gpx_make_outputs\trun_gpx_make_outputs (1)\tCACHED\t{os.path.dirname(os.path.dirname(rnaseq))}\n"
+                   f"3\tegapx:target_proteins_plane:run_align_sort\trun_align_sort (1)\tCOMPLETED\t{os.path.dirname(os.path.dirname(proteins))}\n")
+
+    def tearDown(self):
+        egapx.user_cache_dir = self.saved
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt') as f:
+            f.write(text)
+        return path
+
+    def plan(self, params, **kwargs):
+        "plan_stage_skip on copy of params, returns (result, params after the call, printed text)"
+        params = copy.deepcopy(params)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            r = egapx.plan_stage_skip(skip_args(verbosity=egapx.VERBOSITY_VERBOSE, **kwargs), params, self.output)
+        return r, params, out.getvalue()
+
+    def test_gnomon_parameter_change_runs_only_gnomon(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        params['tasks']['chainer']['chainer_wnode'] = '-minlen 200'
+        r, planned, text = self.plan(params)
+        self.assertTrue(r)
+        self.assertEqual(planned['func_name'], 'only_gnomon')
+        self.assertEqual({ k: planned['input'][k] for k in egapx.ALIGNMENT_INPUTS }, self.alignments)
+        self.assertIn("Only chainer, gnomon parameters changed", text)
+        # Gnomon-only run is the previous run for the next one, its alignment inputs are reused as they are
+        self.write("out/run_params.yaml", yaml.safe_dump(planned))
+        os.remove(os.path.join(self.output, "run.trace.txt"))
+        params['tasks']['gnomon']['gnomon'] = '-b 0.7'
+        r, planned, _ = self.plan(params)
+        self.assertTrue(r)
+        self.assertEqual({ k: planned['input'][k] for k in egapx.ALIGNMENT_INPUTS }, self.alignments)
+
+    def test_new_gnomon_task_runs_only_gnomon(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['annot_builder'] = { 'annot_builder': '-x' }
+        r, planned, _ = self.plan(params)
+        self.assertTrue(r)
+        self.assertEqual(planned['func_name'], 'only_gnomon')
+
+    def test_upstream_parameter_change_runs_all(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        params['tasks']['star_wnode']['star_wnode'] = '-cpus-per-worker 8'
+        r, planned, text = self.plan(params)
+        self.assertFalse(r)
+        self.assertEqual(planned, params)
+        self.assertIn("Full run: parameters of star_wnode changed", text)
+
+    def test_workflow_parameter_change_runs_all(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        params['annotation_provider'] = 'other'
+        r, planned, text = self.plan(params)
+        self.assertFalse(r)
+        self.assertEqual(planned, params)
+        self.assertIn("workflow parameters differ", text)
+
+    def test_input_change_runs_all(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        with open(params['input']['genome'], 'at') as f:
+            f.write("ACGT\n")
+        r, _, text = self.plan(params)
+        self.assertFalse(r)
+        self.assertIn("inputs differ", text)
+
+    def test_unrecorded_inputs_run_all(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        os.remove(os.path.join(self.output, egapx.RUN_INPUTS_FILE))
+        self.assertFalse(self.plan(params)[0])
+
+    def test_hmm_trained_on_genome_runs_all(self):
+        params = copy.deepcopy(self.params)
+        params['input']['hmm_taxid'] = 9598
+        self.write("out/run_params.yaml", yaml.safe_dump(params))
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        r, planned, text = self.plan(params)
+        self.assertFalse(r)
+        self.assertEqual(planned, params)
+        self.assertIn("HMM is trained on this genome", text)
+
+    def test_unchanged_or_forced_runs_all(self):
+        self.assertFalse(self.plan(self.params)[0])
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        self.assertFalse(self.plan(params, full_run=True)[0])
+        self.assertFalse(self.plan(params, stub_run=True)[0])
+
+    def test_missing_alignments_runs_all(self):
+        params = copy.deepcopy(self.params)
+        params['tasks']['gnomon']['gnomon'] = '-b 0.6'
+        shutil.rmtree(os.path.join(self.tmp, "work", "22"))
+        r, planned, text = self.plan(params)
+        self.assertFalse(r)
+        self.assertEqual(planned, params)
+        self.assertIn("alignments of the previous run are not available", text)
+
+
+if __name__ == "__main__":
+    unittest.main()